@@ -0,0 +1,555 @@
+"""
+Concurrency control for shared documents.
+
+Infinoted doesn't transform anything itself, it relays each request with the state vector
+it was made at and leaves it to every client to transform concurrent requests, using the
+adOPTed algorithm (see http://infinote.org/protocol/ and Ressel et al.).  This module is
+that algorithm, it sits between the :class:`InfinotedProtocol`, which speaks XML, and the
+:class:`VobbyService`, which only sees plain edits.
+
+A state vector maps a user id to the number of requests of that user which have been
+executed.  They are plain dicts here, a missing user counts as 0.
+
+"""
+
+TRANSFORMS = {}
+
+
+class Insert(object):
+    """
+    Insert `text` at `position`.
+    """
+    __slots__ = ('position', 'text')
+
+    def __init__(self, position, text):
+        self.position = position
+        self.text = text
+
+    def apply(self, content):
+        return content[:self.position] + self.text + content[self.position:]
+
+    def __repr__(self):
+        return 'Insert(%d, %r)' % (self.position, self.text)
+
+
+class Delete(object):
+    """
+    Delete `length` characters at `position`.
+    """
+    __slots__ = ('position', 'length')
+
+    def __init__(self, position, length):
+        self.position = position
+        self.length = length
+
+    def apply(self, content):
+        return content[:self.position] + content[self.position + self.length:]
+
+    def __repr__(self):
+        return 'Delete(%d, %d)' % (self.position, self.length)
+
+
+class Split(object):
+    """
+    Two operations applied one after the other, `second` is relative to the document with
+    `first` applied.  This comes from a delete which had text inserted in the middle of it.
+    """
+    __slots__ = ('first', 'second')
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def apply(self, content):
+        return self.second.apply(self.first.apply(content))
+
+    def __repr__(self):
+        return 'Split(%r, %r)' % (self.first, self.second)
+
+
+class Move(object):
+    """
+    Move the caret to `position` with `length` characters selected from there, backwards
+    if negative.  The document doesn't change, the caret is transformed like the text
+    around it.
+    """
+    __slots__ = ('position', 'length')
+
+    def __init__(self, position, length=0):
+        self.position = position
+        self.length = length
+
+    def apply(self, content):
+        return content
+
+    def __repr__(self):
+        return 'Move(%d, %d)' % (self.position, self.length)
+
+
+class NoOp(object):
+    """
+    An operation which doesn't change the document, like an unsupported request or a delete
+    of what a concurrent delete already removed.
+    """
+    __slots__ = ()
+
+    def apply(self, content):
+        return content
+
+    def __repr__(self):
+        return 'NoOp()'
+
+
+NOOP = NoOp()
+
+
+def transform(operation, against, wins):
+    """
+    Transform `operation` to apply after `against`, both being made on the same document
+    state.
+
+    Args:
+        operation: The operation to transform.
+        against: The concurrent operation to transform against.
+        wins (bool): When both insert at the same position, whether `operation` ends up
+                     in front of `against`.
+
+    Returns:
+        The transformed operation.
+    """
+    if against is NOOP:
+        return operation
+
+    if against.__class__ is Split:
+        operation = transform(operation, against.first, wins)
+        return transform(operation, against.second, wins)
+
+    if operation.__class__ is Split:
+        first = transform(operation.first, against, wins)
+        against = transform(against, operation.first, not wins)
+        return Split(first, transform(operation.second, against, wins))
+
+    return TRANSFORMS[operation.__class__, against.__class__](operation, against, wins)
+
+
+def _insert_insert(operation, against, wins):
+    if operation.position < against.position or (operation.position == against.position
+                                                  and wins):
+        return operation
+    return Insert(operation.position + len(against.text), operation.text)
+
+
+def _insert_delete(operation, against, wins):
+    if operation.position <= against.position:
+        return operation
+    if operation.position >= against.position + against.length:
+        return Insert(operation.position - against.length, operation.text)
+    return Insert(against.position, operation.text)
+
+
+def _delete_insert(operation, against, wins):
+    if against.position >= operation.position + operation.length:
+        return operation
+    if against.position <= operation.position:
+        return Delete(operation.position + len(against.text), operation.length)
+
+    before = against.position - operation.position
+    return Split(Delete(operation.position, before),
+                 Delete(operation.position + len(against.text), operation.length - before))
+
+
+def _delete_delete(operation, against, wins):
+    end = operation.position + operation.length
+    against_end = against.position + against.length
+    if end <= against.position:
+        return operation
+    if operation.position >= against_end:
+        return Delete(operation.position - against.length, operation.length)
+
+    overlap = min(end, against_end) - max(operation.position, against.position)
+    if overlap == operation.length:
+        return NOOP
+    return Delete(min(operation.position, against.position), operation.length - overlap)
+
+
+def _noop(operation, against, wins):
+    return operation
+
+
+def _move(operation, against, wins):
+    start = _moved(operation.position, against)
+    end = _moved(operation.position + operation.length, against)
+    return Move(start, end - start)
+
+
+def _moved(position, against):
+    # Where `position` ends up once `against` is applied, text inserted right at it goes
+    # in front of it.
+    if against.__class__ is Insert:
+        if against.position <= position:
+            return position + len(against.text)
+        return position
+    if position <= against.position:
+        return position
+    return max(against.position, position - against.length)
+
+
+TRANSFORMS.update({
+    (Insert, Insert): _insert_insert,
+    (Insert, Delete): _insert_delete,
+    (Delete, Insert): _delete_insert,
+    (Delete, Delete): _delete_delete,
+    (NoOp, Insert): _noop,
+    (NoOp, Delete): _noop,
+    (NoOp, Move): _noop,
+    (Insert, Move): _noop,
+    (Delete, Move): _noop,
+    (Move, Move): _noop,
+    (Move, Insert): _move,
+    (Move, Delete): _move,
+})
+
+
+def vector_from_string(text, base=None):
+    """
+    Parse an infinote state vector, ``1:3;2:5``.  With a `base` vector the components are
+    differences to add to it, as in the ``time`` attribute of requests.
+
+    Returns:
+        dict: The state vector.
+    """
+    vector = dict(base) if base else {}
+    for component in text.split(';'):
+        if component:
+            user, count = component.split(':')
+            user = int(user)
+            vector[user] = vector.get(user, 0) + int(count)
+    return vector
+
+
+def vector_to_string(vector, base=None):
+    """
+    Format `vector` as an infinote state vector.  With a `base` vector only the differences
+    to it are written.
+    """
+    base = base or {}
+    return ';'.join(['%d:%d' % (user, count - base.get(user, 0))
+                     for user, count in sorted(vector.items())
+                     if count != base.get(user, 0)])
+
+
+def vector_key(vector):
+    """
+    A hashable key for `vector`, vectors which only differ by users at 0 share a key.
+    """
+    return tuple(sorted([item for item in vector.items() if item[1]]))
+
+
+class Request(object):
+    """
+    An `operation` made by `user` on the document at state `vector`.
+    """
+    __slots__ = ('user', 'vector', 'operation')
+
+    def __init__(self, user, vector, operation):
+        self.user = user
+        self.vector = vector
+        self.operation = operation
+
+
+class RequestLog(object):
+    """
+    The requests of one user, indexed by that user's component of their vectors.  Old
+    requests are dropped from the front so the log starts at :attr:`begin`.
+    """
+    __slots__ = ('begin', 'requests')
+
+    def __init__(self, begin=0):
+        self.begin = begin
+        self.requests = []
+
+    def __getitem__(self, index):
+        if index < self.begin:
+            raise LookupError('Request %d was already removed from the log' % index)
+        return self.requests[index - self.begin]
+
+    def __len__(self):
+        return len(self.requests)
+
+    def end(self):
+        return self.begin + len(self.requests)
+
+    def append(self, request):
+        self.requests.append(request)
+
+    def remove_before(self, index):
+        if index > self.begin:
+            del self.requests[:index - self.begin]
+            self.begin = index
+
+
+class Algorithm(object):
+    """
+    The adOPTed algorithm for one document.
+
+    Local operations are registered with :meth:`generate`, which gives the ``time`` to send
+    them with.  Remote requests go through :meth:`receive`, which returns the operation
+    transformed to apply to the local document.
+
+    When two users insert at the same position the user with the lower id ends up first.
+
+    While :attr:`offline` the requests of the local user are only dropped from the log once
+    they are :attr:`acknowledged`, until then they may still have to be sent again.
+
+    Kwargs:
+        user (int): The local user id, may be set later once the server assigned one.
+        cleanup_interval (int): How many requests to process between dropping requests
+                                nobody can be concurrent to anymore from the logs.
+
+    """
+    def __init__(self, user=None, cleanup_interval=64):
+        self.user = user
+        self.current = {}
+        self.logs = {}
+        self.user_vectors = {}
+        self.cleanup_interval = cleanup_interval
+        self.processed = 0
+        self.translated = {}
+        # How many requests of the local user the server is known to have, as the other
+        # users only learn about them from the server.
+        self.acknowledged = 0
+        self.offline = False
+
+    def set_user_vector(self, user, vector):
+        """
+        Record the state `user` was last seen at, from ``sync-user`` or ``user-join``.  The
+        current state is at least every user's state.
+        """
+        self.user_vectors[user] = dict(vector)
+        self._acknowledge(user, vector)
+        for other, count in vector.items():
+            if count > self.current.get(other, 0):
+                self.current[other] = count
+
+        log = self._log(user)
+        if not len(log):
+            log.begin = max(log.begin, vector.get(user, 0))
+
+    def add_synced(self, user, time, operation):
+        """
+        Add a request from the history sent while synchronizing, it is already part of the
+        document so it is only logged.
+        """
+        vector = vector_from_string(time)
+        log = self._log(user)
+        if not len(log):
+            log.begin = vector.get(user, 0)
+        log.append(Request(user, vector, operation))
+
+    def generate(self, operation):
+        """
+        Register a local `operation` which was made on the current document.
+
+        Returns:
+            string: The ``time`` attribute to send the request with, the difference to the
+                    previous request of the local user.
+        """
+        request = Request(self.user, dict(self.current), operation)
+        time = vector_to_string(request.vector, self.user_vectors.get(self.user))
+        self._execute(request)
+        return time
+
+    def receive(self, user, time, operation):
+        """
+        Process the request of `operation` by `user` made at `time`.
+
+        Args:
+            user (int): The user which made the request.
+            time (string): The ``time`` attribute of the request.
+            operation: The operation as the user made it.
+
+        Returns:
+            The operation transformed to apply to the current document.
+        """
+        vector = vector_from_string(time, self.user_vectors.get(user))
+        request = Request(user, vector, operation)
+        operation = self.translate(request, self.current)
+        self._acknowledge(user, vector)
+        self._execute(request)
+        return operation
+
+    def translate(self, request, vector):
+        """
+        Transform the operation of `request` to apply at state `vector`, which must include
+        everything `request` was made on.  Translations are kept until :meth:`cleanup`
+        drops `request` as the same ones are needed again for the following requests.
+        They are keyed on the request itself, not its ``id()``, which a request that failed
+        to translate would hand on to the next one.
+
+        Each translation needs others to states further back, as many levels of them as
+        there are requests `request` didn't know about.  They are worked out with a stack
+        rather than by recursion, which a request concurrent to a thousand others would
+        take deeper than Python allows.
+        """
+        key = (request, vector_key(vector))
+        operation = self._translation(*key)
+        if operation is not None:
+            return operation
+
+        stack = [(request, vector, key[1], None)]
+        while stack:
+            request, vector, target, step = stack[-1]
+            if step is None:
+                if (request, target) in self.translated:
+                    stack.pop()
+                    continue
+                step = self._step(request, vector)
+                stack[-1] = (request, vector, target, step)
+
+            against, previous, before = step
+            operation = self._translation(request, before)
+            other = self._translation(against, before)
+            if operation is None or other is None:
+                if operation is None:
+                    stack.append((request, previous, before, None))
+                if other is None:
+                    stack.append((against, previous, before, None))
+                continue
+
+            wins = request.user < against.user
+            if (operation.__class__ is Insert and other.__class__ is Insert and
+                    operation.position == other.position):
+                # A delete may have moved two inserts to the same position, so every site
+                # compares them where neither knew about the other, their least common
+                # successor.  Only if they were at the same position there too does the
+                # user id decide.  This is decided pair by pair, with three or more users
+                # inserting into text another one deleted the pairs may not agree on one
+                # order everywhere.
+                successor = dict(request.vector)
+                for user, count in against.vector.items():
+                    if count > successor.get(user, 0):
+                        successor[user] = count
+                common = vector_key(successor)
+                position = self._translation(request, common)
+                other_position = self._translation(against, common)
+                if position is None or other_position is None:
+                    if position is None:
+                        stack.append((request, successor, common, None))
+                    if other_position is None:
+                        stack.append((against, successor, common, None))
+                    continue
+                if position.position != other_position.position:
+                    wins = position.position < other_position.position
+
+            self.translated[request, target] = transform(operation, other, wins)
+            stack.pop()
+        return self.translated[key]
+
+    def _translation(self, request, target):
+        # The operation of `request` at the state keyed `target` if it is already known,
+        # None if it still has to be translated.
+        if target == vector_key(request.vector):
+            return request.operation
+        return self.translated.get((request, target))
+
+    def _step(self, request, vector):
+        """
+        Step back from `vector` over the last request of a user that `request` didn't know
+        about, and which none of the other unknown requests depend on.  The translation to
+        `vector` is that of `request` to the state before it transformed against the
+        translation of that request to the same state.
+
+        Returns:
+            tuple: The request stepped back over, the state before it and the
+                   :func:`vector_key` of that state.
+        """
+        latest = [(user, count, self.logs[user][count - 1])
+                  for user, count in vector.items()
+                  if count > request.vector.get(user, 0)]
+        for user, count, against in latest:
+            if all(other.vector.get(user, 0) < count for _, _, other in latest):
+                break
+        else:
+            raise ValueError('State %r is not reachable from %r' % (vector,
+                                                                    request.vector))
+
+        previous = dict(vector)
+        previous[user] = count - 1
+        return against, previous, vector_key(previous)
+
+    def acknowledge(self, count):
+        """
+        The server has the first `count` requests of the local user, like it says in the
+        state it gives us on joining.
+        """
+        self.acknowledged = max(self.acknowledged, count)
+
+    def _acknowledge(self, user, vector):
+        if self.user is not None and user != self.user:
+            self.acknowledge(vector.get(self.user, 0))
+
+    def _log(self, user):
+        log = self.logs.get(user)
+        if log is None:
+            log = self.logs[user] = RequestLog()
+        return log
+
+    def _execute(self, request):
+        user = request.user
+        log = self._log(user)
+        if not len(log):
+            log.begin = request.vector.get(user, 0)
+        log.append(request)
+
+        vector = dict(request.vector)
+        vector[user] = vector.get(user, 0) + 1
+        self.user_vectors[user] = vector
+        self.current[user] = self.current.get(user, 0) + 1
+
+        self.processed += 1
+        if self.processed % self.cleanup_interval == 0:
+            self.cleanup()
+
+    def cleanup(self):
+        """
+        Drop the requests every user already knew about when making their last request, no
+        request to come can be concurrent to them.  The local user's next request knows
+        about everything executed so far, even when it hasn't made any for a while.  While
+        :attr:`offline` its own requests are kept until acknowledged.
+        """
+        users = list(self.logs)
+        vectors = dict(self.user_vectors)
+        if self.user is not None:
+            vectors[self.user] = self.current
+        oldest = dict((user, min([vector.get(user, 0) for vector in vectors.values()]))
+                      for user in users)
+        if self.offline and self.user in oldest:
+            oldest[self.user] = min(oldest[self.user], self.acknowledged)
+
+        # Requests which are kept may still be translated, which needs everything since the
+        # state they were made at.  Each kept request is looked at once, keeping older ones
+        # adds them to the work list.
+        pending = [(user, max(oldest[user], self.logs[user].begin), self.logs[user].end())
+                   for user in users]
+        while pending:
+            user, start, end = pending.pop()
+            log = self.logs[user]
+            for index in range(start, end):
+                vector = log[index].vector
+                for other in users:
+                    count = max(vector.get(other, 0), self.logs[other].begin)
+                    if count < oldest[other]:
+                        pending.append((other, count, oldest[other]))
+                        oldest[other] = count
+
+        for user in users:
+            self.logs[user].remove_before(oldest[user])
+
+        # Translations of the requests which are kept are still needed, without them the
+        # next translation would have to work its way back through the whole log.
+        kept = set()
+        for log in self.logs.values():
+            kept.update(log.requests)
+        self.translated = dict((key, operation)
+                               for key, operation in self.translated.items()
+                               if key[0] in kept)
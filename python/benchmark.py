@@ -0,0 +1,640 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Throughput benchmarks for the hot paths of the bridge.
+
+Each benchmark drives the real protocol classes over in memory transports so no Vim or
+infinoted instance is needed.  Run a benchmark by name from the ``python`` directory::
+
+    ./benchmark.py netbeans [recorded_session]
+    ./benchmark.py coalesce [recorded_session]
+    ./benchmark.py ot [users] [requests] [lag]
+    ./benchmark.py document [megabytes]
+    ./benchmark.py sync [megabytes] [stanza|domish]
+    ./benchmark.py parse [stanzas]
+    ./benchmark.py replay {typing,paste,cursor,concurrent,batched,sync,substitute} [scale]
+    ./benchmark.py replay trace [scale]
+    ./benchmark.py fanout [vims] [scale]
+    ./benchmark.py backpressure [scale]
+    ./benchmark.py dispatch [stanzas]
+    ./benchmark.py directory [documents]
+    ./benchmark.py startup [lines]
+
+A recorded session is the raw bytes Vim sent over the netbeans socket, for instance as
+captured with ``socat -v``.  Without one a synthetic typing session is generated.
+
+The benchmarks which check that the documents converged exit with 1 when they didn't.
+
+The replay benchmark feeds both protocols at once, see :mod:`replay`, either a generated
+scenario or a trace dumped with ``kill -USR1``.  The fanout benchmark replays the typing
+and concurrent scenarios with several Vims connected to the one service.
+
+The startup benchmark runs ``run.py`` for real against a :mod:`fake_infinoted` server and
+a stand in for Vim, timing from launching it until Vim has the whole first document.
+
+"""
+import os
+import random
+import socket
+import sys
+import timeit
+
+from twisted.internet import protocol, reactor, task
+from twisted.test.proto_helpers import StringTransport
+from twisted.words.protocols.jabber import xmlstream
+from twisted.words.xish import domish
+from xml.sax.saxutils import escape
+
+from adopted import Algorithm, Delete, Insert
+from coalescer import OperationCoalescer
+from directory import SUBDIRECTORY, TEXT, Directory
+from document import Document
+from fake_infinoted import FakeInfinoted
+from infinoted import InfinotedProtocol, operation_from_xml
+from replay import (LINE, SCENARIOS, CountingTransport, Replay, concurrent, cursor,
+                    load_trace, open_session)
+from vimbeans import VimBeansProtocol
+from metrics import Metrics
+from stanza import StanzaStream
+from wiretrace import Tracer
+
+
+class CountingService(object):
+    """
+    Stand in for :class:`vobby.VobbyService` which only counts the operations it sees.
+    """
+    def __init__(self):
+        self.clock = task.Clock()
+        self.tracer = Tracer()
+        self.metrics = Metrics()
+        self.operations = 0
+
+    def add_protocol(self, protocol):
+        pass
+
+    def vim_connected(self, vim):
+        pass
+
+    def vim_disconnected(self, vim):
+        pass
+
+    def insert_gobby(self, content, offset, buffer_name, origin=None):
+        self.operations += 1
+
+    def delete_gobby(self, offset, length, buffer_name, origin=None):
+        self.operations += 1
+
+    def replace_gobby(self, offset, length, content, buffer_name):
+        self.operations += 1
+
+    def caret_gobby(self, offset, selection, buffer_name):
+        self.operations += 1
+
+
+def typing_session(keystrokes, buffers=12):
+    """
+    Generate a netbeans session of someone typing across `buffers` buffers.  Every
+    keystroke is the remove/insert pair Vim sends, with the occasional paste.
+
+    Returns:
+        string: The raw netbeans traffic.
+    """
+    rand = random.Random(0)
+    lines = ['AUTH changeme\n']
+    for bufid in range(1, buffers + 1):
+        lines.append('0:fileOpened=0 "/tmp/file_%d.txt" T F\n' % bufid)
+
+    offsets = [0] * (buffers + 1)
+    for seqno in range(keystrokes):
+        bufid = rand.randint(1, buffers)
+        offset = offsets[bufid]
+        if rand.random() < 0.01:
+            text = 'pasted \\"text\\"\\n' * 20
+        else:
+            text = rand.choice('abcdefghijklmnopqrstuvwxyz ')
+        lines.append('%d:remove=%d %d 0\n' % (bufid, seqno, offset))
+        lines.append('%d:insert=%d %d "%s"\n' % (bufid, seqno, offset, text))
+        offsets[bufid] += 1
+
+    return ''.join(lines)
+
+
+def chunked(data, rand):
+    """
+    Split `data` into reads of random sizes, like they arrive off of a socket.
+    """
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = start + rand.randint(1, 4096)
+        chunks.append(data[start:end])
+        start = end
+    return chunks
+
+
+def load_session(args):
+    """
+    The recorded session named in `args`, or a synthetic one.
+    """
+    if args:
+        with open(args[0], 'rb') as session:
+            return session.read()
+    return typing_session(50000)
+
+
+def bench_netbeans(args):
+    """
+    Messages per second through :meth:`VimBeansProtocol.dataReceived`.
+    """
+    data = load_session(args)
+    messages = data.count('\n')
+    chunks = chunked(data, random.Random(0))
+
+    service = CountingService()
+    protocol = VimBeansProtocol(service)
+    protocol.makeConnection(StringTransport())
+
+    start = timeit.default_timer()
+    for chunk in chunks:
+        protocol.dataReceived(chunk)
+    elapsed = timeit.default_timer() - start
+
+    print('%d messages in %d reads, %d operations' % (messages, len(chunks),
+                                                      service.operations))
+    print('%.3f seconds, %.0f messages/sec' % (elapsed, messages / elapsed))
+
+
+def bench_coalesce(args):
+    """
+    How many requests the :class:`OperationCoalescer` lets through for the edits of a
+    session, with the reads arriving 10ms apart.
+    """
+    data = load_session(args)
+    chunks = chunked(data, random.Random(0))
+
+    clock = task.Clock()
+    sent = CountingService()
+    service = CountingService()
+    coalescer = OperationCoalescer(sent.insert_gobby, sent.delete_gobby, sent.replace_gobby,
+                                   clock=clock)
+    service.insert_gobby = lambda content, offset, buffer_name, origin=None: (
+        coalescer.insert(content, offset, buffer_name))
+    service.delete_gobby = lambda offset, length, buffer_name, origin=None: (
+        coalescer.delete(offset, length, buffer_name))
+    protocol = VimBeansProtocol(service)
+    protocol.makeConnection(StringTransport())
+
+    edits = data.count(':insert=') + data.count(':remove=')
+    start = timeit.default_timer()
+    for chunk in chunks:
+        protocol.dataReceived(chunk)
+        clock.advance(0.01)
+    coalescer.flush()
+    elapsed = timeit.default_timer() - start
+
+    print('%d edits from Vim, %d requests sent, %.1fx fewer' % (
+        edits, sent.operations, float(edits) / max(sent.operations, 1)))
+    print('%.3f seconds' % elapsed)
+
+
+def bench_ot(args):
+    """
+    Requests per second through :meth:`Algorithm.receive` with many users editing at the
+    same time.  Every user sees the requests in the order the server relays them, but lags
+    up to `lag` requests behind, like network latency, so each request is concurrent to a
+    few others.
+    """
+    users = int(args[0]) if args else 20
+    requests = int(args[1]) if len(args) > 1 else 2000
+    lag = int(args[2]) if len(args) > 2 else 4
+    rand = random.Random(0)
+
+    sites = [Algorithm(user) for user in range(1, users + 1)]
+    for site in sites:
+        for user in range(1, users + 1):
+            site.set_user_vector(user, {})
+    documents = ['The quick brown fox jumps over the lazy dog\n' * 10] * users
+    relayed = []
+    seen = [0] * users
+    received = [0]
+
+    def catch_up(index, end):
+        site = sites[index]
+        for user, time, operation in relayed[seen[index]:end]:
+            if user != site.user:
+                operation = site.receive(user, time, operation)
+                documents[index] = operation.apply(documents[index])
+                received[0] += 1
+        seen[index] = max(seen[index], end)
+
+    start = timeit.default_timer()
+    for _ in range(requests):
+        for index in range(users):
+            catch_up(index, max(0, len(relayed) - rand.randint(0, lag)))
+
+        index = rand.randrange(users)
+        document = documents[index]
+        position = rand.randint(0, len(document))
+        if document and rand.random() < 0.3:
+            operation = Delete(min(position, len(document) - 1), 1)
+        else:
+            operation = Insert(position, rand.choice('abcdefghijklmnopqrstuvwxyz'))
+        documents[index] = operation.apply(document)
+        relayed.append((sites[index].user, sites[index].generate(operation), operation))
+
+    for index in range(users):
+        catch_up(index, len(relayed))
+    elapsed = timeit.default_timer() - start
+
+    converged = len(set(documents)) == 1
+    print('%d users, %d requests generated, %d received' % (users, requests, received[0]))
+    print('%.3f seconds, %.0f requests/sec, documents %s' % (
+        elapsed, (requests + received[0]) / elapsed,
+        'converged' if converged else 'DIVERGED'))
+    return 0 if converged else 1
+
+
+def bench_document(args):
+    """
+    Edits and line lookups per second on a large :class:`Document`.
+    """
+    megabytes = float(args[0]) if args else 10
+    line = u'The quick brown fox jumps over the lazy dog\n'
+    document = Document(line * int(megabytes * 1024 * 1024 / len(line)))
+    rand = random.Random(0)
+
+    edits = 100000
+    start = timeit.default_timer()
+    for _ in range(edits):
+        offset = rand.randint(0, len(document) - 10)
+        if rand.random() < 0.3:
+            document.delete(offset, rand.randint(1, 10))
+        else:
+            document.insert(rand.choice(u'abc\n'), offset)
+        document.line_column(offset)
+    elapsed = timeit.default_timer() - start
+
+    print('%d characters in %d chunks' % (len(document), len(document.chunks)))
+    print('%.3f seconds, %.0f edits/sec' % (elapsed, edits / elapsed))
+
+
+def bench_sync(args):
+    """
+    Megabytes per second through the synchronization of a large document, from parsing
+    the ``sync-segment`` stanzas to writing the inserts to Vim.  The stanzas are parsed by
+    a :class:`StanzaStream`, or by twisted's own parser with ``domish``.
+    """
+    megabytes = float(args[0]) if args else 10
+    parser = PARSERS[args[1] if len(args) > 1 else 'stanza']
+    line = u'The <quick> brown fox jumps over the lazy d\xf6g\n'
+    text = line * int(megabytes * 1024 * 1024 / len(line))
+    segment = 64 * 1024
+    data = ''.join(['<group publisher="server" name="InfSession_1">'
+                    '<sync-segment author="1">%s</sync-segment></group>' %
+                    escape(text[start:start + segment]).encode('utf-8')
+                    for start in range(0, len(text), segment)])
+
+    service = CountingService()
+    transport = CountingTransport()
+    protocol = VimBeansProtocol(service)
+    protocol.makeConnection(transport)
+    protocol.new_buffer(u'big.txt')
+    document = Document()
+
+    def segment_received(element):
+        content = unicode(element.firstChildElement())
+        document.insert(content, len(document))
+        protocol.sync(content, u'big.txt')
+
+    stream = parser()
+    stream.DocumentStartEvent = lambda root: None
+    stream.ElementEvent = segment_received
+    stream.DocumentEndEvent = lambda: None
+
+    start = timeit.default_timer()
+    stream.parse('<stream>')
+    for chunk in chunked(data, random.Random(0)):
+        stream.parse(chunk)
+    protocol.sync_done(u'big.txt')
+    protocol.commands.flush()
+    elapsed = timeit.default_timer() - start
+
+    print('%d characters synchronized, %d bytes in %d writes, largest %d' % (
+        len(document), transport.bytes, transport.writes, transport.largest))
+    print('%.3f seconds, %.1f MB/sec' % (elapsed, len(data) / elapsed / 1024 / 1024))
+
+
+def bench_directory(args):
+    """
+    Nodes added and paths found per second in a :class:`Directory` of `documents` text
+    documents, spread over three levels of ten subdirectories each.
+    """
+    documents = int(args[0]) if args else 100000
+    directory = Directory()
+    paths = []
+
+    start = timeit.default_timer()
+    parents = [directory.root.node_id]
+    for depth in range(3):
+        subdirectories = []
+        for parent in parents:
+            for index in range(10):
+                node = directory.add(unicode(len(directory)), parent, u'dir%d' % index,
+                                     SUBDIRECTORY)
+                subdirectories.append(node.node_id)
+        parents = subdirectories
+    for index in range(documents):
+        node = directory.add(unicode(len(directory)), parents[index % len(parents)],
+                             u'document%d.txt' % index, TEXT)
+        paths.append(node.path())
+    added = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    found = sum([1 for path in paths if directory.find(path) is not None])
+    elapsed = timeit.default_timer() - start
+
+    print('%d nodes, %.0f added/sec' % (len(directory), len(directory) / added))
+    print('%d paths found, %.0f lookups/sec' % (found, len(paths) / elapsed))
+
+
+# The parsers the receive path can use, by name.
+PARSERS = {
+    'domish': domish.elementStream,
+    'stanza': StanzaStream,
+}
+
+
+def bench_parse(args):
+    """
+    Request stanzas per second through each of the :data:`PARSERS`, with the operation of
+    each request built like :meth:`InfinotedProtocol.request` does.
+    """
+    count = int(args[0]) if args else 100000
+    data = ''.join(['<group publisher="server" name="InfSession_1">'
+                    '<request user="2" time="1:%d"><insert-caret pos="%d">%s</insert-caret>'
+                    '</request></group>' % (index, index, 'abcdefghij'[index % 10])
+                    for index in range(count)])
+    reads = chunked(data, random.Random(0))
+
+    for name, parser in sorted(PARSERS.items()):
+        operations = []
+
+        def stanza_received(element):
+            for node in element.elements():
+                operations.append(operation_from_xml(node.firstChildElement()))
+
+        stream = parser()
+        stream.DocumentStartEvent = lambda root: None
+        stream.ElementEvent = stanza_received
+        stream.DocumentEndEvent = lambda: None
+
+        start = timeit.default_timer()
+        stream.parse('<stream>')
+        for read in reads:
+            stream.parse(read)
+        elapsed = timeit.default_timer() - start
+
+        print('%-6s %d stanzas, %.3f seconds, %.0f stanzas/sec' % (
+            name, len(operations), elapsed, len(operations) / elapsed))
+
+
+# The XPath observers InfinotedProtocol used to register, one per message type.
+XPATH_OBSERVERS = [
+    '/group/welcome', '/group/explore-begin', '/group/explore-end', '/group/subscribe-chat',
+    '/group/subscribe-session', '/group/sync-begin', '/group/sync-end', '/group/user-join',
+    '/group/user-rejoin', '/group/add-node', '/group/sync-segment', '/group/sync-user',
+    '/group/sync-request', '/group/request',
+]
+
+
+def bench_dispatch(args):
+    """
+    Stanzas per second routed to their handlers, by the XPath observers which used to be
+    registered for each message type and by :meth:`InfinotedProtocol.group`.  The handlers
+    do nothing so only the routing is measured.
+    """
+    count = int(args[0]) if args else 100000
+    rand = random.Random(0)
+    messages = (['<request user="2" time="1:1"><insert-caret pos="0">a</insert-caret>'
+                 '</request>'] * 8 +
+                ['<request user="2" time=""><delete-caret pos="0" len="1"/></request>',
+                 '<user-join id="3" name="x" time="" caret="0" status="active"/>'])
+    stream = domish.elementStream()
+    stanzas = []
+    stream.DocumentStartEvent = lambda root: None
+    stream.ElementEvent = stanzas.append
+    stream.DocumentEndEvent = lambda: None
+    stream.parse('<stream>')
+    for _ in range(count):
+        stream.parse('<group publisher="server" name="InfSession_1">%s</group>' %
+                     rand.choice(messages))
+
+    handled = [0]
+
+    def handler(*args):
+        handled[0] += 1
+
+    xpath = xmlstream.XmlStream(xmlstream.Authenticator())
+    for query in XPATH_OBSERVERS:
+        xpath.addObserver(query, handler)
+
+    protocol = InfinotedProtocol(CountingService())
+    protocol.handlers = dict((name, handler) for name in protocol.handlers)
+    table = xmlstream.XmlStream(xmlstream.Authenticator())
+    table.addObserver('/group', protocol.group)
+
+    for name, xs in (('xpath', xpath), ('table', table)):
+        handled[0] = 0
+        start = timeit.default_timer()
+        for stanza in stanzas:
+            xs.dispatch(stanza)
+        elapsed = timeit.default_timer() - start
+        print('%-6s %d stanzas, %d handled, %.3f seconds, %.0f stanzas/sec' % (
+            name, len(stanzas), handled[0], elapsed, len(stanzas) / elapsed))
+
+
+def bench_replay(args):
+    """
+    Messages per second and the latency of each message through both protocols for a
+    generated scenario or a dumped trace.
+    """
+    name = args[0] if args else 'typing'
+    scale = float(args[1]) if len(args) > 1 else 1
+    if name in SCENARIOS:
+        messages = SCENARIOS[name](scale)
+    else:
+        messages = load_trace(name)
+
+    replay = Replay()
+    result = replay.run(messages)
+    latency = result['latency'].summary()
+    print('%d messages, %d bytes in, %d bytes to Vim, %d bytes to infinoted in %d edits' % (
+        result['messages'], result['bytes'], replay.vim_transport.bytes,
+        replay.infinoted_transport.bytes,
+        replay.service.metrics.counters.get('infinoted.edits', 0)))
+    print('%.3f seconds, %.0f messages/sec, %.1f MB/sec' % (
+        result['seconds'], result['messages'] / result['seconds'],
+        result['bytes'] / result['seconds'] / 1024 / 1024))
+    print('latency p50 %.3fms p99 %.3fms max %.3fms, %s allocated' % (
+        latency['p50_ms'], latency['p99_ms'], latency['max_ms'], result['allocated']))
+    converged = replay.converged()
+    print('documents %s' % ('converged' if converged else 'DIVERGED'))
+    return 0 if converged else 1
+
+
+def bench_fanout(args):
+    """
+    Messages per second with one and with `vims` Vims connected, one of them typing while
+    the others follow along, and the others editing concurrently.
+    """
+    vims = int(args[0]) if args else 8
+    scale = float(args[1]) if len(args) > 1 else 0.5
+    diverged = 0
+    for name in ('typing', 'concurrent'):
+        messages = SCENARIOS[name](scale)
+        for count in (1, vims):
+            replay = Replay(vims=count)
+            result = replay.run(messages)
+            latency = result['latency'].summary()
+            converged = replay.converged()
+            diverged += not converged
+            print('%s, %d vims: %.0f messages/sec, p99 %.3fms, %d bytes to each Vim%s' % (
+                name, count, result['messages'] / result['seconds'], latency['p99_ms'],
+                replay.vim_transports[-1].bytes, '' if converged else ', DIVERGED'))
+    return 1 if diverged else 0
+
+
+def bench_backpressure(args):
+    """
+    How much is held back while first Vim and then infinoted stall, the others typing into
+    the stalled Vim and Vim jumping around typing for the stalled infinoted, against what
+    would have piled up in the transport.
+    """
+    scale = float(args[0]) if args else 1
+    text = LINE * 100
+    stalls = (('vim', concurrent(8, int(1000 * scale), text)),
+              ('infinoted', cursor(int(5000 * scale), text, jump=0.2)))
+    diverged = 0
+    for side, messages in stalls:
+        sent = {}
+        for stalled in (False, True):
+            replay = Replay()
+            replay.run(open_session(text, users=8))
+            transport = getattr(replay, side + '_transport')
+            before = transport.bytes
+            if stalled:
+                transport.producer.pauseProducing()
+            for source, data in messages:
+                replay.feed(source, data)
+                replay.clock.advance(0.01)
+            held = transport.bytes - before
+            if stalled:
+                transport.producer.resumeProducing()
+            replay.service.coalescer.flush()
+            replay.clock.advance(1)
+            sent[stalled] = transport.bytes - before
+
+        counters, peaks = replay.service.metrics.counters, replay.service.metrics.peaks
+        prefix = 'vim' if side == 'vim' else 'coalescer'
+        converged = replay.converged()
+        diverged += not converged
+        print('%s stalled: %d bytes would have piled up, %d written while stalled, '
+              '%d after' % (side, sent[False], held, sent[True]))
+        print('  peak %d edits held, %d compactions, converged %s' % (
+            peaks.get(prefix + '.held', 0), counters.get(prefix + '.compactions', 0),
+            converged))
+    return 1 if diverged else 0
+
+
+class FirstSync(protocol.Protocol):
+    """
+    Stands in for Vim in :func:`bench_startup`, stopping the reactor once a buffer is
+    complete.
+    """
+    def connectionMade(self):
+        self.factory.times['vim connected'] = timeit.default_timer()
+        self.transport.write('AUTH changeme\n0:startupDone=0\n')
+        self.received = ''
+
+    def dataReceived(self, data):
+        self.received = self.received[-32:] + data
+        if 'initDone' in self.received and 'first sync' not in self.factory.times:
+            self.factory.times['first sync'] = timeit.default_timer()
+            reactor.stop()
+
+
+class FirstSyncFactory(protocol.ClientFactory):
+    """
+    Connects a :class:`FirstSync` as soon as the port is listening, trying again until it
+    is.
+    """
+    protocol = FirstSync
+
+    def __init__(self):
+        self.times = {}
+
+    def clientConnectionFailed(self, connector, reason):
+        reactor.callLater(0.005, connector.connect)
+
+
+def bench_startup(args):
+    """
+    Seconds from launching ``run.py`` until Vim can connect and until Vim has the whole
+    first document of `lines` lines.
+    """
+    lines = int(args[0]) if args else 1000
+    server = FakeInfinoted({u'shared.txt': u'The quick brown fox\n' * lines})
+    infinoted = reactor.listenTCP(0, server.factory(), interface='127.0.0.1')
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    command = [sys.executable, os.path.join(here, 'run.py'), '--port', str(port),
+               '--interface', '127.0.0.1', '--metrics-port', '0', '--no-tls',
+               '--infinoted', '127.0.0.1:%d' % infinoted.getHost().port]
+    factory = FirstSyncFactory()
+    start = timeit.default_timer()
+    process = reactor.spawnProcess(protocol.ProcessProtocol(), sys.executable, command,
+                                   env=os.environ, path=here)
+    reactor.connectTCP('127.0.0.1', port, factory)
+    reactor.callLater(30, reactor.stop)
+    reactor.run()
+    process.signalProcess('TERM')
+
+    for name in ('vim connected', 'first sync'):
+        if name in factory.times:
+            print('%-13s %.3f seconds' % (name, factory.times[name] - start))
+        else:
+            print('%-13s timed out' % name)
+
+
+BENCHMARKS = {
+    'backpressure': bench_backpressure,
+    'coalesce': bench_coalesce,
+    'directory': bench_directory,
+    'dispatch': bench_dispatch,
+    'document': bench_document,
+    'fanout': bench_fanout,
+    'netbeans': bench_netbeans,
+    'parse': bench_parse,
+    'ot': bench_ot,
+    'replay': bench_replay,
+    'startup': bench_startup,
+    'sync': bench_sync,
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print('usage: %s {%s} [args]' % (sys.argv[0], ','.join(sorted(BENCHMARKS))))
+        return 1
+
+    return BENCHMARKS[sys.argv[1]](sys.argv[2:])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+The buffers open in Vim, each connected Vim numbers its own.
+"""
+
+from document import Document
+
+
+class Buffer(object):
+    """
+    One Vim buffer.
+
+    Args:
+        bufid (int): The netbeans buffer number.
+        name (unicode): The buffer name, the name of the node in the infinoted directory.
+
+    Attributes:
+        document (Document): Mirrors the contents of the Vim buffer, to translate offsets.
+        listening (bool): Whether Vim was told to report changes to the buffer.
+        seqno (int): The sequence number of the last event Vim sent for the buffer.
+
+    """
+    __slots__ = ('bufid', 'name', 'document', 'listening', 'seqno')
+
+    def __init__(self, bufid, name):
+        self.bufid = bufid
+        self.name = name
+        self.document = Document()
+        self.listening = False
+        self.seqno = 0
+
+    def __repr__(self):
+        return 'Buffer(%d, %r)' % (self.bufid, self.name)
+
+
+class BufferRegistry(object):
+    """
+    Finds a :class:`Buffer` by its netbeans buffer number or by its name, both in constant
+    time no matter how many buffers are open.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.names = {}
+        self.last_id = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids.values())
+
+    def add(self, name):
+        """
+        Register a new buffer called `name` under the next buffer number.  A buffer already
+        registered under `name` is replaced.
+
+        Returns:
+            Buffer: The new buffer.
+        """
+        self.remove(self.names.get(name))
+        self.last_id += 1
+        buffer = Buffer(self.last_id, name)
+        self.ids[buffer.bufid] = buffer
+        self.names[name] = buffer
+        return buffer
+
+    def remove(self, buffer):
+        """
+        Forget `buffer`, None is ignored.
+        """
+        if buffer is not None:
+            self.ids.pop(buffer.bufid, None)
+            if self.names.get(buffer.name) is buffer:
+                del self.names[buffer.name]
+
+    def get(self, bufid):
+        """
+        The buffer numbered `bufid`, None if there isn't one.
+        """
+        return self.ids.get(bufid)
+
+    def find(self, name):
+        """
+        The buffer called `name`, None if there isn't one.
+        """
+        return self.names.get(name)
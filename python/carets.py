@@ -0,0 +1,193 @@
+"""
+Shows where the other users of a document are in Vim, with netbeans annotations.
+
+Netbeans annotations are signs on whole lines, so every user gets a sign with their initials
+in their colour on the line of their caret, and the line they last edited is highlighted
+in a lighter shade of it.  Carets can move with every request, so they are only redrawn
+once a frame, each user where they ended up, and no more than :data:`PER_FRAME` of them.
+While Vim is behind they aren't redrawn at all, only where they moved to is kept.
+
+"""
+import colorsys
+import re
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+# The words and numbers of a name.
+WORD = re.compile(r'[^\W\d_]+|\d+', re.UNICODE)
+
+# Seconds between redrawing the carets which moved.
+FRAME = 0.1
+
+# The most carets redrawn in a frame, the others wait for the next one.
+PER_FRAME = 8
+
+# The kinds of annotation for a user, the sign at the caret and the highlight of the line
+# last edited, with the saturation of their colour.
+CARET = 'Caret'
+EDIT = 'Edit'
+SATURATION = {CARET: 0.6, EDIT: 0.2}
+
+
+def hue_color(hue, saturation):
+    """
+    The colour of `hue`, 0 to 1 as infinote has it, at `saturation` as the ``0xRRGGBB``
+    number netbeans takes.
+    """
+    red, green, blue = colorsys.hsv_to_rgb(hue % 1.0, saturation, 1.0)
+    return (int(red * 255) << 16) | (int(green * 255) << 8) | int(blue * 255)
+
+
+def initials(name):
+    """
+    The text of the sign for the user `name`, the first letters of its first two words or
+    numbers, or of its only one.
+    """
+    words = WORD.findall(name)
+    if len(words) > 1:
+        return words[0][0] + words[1][0]
+    return words[0][:2] if words else u'@'
+
+
+class CaretAnnotations(object):
+    """
+    The annotations of the other users in the buffers of one Vim.
+
+    Args:
+        commands (CommandQueue): Where the annotation commands are queued.
+        buffers (BufferRegistry): The buffers of the Vim.
+
+    Kwargs:
+        clock (IReactorTime): Used to schedule the redraws.
+        frame (float): Seconds between redraws.
+        per_frame (int): The most carets redrawn at once.
+        metrics (Metrics): Counts the moves and how many of them were drawn.
+
+    """
+    def __init__(self, commands, buffers, clock=reactor, frame=FRAME, per_frame=PER_FRAME,
+                 metrics=None):
+        self.commands = commands
+        self.buffers = buffers
+        self.clock = clock
+        self.frame = frame
+        self.per_frame = per_frame
+        self.metrics = metrics
+        # The users to redraw by buffer name and user name, with whether they edited, the
+        # longest waiting first.
+        self.pending = OrderedDict()
+        # The buffer number and serial number of each annotation shown, by buffer name,
+        # user name and kind.
+        self.shown = {}
+        # The type numbers of the annotation types defined in each buffer by type name, by
+        # buffer number, and the type name of each user by kind, user name and hue.
+        self.types = {}
+        self.names = {}
+        self.serial = 0
+        self.paused = False
+        self.call = None
+
+    def move(self, buffer_name, user, edited=False):
+        """
+        The caret of `user` moved in `buffer_name`, because of an edit if `edited`.  It is
+        drawn where the caret is at the next frame.
+        """
+        if self.metrics is not None:
+            self.metrics.count('carets.moves')
+        key = (buffer_name, user.name)
+        if key in self.pending:
+            edited = edited or self.pending[key][1]
+        self.pending[key] = (user, edited)
+        if self.call is None and not self.paused:
+            self.call = self.clock.callLater(self.frame, self.flush)
+
+    def remove(self, buffer_name, name):
+        """
+        Take the annotations of the user `name` out of `buffer_name`.
+        """
+        self.pending.pop((buffer_name, name), None)
+        for kind in (CARET, EDIT):
+            self._remove((buffer_name, name, kind))
+
+    def flush(self):
+        """
+        Draw the carets which moved since the last frame, those which have waited longest
+        first.
+        """
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+        for _ in range(min(self.per_frame, len(self.pending))):
+            (buffer_name, name), (user, edited) = self.pending.popitem(last=False)
+            buffer = self.buffers.find(buffer_name)
+            if buffer is None:
+                continue
+
+            offset = buffer.document.byte_offset(min(max(user.caret, 0),
+                                                     len(buffer.document)))
+            self._draw(buffer, user, CARET, offset)
+            if edited:
+                self._draw(buffer, user, EDIT, offset)
+            if self.metrics is not None:
+                self.metrics.count('carets.drawn')
+
+        if self.pending:
+            self.call = self.clock.callLater(self.frame, self.flush)
+
+    def pause(self):
+        """
+        Stop redrawing until :meth:`resume`, Vim is behind.
+        """
+        self.paused = True
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def resume(self):
+        """
+        Redraw the carets which moved meanwhile.
+        """
+        self.paused = False
+        if self.pending:
+            self.flush()
+
+    def stop(self):
+        """
+        Drop the redraw still to come, Vim went away.
+        """
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        self.pending.clear()
+
+    def _draw(self, buffer, user, kind, offset):
+        key = (buffer.name, user.name, kind)
+        self._remove(key)
+        self.serial += 1
+        self.commands.command(buffer.bufid, 'addAnno', self.serial,
+                              self._type(buffer, user, kind), offset, 0)
+        self.shown[key] = (buffer.bufid, self.serial)
+
+    def _remove(self, key):
+        shown = self.shown.pop(key, None)
+        if shown is not None:
+            buffer = self.buffers.find(key[0])
+            if buffer is not None and buffer.bufid == shown[0]:
+                self.commands.command(buffer.bufid, 'removeAnno', shown[1])
+
+    def _type(self, buffer, user, kind):
+        # Type names are global to Vim, so a user whose colour changed gets a new one.
+        name = self.names.get((kind, user.name, user.hue))
+        if name is None:
+            name = self.names[kind, user.name, user.hue] = 'Vobby%s%d' % (kind,
+                                                                        len(self.names))
+
+        types = self.types.setdefault(buffer.bufid, {})
+        number = types.get(name)
+        if number is None:
+            number = types[name] = len(types) + 1
+            glyph = initials(user.name) if kind == CARET else u''
+            self.commands.command(buffer.bufid, 'defineAnnoType', number, name, user.name,
+                                  glyph, 0, hue_color(user.hue, SATURATION[kind]))
+        return number
@@ -0,0 +1,418 @@
+"""
+Merges the stream of small edits coming from Vim into fewer, larger edits.
+
+Vim reports every keystroke as its own ``insert`` and most changes as a ``remove`` followed
+by an ``insert`` at the same offset.  Sending each of those to infinoted as its own request
+is wasteful, so edits to a buffer are held for a short window and merged while they stay
+contiguous.
+
+Caret moves are held back longer still, only the last one is sent once the caret has rested
+or along with the next edits sent, so they end up in the same stanza.  An edit moves the
+caret itself, so a move followed by an edit isn't sent at all.
+
+While the other side can't keep up the edits are held back in an :class:`EditQueue` for
+each buffer instead.  It merges them the same way, and once it holds more than
+:data:`MAX_HELD` it replaces them with the :func:`diff.splices` of the text before and
+after them, so however long the wait it never grows past that.  Edits made on the other
+side meanwhile are transformed against the ones held, and those against them.
+
+"""
+
+from twisted.internet import reactor
+
+from adopted import Delete, Insert, Move, Split, transform
+from diff import difference, splices
+
+# The most edits an :class:`EditQueue` holds before compacting them.
+MAX_HELD = 64
+
+
+class Splice(object):
+    """
+    A pending edit, replace `length` characters at `offset` of the document as it was
+    before the edit with `text`.  A plain insert has a `length` of 0 and a plain delete has
+    an empty `text`.
+
+    """
+    __slots__ = ('offset', 'length', 'text')
+
+    def __init__(self, offset, length, text):
+        self.offset = offset
+        self.length = length
+        self.text = text
+
+    def merge_delete(self, offset, length):
+        """
+        Fold a delete of `length` characters at `offset` into this splice.  The `offset` is
+        relative to the document with this splice already applied.
+
+        Returns:
+            bool: False if the delete doesn't touch this splice and can't be merged.
+        """
+        start = self.offset
+        end = start + len(self.text)
+        if offset > end or offset + length < start:
+            return False
+
+        before = max(0, start - offset)
+        after = max(0, offset + length - end)
+        self.text = (self.text[:max(offset, start) - start] +
+                     self.text[min(offset + length, end) - start:])
+        self.offset = min(offset, start)
+        self.length += before + after
+        return True
+
+    def merge_insert(self, offset, text):
+        """
+        Fold an insert of `text` at `offset` into this splice.  The `offset` is relative to
+        the document with this splice already applied.
+
+        Returns:
+            bool: False if the insert doesn't touch this splice and can't be merged.
+        """
+        position = offset - self.offset
+        if position < 0 or position > len(self.text):
+            return False
+
+        self.text = self.text[:position] + text + self.text[position:]
+        return True
+
+
+class EditQueue(object):
+    """
+    The edits to one document held back, as :class:`Splice` instances each relative to the
+    document with the ones before it applied.
+
+    Args:
+        text (callable): Returns the text of the document before the edits held.
+
+    Kwargs:
+        limit (int): The most edits held, more are compacted.
+        metrics (Metrics): Records the high-water mark of the edits held and counts the
+                           compactions.
+        name (string): The prefix of the metrics, ``name.held`` and ``name.compactions``.
+
+    """
+    def __init__(self, text, limit=MAX_HELD, metrics=None, name='held'):
+        self.text = text
+        self.limit = limit
+        self.metrics = metrics
+        self.name = name
+        self.splices = []
+
+    def __len__(self):
+        return len(self.splices)
+
+    def insert(self, content, offset):
+        """
+        Hold an insert of `content` at `offset`.
+        """
+        if not self.splices or not self.splices[-1].merge_insert(offset, content):
+            self.append(Splice(offset, 0, content))
+
+    def delete(self, offset, length):
+        """
+        Hold a delete of `length` characters at `offset`.
+        """
+        if not self.splices or not self.splices[-1].merge_delete(offset, length):
+            self.append(Splice(offset, length, u''))
+
+    def append(self, splice):
+        """
+        Hold `splice` after the others, compacting them when there are too many.
+        """
+        self.splices.append(splice)
+        if len(self.splices) > self.limit:
+            self.compact()
+        if self.metrics is not None:
+            self.metrics.peak(self.name + '.held', len(self.splices))
+
+    def compact(self):
+        """
+        Replace the edits held by the few turning the text before them into the text after
+        them, or by the one replacement of :func:`diff.difference` when they are still
+        more than half the limit.
+        """
+        before = after = self.text()
+        for splice in self.splices:
+            after = (after[:splice.offset] + splice.text +
+                     after[splice.offset + splice.length:])
+
+        edits = splices(before, after)
+        if len(edits) > self.limit // 2:
+            edits = [difference(before, after)]
+        self.splices = [Splice(offset, length, text) for offset, length, text in edits
+                        if length or text]
+        if self.metrics is not None:
+            self.metrics.count(self.name + '.compactions')
+
+    def transform(self, edits):
+        """
+        Transform the concurrent `edits`, made on the document before the edits held, to
+        apply after them, and the edits held to apply after the `edits`.  Text both insert
+        at the same position ends up with that of the `edits` first.  The :attr:`text` must
+        already be that of the document with the `edits` made.
+
+        Args:
+            edits (list): Triples of the offset, the number of characters to remove there
+                          and the text to insert in their place, each relative to the
+                          document with the ones before it made.
+
+        Returns:
+            list: The `edits` transformed, in the same form.
+        """
+        held = [operation for splice in self.splices
+                for operation in _operations(splice.offset, splice.length, splice.text)]
+        transformed = []
+        for offset, length, text in edits:
+            for operation in _operations(offset, length, text):
+                for index, against in enumerate(held):
+                    held[index] = transform(against, operation, False)
+                    operation = transform(operation, against, True)
+                transformed.extend(_splices(operation))
+
+        self.splices = []
+        for offset, length, text in [edit for held_operation in held
+                                     for edit in _splices(held_operation)]:
+            last = self.splices[-1] if self.splices else None
+            if last is None or not (last.merge_delete(offset, length) if length else
+                                    last.merge_insert(offset, text)):
+                self.splices.append(Splice(offset, length, text))
+        if len(self.splices) > self.limit:
+            self.compact()
+        return transformed
+
+    def caret(self, offset, selection):
+        """
+        Where a caret at `offset` of the document before the edits held, with `selection`
+        characters selected, is once they are made.
+
+        Returns:
+            tuple: The offset and the selection.
+        """
+        return _caret(offset, selection, [(splice.offset, splice.length, splice.text)
+                                          for splice in self.splices])
+
+
+def _caret(offset, selection, edits):
+    # Where a caret ends up once the `edits` are made.
+    move = Move(offset, selection)
+    for offset, length, text in edits:
+        for operation in _operations(offset, length, text):
+            move = transform(move, operation, False)
+    return move.position, move.length
+
+
+def _operations(offset, length, text):
+    # The operations of a splice, the delete first.
+    operations = []
+    if length:
+        operations.append(Delete(offset, length))
+    if text:
+        operations.append(Insert(offset, text))
+    return operations
+
+
+def _splices(operation):
+    # The splices of a transformed operation, none for a no-op.
+    if operation.__class__ is Split:
+        return _splices(operation.first) + _splices(operation.second)
+    if operation.__class__ is Insert:
+        return [(operation.position, 0, operation.text)]
+    if operation.__class__ is Delete:
+        return [(operation.position, operation.length, u'')]
+    return []
+
+
+class OperationCoalescer(object):
+    """
+    Holds the edits for each buffer for up to `window` seconds, merging any edit that is
+    contiguous with the pending one.  Once the window expires, or a non contiguous edit
+    arrives, the pending edit is handed to the `insert`, `delete` or `replace` callback.
+
+    The buffers given to :meth:`pause` aren't sent anything until given to :meth:`resume`,
+    or flushed explicitly, their edits are held in an :class:`EditQueue` in :attr:`held`.
+    Remote edits to them are passed through :meth:`transform` instead of flushing first.
+
+    Args:
+        insert (callable): Called as ``insert(content, offset, buffer_name)``.
+        delete (callable): Called as ``delete(offset, length, buffer_name)``.
+        replace (callable): Called as ``replace(offset, length, content, buffer_name)``.
+
+    Kwargs:
+        window (float): Seconds to wait for more edits before sending.  0 sends at the end
+                        of the current reactor iteration.
+        clock (IReactorTime): Used to schedule the flushes.
+        move (callable): Called as ``move(offset, selection, buffer_name)``.
+        move_window (float): Seconds the caret has to rest before a move is sent on its
+                             own.
+        text (callable): Called as ``text(buffer_name)``, returns the text the edits not
+                         yet sent apply to.  Needed to compact the edits held.
+        metrics (Metrics): Passed on to the :class:`EditQueue` of each buffer paused.
+
+    """
+    def __init__(self, insert, delete, replace, window=0.05, clock=reactor, move=None,
+                 move_window=0.25, text=None, metrics=None):
+        self._insert = insert
+        self._delete = delete
+        self._replace = replace
+        self._move = move
+        self._text = text
+        self.window = window
+        self.move_window = move_window
+        self.clock = clock
+        self.metrics = metrics
+        self.pending = {}
+        self.moves = {}
+        self.held = {}
+        self.paused = set()
+
+    def insert(self, content, offset, buffer_name):
+        """
+        Queue an insert of `content` at `offset` into `buffer_name`.
+        """
+        if not content:
+            return
+
+        self._drop_move(buffer_name)
+        if buffer_name in self.paused:
+            self._hold(buffer_name).insert(content, offset)
+            return
+        pending = self.pending.get(buffer_name)
+        if pending is None or not pending[0].merge_insert(offset, content):
+            self._queue(Splice(offset, 0, content), buffer_name)
+
+    def delete(self, offset, length, buffer_name):
+        """
+        Queue a delete of `length` characters at `offset` from `buffer_name`.
+        """
+        if not length:
+            return
+
+        self._drop_move(buffer_name)
+        if buffer_name in self.paused:
+            self._hold(buffer_name).delete(offset, length)
+            return
+        pending = self.pending.get(buffer_name)
+        if pending is None or not pending[0].merge_delete(offset, length):
+            self._queue(Splice(offset, length, ''), buffer_name)
+
+    def move(self, offset, selection, buffer_name):
+        """
+        Queue moving the caret in `buffer_name` to `offset`, with `selection` characters
+        selected from there.  The `offset` is relative to the document with the pending
+        edit applied.
+        """
+        self._drop_move(buffer_name)
+        call = self.clock.callLater(self.move_window, self._expire, buffer_name)
+        self.moves[buffer_name] = (offset, selection, call)
+
+    def pause(self, buffer_names):
+        """
+        Hold the edits to `buffer_names` until :meth:`resume`, the other side is behind.
+        """
+        self.paused.update(buffer_names)
+
+    def resume(self, buffer_names):
+        """
+        Send what was held for `buffer_names` and go back to sending as usual.
+        """
+        for name in buffer_names:
+            if name in self.paused:
+                self.paused.discard(name)
+                self.flush(name)
+
+    def flush(self, buffer_name=None, held=True):
+        """
+        Send the edits held or pending for `buffer_name` right away, and then the pending
+        move, or for all buffers if no `buffer_name` is given.  Without `held` the paused
+        buffers are left alone.
+        """
+        if buffer_name is None:
+            names = set(self.pending) | set(self.moves) | set(self.held)
+        else:
+            names = [buffer_name]
+        if not held:
+            names = [name for name in names if name not in self.paused]
+        for name in names:
+            queue = self.held.pop(name, None)
+            if queue is not None:
+                if name in self.paused and len(queue) > 1:
+                    # Still behind, so only as few requests as it takes.
+                    queue.compact()
+                for splice in queue.splices:
+                    self._send(splice, name)
+
+            pending = self.pending.pop(name, None)
+            if pending is not None:
+                splice, call = pending
+                if call.active():
+                    call.cancel()
+                self._send(splice, name)
+
+            move = self.moves.pop(name, None)
+            if move is not None:
+                offset, selection, call = move
+                if call.active():
+                    call.cancel()
+                self._move(offset, selection, name)
+
+    def transform(self, buffer_name, edits):
+        """
+        Transform the remote `edits` to the paused `buffer_name`, made on the text the edits
+        not yet sent apply to, to apply after them, and those to apply after the `edits`.
+        The caret move not yet sent is moved past them too.  The `text` callback must
+        already return the text with the `edits` made.
+
+        Args:
+            edits (list): Triples of the offset, the number of characters to remove there
+                          and the text to insert in their place, each relative to the text
+                          with the ones before it made.
+
+        Returns:
+            list: The `edits` transformed, as they are if `buffer_name` isn't paused.
+        """
+        if buffer_name not in self.paused:
+            return edits
+        if buffer_name in self.held or buffer_name in self.pending:
+            edits = self._hold(buffer_name).transform(edits)
+        move = self.moves.get(buffer_name)
+        if move is not None:
+            self.moves[buffer_name] = _caret(move[0], move[1], edits) + (move[2],)
+        return edits
+
+    def _expire(self, buffer_name):
+        if buffer_name not in self.paused:
+            self.flush(buffer_name)
+
+    def _hold(self, buffer_name):
+        held = self.held.get(buffer_name)
+        if held is None:
+            held = self.held[buffer_name] = EditQueue(lambda: self._text(buffer_name),
+                                                      metrics=self.metrics,
+                                                      name='coalescer')
+            # The pending edit came first.
+            pending = self.pending.pop(buffer_name, None)
+            if pending is not None:
+                if pending[1].active():
+                    pending[1].cancel()
+                held.append(pending[0])
+        return held
+
+    def _drop_move(self, buffer_name):
+        move = self.moves.pop(buffer_name, None)
+        if move is not None and move[2].active():
+            move[2].cancel()
+
+    def _queue(self, splice, buffer_name):
+        self.flush(buffer_name)
+        call = self.clock.callLater(self.window, self._expire, buffer_name)
+        self.pending[buffer_name] = (splice, call)
+
+    def _send(self, splice, buffer_name):
+        if splice.length and splice.text:
+            self._replace(splice.offset, splice.length, splice.text, buffer_name)
+        elif splice.length:
+            self._delete(splice.offset, splice.length, buffer_name)
+        elif splice.text:
+            self._insert(splice.text, splice.offset, buffer_name)
@@ -0,0 +1,139 @@
+"""
+Finds the few edits turning one text into another, for edits Vim reports as many.
+
+Vim reports a paste or a ``:%s`` as a remove and an insert for every line it touches.
+Rather than sending each of those on, the text before and after them is compared and only
+the regions that really changed are sent.  The texts are compared line by line with the
+diff of Myers, "An O(ND) Difference Algorithm and Its Variations", and each changed region
+is narrowed down to the characters that differ.
+
+"""
+
+# The most lines added and removed the diff looks for before giving up and replacing
+# everything between the common prefix and suffix, the cost grows with its square.
+MAX_COST = 256
+
+# Edits with fewer characters than this between them are merged into one, resending what
+# is between them costs less than the XML of another request.
+MERGE_GAP = 128
+
+
+def difference(old, new):
+    """
+    The one replacement turning the text `old` into `new`, everything between their common
+    prefix and suffix.
+
+    Returns:
+        tuple: The offset, the number of characters of `old` to remove there and the text to
+               insert in their place.
+    """
+    limit = min(len(old), len(new))
+    start = _common_length(old, new, limit, lambda text, low, high: text[low:high])
+    end = _common_length(old, new, limit - start,
+                         lambda text, low, high: text[len(text) - high:len(text) - low])
+    return start, len(old) - start - end, new[start:len(new) - end]
+
+
+def _common_length(old, new, limit, piece):
+    # Binary search comparing slices, only the part not yet known to be equal each time.
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if piece(old, low, middle) == piece(new, low, middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def matching_lines(old, new, max_cost=MAX_COST):
+    """
+    The longest common subsequence of the lists of lines `old` and `new`.
+
+    Returns:
+        list: Triples of where a run of equal lines starts in `old`, where in `new` and how
+              many lines it has, in order.  None if more than `max_cost` lines have to be
+              added and removed.
+    """
+    n, m = len(old), len(new)
+    furthest = {1: 0}
+    trace = []
+    for cost in range(min(n + m, max_cost) + 1):
+        trace.append(dict(furthest))
+        for k in range(-cost, cost + 1, 2):
+            if k == -cost or (k != cost and furthest[k - 1] < furthest[k + 1]):
+                x = furthest[k + 1]
+            else:
+                x = furthest[k - 1] + 1
+            y = x - k
+            while x < n and y < m and old[x] == new[y]:
+                x += 1
+                y += 1
+            furthest[k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    return None
+
+
+def _backtrack(trace, x, y):
+    matches = []
+    for cost in range(len(trace) - 1, 0, -1):
+        furthest = trace[cost]
+        k = x - y
+        if k == -cost or (k != cost and furthest[k - 1] < furthest[k + 1]):
+            previous = k + 1
+        else:
+            previous = k - 1
+        previous_x = furthest[previous]
+        start_x = previous_x + (previous == k - 1)
+        if x > start_x:
+            matches.append((start_x, start_x - k, x - start_x))
+        x, y = previous_x, previous_x - previous
+    if x:
+        matches.append((0, 0, x))
+    matches.reverse()
+    return matches
+
+
+def splices(old, new, max_cost=MAX_COST, merge_gap=MERGE_GAP):
+    """
+    The edits turning the text `old` into `new`, one for every region of lines that
+    changed, narrowed down to the characters that differ and merged when fewer than
+    `merge_gap` characters apart.  When the lines differ by more than `max_cost` it is the
+    one edit of :func:`difference`.
+
+    Returns:
+        list: Triples of the offset, the number of characters to remove there and the text
+              to insert in their place, in order.  The offsets are in the text with the
+              edits before them already made.
+    """
+    start, length, text = difference(old, new)
+    if not length and not text:
+        return []
+
+    old_lines = old[start:start + length].splitlines(True)
+    new_lines = text.splitlines(True)
+    matches = matching_lines(old_lines, new_lines, max_cost)
+    if matches is None:
+        return [(start, length, text)]
+
+    edits = []
+    offset = start
+    old_index = new_index = 0
+    for old_match, new_match, size in matches + [(len(old_lines), len(new_lines), 0)]:
+        removed = u''.join(old_lines[old_index:old_match])
+        inserted = u''.join(new_lines[new_index:new_match])
+        if removed or inserted:
+            skip, length, text = difference(removed, inserted)
+            position = offset + skip
+            if edits and position - edits[-1][0] - len(edits[-1][2]) < merge_gap:
+                last, last_length, last_text = edits.pop()
+                between = new[last + len(last_text):position]
+                length += last_length + len(between)
+                text = last_text + between + text
+                position = last
+            edits.append((position, length, text))
+            offset += len(inserted)
+        offset += sum([len(line) for line in new_lines[new_match:new_match + size]])
+        old_index, new_index = old_match + size, new_match + size
+    return edits
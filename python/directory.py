@@ -0,0 +1,140 @@
+"""
+The directory tree of an infinoted server, as far as it was explored.
+
+infinoted only tells about the children of a subdirectory once it is explored, so the tree
+is filled in as subdirectories are asked for and kept up to date by the ``add-node`` and
+``remove-node`` messages which follow.  Nodes are found by id in constant time and by path
+in time proportional to the depth of the path.
+
+"""
+
+SUBDIRECTORY = u'InfSubdirectory'
+TEXT = u'InfText'
+
+
+class DirectoryNode(object):
+    """
+    A document or subdirectory of the directory.
+
+    Args:
+        node_id (unicode): The id infinoted gave the node.
+        name (unicode): The name of the node in its parent.
+        node_type (unicode): :data:`SUBDIRECTORY`, :data:`TEXT` or another type of
+                             document.
+        parent (DirectoryNode): None for the root.
+
+    Attributes:
+        children (dict): The nodes in a subdirectory by name.
+        explored (bool): Whether :attr:`children` holds all of them.
+
+    """
+    __slots__ = ('node_id', 'name', 'node_type', 'parent', 'children', 'explored')
+
+    def __init__(self, node_id, name, node_type, parent=None):
+        self.node_id = node_id
+        self.name = name
+        self.node_type = node_type
+        self.parent = parent
+        self.children = {}
+        self.explored = False
+
+    def __repr__(self):
+        return 'DirectoryNode(%r, %r, %r)' % (self.node_id, self.name, self.node_type)
+
+    def is_directory(self):
+        return self.node_type == SUBDIRECTORY
+
+    def path(self):
+        """
+        The path of the node from the root, like ``notes/todo.txt``, the root's is empty.
+        """
+        names = []
+        node = self
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return u'/'.join(reversed(names))
+
+
+class Directory(object):
+    """
+    The explored part of the directory, starting with only the unexplored root, node
+    ``0``.
+    """
+    def __init__(self):
+        self.root = DirectoryNode(u'0', u'', SUBDIRECTORY)
+        self.nodes = {self.root.node_id: self.root}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, node_id):
+        """
+        The node with `node_id`, None if it isn't known.
+        """
+        return self.nodes.get(node_id)
+
+    def add(self, node_id, parent_id, name, node_type):
+        """
+        Add the node `node_id` called `name` to the subdirectory `parent_id`.  A node
+        already in the subdirectory under `name` is replaced.
+
+        Returns:
+            DirectoryNode: The new node, None when the parent isn't known.
+        """
+        parent = self.nodes.get(parent_id)
+        if parent is None:
+            return None
+
+        self.remove(node_id)
+        existing = parent.children.get(name)
+        if existing is not None:
+            self.remove(existing.node_id)
+
+        node = DirectoryNode(node_id, name, node_type, parent)
+        parent.children[name] = node
+        self.nodes[node_id] = node
+        return node
+
+    def remove(self, node_id):
+        """
+        Forget the node `node_id` and everything below it, unknown ids are ignored.
+        """
+        node = self.nodes.get(node_id)
+        if node is None or node is self.root:
+            return
+
+        if node.parent.children.get(node.name) is node:
+            del node.parent.children[node.name]
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            self.nodes.pop(node.node_id, None)
+            pending.extend(node.children.values())
+
+    def find(self, path):
+        """
+        The node at `path`, like ``notes/todo.txt``.
+
+        Returns:
+            DirectoryNode: The node, None when it isn't known, which may be because a
+                           subdirectory on the way isn't explored yet.
+        """
+        node = self.root
+        for name in path.split(u'/'):
+            if name:
+                node = node.children.get(name)
+                if node is None:
+                    return None
+        return node
+
+    def listing(self, node):
+        """
+        The names of the children of the subdirectory `node`, subdirectories first and
+        ending with a ``/``.
+        """
+        directories = sorted([name + u'/' for name, child in node.children.items()
+                              if child.is_directory()])
+        documents = sorted([name for name, child in node.children.items()
+                            if not child.is_directory()])
+        return directories + documents
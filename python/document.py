@@ -0,0 +1,321 @@
+"""
+A shadow copy of a shared document.
+"""
+
+from file_buffer import FileBuffer
+
+
+def utf8_length(text):
+    """
+    The number of bytes `text` takes up in UTF-8.
+    """
+    return len(text.encode('utf-8'))
+
+
+class FenwickTree(object):
+    """
+    A binary indexed tree over a list of counts, giving prefix sums and updates in
+    O(log n).  The counts themselves are kept too, so the tree can be rebuilt without
+    counting everything again.
+
+    Args:
+        values (list): The initial counts.
+
+    """
+    __slots__ = ('counts', 'tree')
+
+    def __init__(self, values=()):
+        self.counts = list(values)
+        self._build()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, index, delta):
+        """
+        Add `delta` to the count at `index`.
+        """
+        self.counts[index] += delta
+        index += 1
+        tree = self.tree
+        size = len(tree)
+        while index < size:
+            tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index):
+        """
+        The sum of the counts before `index`.
+        """
+        total = 0
+        tree = self.tree
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+
+    def find(self, value):
+        """
+        Find where the running sum reaches `value`.
+
+        Returns:
+            tuple: ``(index, remainder)`` of the first index whose running sum, including
+                   itself, is at least `value` and how far into it `value` is.  A `value` of
+                   0 gives ``(0, 0)``.
+        """
+        tree = self.tree
+        size = len(tree)
+        position = 0
+        step = 1
+        while step * 2 < size:
+            step *= 2
+
+        while step:
+            following = position + step
+            if following < size and tree[following] < value:
+                position = following
+                value -= tree[following]
+            step //= 2
+        return position, value
+
+    def splice(self, start, end, values):
+        """
+        Replace the counts from `start` to `end` with `values`.  This is O(n) unless it is
+        at the end, where the tree is only cut back and extended, like while appending.
+        """
+        if end < len(self.counts):
+            self.counts[start:end] = values
+            self._build()
+            return
+
+        del self.counts[start:]
+        del self.tree[start + 1:]
+        tree = self.tree
+        for value in values:
+            self.counts.append(value)
+            index = len(tree)
+            covered = index - (index & -index)
+            tree.append(value + self.prefix(index - 1) - self.prefix(covered))
+
+    def _build(self):
+        tree = [0] + self.counts
+        size = len(tree)
+        for index in range(1, size):
+            parent = index + (index & -index)
+            if parent < size:
+                tree[parent] += tree[index]
+        self.tree = tree
+
+
+class Document(FileBuffer):
+    """
+    The text of a shared document kept as a list of chunks, a simple rope.  Fenwick trees
+    over the characters and newlines in each chunk make finding an offset or a line
+    O(log n), and an edit only touches the chunks it covers, so multi-megabyte documents
+    are as cheap to edit as small ones.
+
+    Offsets are in characters, as infinoted uses.  A third tree over the UTF-8 length of
+    each chunk translates them to and from the byte offsets Vim uses, see
+    :meth:`byte_offset` and :meth:`char_offset`.
+
+    Kwargs:
+        content (unicode): The initial text.
+
+    """
+    # Chunks are kept between CHUNK_SIZE / 2 and CHUNK_SIZE * 2 characters, other than the
+    # first and last ones.
+    CHUNK_SIZE = 1024
+
+    def __init__(self, content=u''):
+        self.sync(content)
+
+    def __len__(self):
+        return self.chars.prefix(len(self.chunks))
+
+    def __unicode__(self):
+        return u''.join(self.chunks)
+
+    def lines(self):
+        """
+        The number of lines, a document without newlines has one.
+        """
+        return self.newlines.prefix(len(self.chunks)) + 1
+
+    def insert(self, content, offset, user=None):
+        """
+        Insert `content` at the character `offset`.
+
+        Raises:
+            ValueError: `offset` is past the end of the document.
+        """
+        self.validate(offset)
+        if not content:
+            return
+
+        index, position = self.chars.find(offset)
+        chunk = self.chunks[index]
+        chunk = chunk[:position] + content + chunk[position:]
+        if len(chunk) > self.CHUNK_SIZE * 2:
+            self._replace(index, index + 1, chunk)
+        else:
+            self._update(index, chunk, u'', content)
+
+    def delete(self, offset, length, user=None):
+        """
+        Delete `length` characters at the character `offset`.
+
+        Raises:
+            ValueError: The range runs past the end of the document.
+        """
+        self.validate(offset, length)
+        if not length:
+            return
+
+        first, position = self.chars.find(offset)
+        last, end = self.chars.find(offset + length)
+        if first == last:
+            chunk = self.chunks[first]
+            removed = chunk[position:end]
+            chunk = chunk[:position] + chunk[end:]
+            if len(chunk) < self.CHUNK_SIZE // 2 and first > 0:
+                self._replace(first, first + 1, chunk)
+            else:
+                self._update(first, chunk, removed, u'')
+        else:
+            self._replace(first, last + 1,
+                          self.chunks[first][:position] + self.chunks[last][end:])
+
+    def sync(self, content):
+        """
+        Replace the whole document with `content`.
+        """
+        self.chunks = []
+        self.chars = FenwickTree()
+        self.newlines = FenwickTree()
+        self.bytes = FenwickTree()
+        self._replace(0, 0, content)
+
+    def validate(self, offset, length=0):
+        """
+        Check that `length` characters at `offset` are within the document.
+
+        Raises:
+            ValueError: They aren't.
+        """
+        if offset < 0 or length < 0 or offset + length > len(self):
+            raise ValueError('Range %d+%d is outside of the document of %d characters' %
+                             (offset, length, len(self)))
+
+    def text(self, offset=0, length=None):
+        """
+        The text of `length` characters at `offset`, to the end without a `length`.
+        """
+        if length is None:
+            length = len(self) - offset
+        self.validate(offset, length)
+        if not length:
+            return u''
+
+        first, position = self.chars.find(offset + 1)
+        last, end = self.chars.find(offset + length)
+        if first == last:
+            return self.chunks[first][position - 1:end]
+
+        pieces = [self.chunks[first][position - 1:]]
+        pieces.extend(self.chunks[first + 1:last])
+        pieces.append(self.chunks[last][:end])
+        return u''.join(pieces)
+
+    def ascii(self):
+        """
+        Whether the document is all ASCII, where bytes and characters are the same.
+        """
+        count = len(self.chunks)
+        return self.bytes.prefix(count) == self.chars.prefix(count)
+
+    def byte_offset(self, offset):
+        """
+        The UTF-8 byte offset of the character `offset`.
+        """
+        self.validate(offset)
+        if self.ascii():
+            return offset
+
+        index, position = self.chars.find(offset)
+        return self.bytes.prefix(index) + utf8_length(self.chunks[index][:position])
+
+    def char_offset(self, offset):
+        """
+        The character offset of the UTF-8 byte `offset`.
+
+        Raises:
+            ValueError: `offset` is past the end of the document.
+        """
+        size = self.bytes.prefix(len(self.chunks))
+        if offset < 0 or offset > size:
+            raise ValueError('Byte %d is outside of the document' % offset)
+        if size == len(self):
+            return offset
+
+        index, position = self.bytes.find(offset)
+        chunk = self.chunks[index].encode('utf-8')[:position]
+        return self.chars.prefix(index) + len(chunk.decode('utf-8', 'ignore'))
+
+    def line_offset(self, line):
+        """
+        The character offset of the start of the 0 based `line`.
+        """
+        if line <= 0:
+            return 0
+        if line >= self.lines():
+            raise ValueError('Line %d is past the end of the document' % line)
+
+        index, count = self.newlines.find(line)
+        chunk = self.chunks[index]
+        position = -1
+        for _ in range(count):
+            position = chunk.index(u'\n', position + 1)
+        return self.chars.prefix(index) + position + 1
+
+    def line_column(self, offset):
+        """
+        The 0 based line and column of the character `offset`.
+
+        Returns:
+            tuple: ``(line, column)``.
+        """
+        self.validate(offset)
+        index, position = self.chars.find(offset)
+        line = self.newlines.prefix(index) + self.chunks[index].count(u'\n', 0, position)
+        return line, offset - self.line_offset(line)
+
+    def _update(self, index, chunk, removed, inserted):
+        """
+        Change the chunk at `index` in place to `chunk`, which had the text `removed` taken
+        out of it and `inserted` put in.  Only those are counted for the trees.
+        """
+        self.chunks[index] = chunk
+        self.chars.add(index, len(inserted) - len(removed))
+        self.newlines.add(index, inserted.count(u'\n') - removed.count(u'\n'))
+        self.bytes.add(index, utf8_length(inserted) - utf8_length(removed))
+
+    def _replace(self, start, end, content):
+        """
+        Replace the chunks from `start` to `end` with `content` cut into new chunks.  This
+        rebuilds the trees so it is only done when the number of chunks changes, only the
+        new chunks are counted though.
+        """
+        size = self.CHUNK_SIZE
+        if start > 0 and len(content) < size:
+            # Too small to stand on its own, merge with the previous chunk.
+            start -= 1
+            content = self.chunks[start] + content
+
+        pieces = [content[begin:begin + size] for begin in range(0, len(content), size)]
+        if not pieces and len(self.chunks) == end - start:
+            pieces = [u'']
+
+        self.chunks[start:end] = pieces
+        self.chars.splice(start, end, [len(chunk) for chunk in pieces])
+        self.newlines.splice(start, end, [chunk.count(u'\n') for chunk in pieces])
+        self.bytes.splice(start, end, [utf8_length(chunk) for chunk in pieces])
@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A stand-in for infinoted to load test the bridge on one machine.
+
+Only what :class:`InfinotedProtocol` uses is implemented: anonymous SASL and resource
+binding, exploring the root of the directory, subscribing to and synchronizing text
+sessions, joining and rejoining them and relaying requests.  Requests are transformed with
+the same :class:`Algorithm` the client uses so the server keeps the text of each session.
+
+Virtual users joined to every session type at a given rate.  Run it from the ``python``
+directory and start vobby with ``infinoted_tls = False``, as no TLS is offered::
+
+    ./fake_infinoted.py --documents 4 --users 8 --rate 20
+
+With ``--batch`` the messages of a synchronization and the requests relayed in the same
+reactor tick go out in a single ``<group>``, which infinoted itself never does.
+
+"""
+import argparse
+import random
+import sys
+
+from twisted.internet import reactor, task
+from twisted.python import log
+from twisted.words.protocols.jabber import xmlstream
+from twisted.words.protocols.jabber.client import NS_XMPP_BIND
+from twisted.words.protocols.jabber.sasl import NS_XMPP_SASL
+from twisted.words.xish import domish
+from xml.sax.saxutils import escape, quoteattr
+
+from adopted import Algorithm, Delete, Insert, Move, NOOP, Split, vector_to_string
+from document import Document
+from infinoted import ENTITIES, operation_from_xml
+from stanza import StanzaXmlStream
+
+GROUP = u'<group publisher="server" name=%s>%s</group>'
+SEGMENT = 16 * 1024
+
+
+def operation_to_xml(operation):
+    """
+    The XML of a request for `operation`, as it was made rather than transformed.
+    """
+    if operation.__class__ is Insert:
+        return u'<insert-caret pos="%d">%s</insert-caret>' % (
+            operation.position, escape(operation.text, ENTITIES))
+    if operation.__class__ is Delete:
+        return u'<delete-caret pos="%d" len="%d"/>' % (operation.position, operation.length)
+    if operation.__class__ is Move:
+        return u'<move caret="%d" selection="%d"/>' % (operation.position, operation.length)
+    return u'<no-op/>'
+
+
+class AnonymousAuthenticator(xmlstream.ListenAuthenticator):
+    """
+    Lets anyone in with SASL ``ANONYMOUS`` and binds them to a made up resource.  Once the
+    resource is bound the stream is authenticated, ``STREAM_AUTHD_EVENT`` is dispatched.
+    """
+    namespace = 'jabber:client'
+
+    def __init__(self):
+        xmlstream.ListenAuthenticator.__init__(self)
+        self.authenticated = False
+
+    def associateWithStream(self, xs):
+        xmlstream.ListenAuthenticator.associateWithStream(self, xs)
+        xs.addObserver('/auth', self.auth)
+        xs.addObserver('/iq[@type="set"]/bind', self.bind)
+
+    def streamStarted(self, rootElement):
+        xmlstream.ListenAuthenticator.streamStarted(self, rootElement)
+        self.xmlstream.sendHeader()
+
+        features = domish.Element((xmlstream.NS_STREAMS, 'features'))
+        if self.authenticated:
+            features.addElement((NS_XMPP_BIND, 'bind'))
+        else:
+            mechanisms = features.addElement((NS_XMPP_SASL, 'mechanisms'))
+            mechanisms.addElement('mechanism', content=u'ANONYMOUS')
+        self.xmlstream.send(features)
+
+    def auth(self, element):
+        # The client starts a new stream after the success.
+        self.authenticated = True
+        self.xmlstream.send(domish.Element((NS_XMPP_SASL, 'success')))
+        self.xmlstream.reset()
+
+    def bind(self, iq):
+        reply = xmlstream.toResponse(iq, 'result')
+        bind = reply.addElement((NS_XMPP_BIND, 'bind'))
+        bind.addElement('jid', content=u'anonymous@infinoted/%s' % self.xmlstream.sid)
+        self.xmlstream.send(reply)
+        self.xmlstream.dispatch(self.xmlstream, xmlstream.STREAM_AUTHD_EVENT)
+
+
+class FakeSession(object):
+    """
+    One text session, the document of node `node_id` called `name`.
+
+    Attributes:
+        users (dict): The name of each user joined by id, virtual users included.
+        unavailable (set): The ids of the users whose connection was lost, who can rejoin
+                           by their name.
+        members (dict): The user id of each subscribed :class:`FakeConnection`, None until
+                        it joined.
+
+    """
+    def __init__(self, node_id, name, text=u''):
+        self.node_id = node_id
+        self.name = name
+        self.group = u'InfSession_%d' % node_id
+        self.document = Document(text)
+        self.algorithm = Algorithm()
+        self.users = {}
+        self.unavailable = set()
+        self.members = {}
+
+    def join(self, user, name):
+        """
+        Join `user` called `name` at the current state.
+        """
+        self.users[user] = name
+        self.algorithm.set_user_vector(user, self.algorithm.current)
+
+    def leave(self, user):
+        """
+        Mark `user` unavailable.  Like infinoted its state is kept, it still holds back
+        dropping old requests, so it can rejoin and send what didn't arrive.
+        """
+        self.unavailable.add(user)
+
+    def rejoin(self, name):
+        """
+        Make the unavailable user called `name` available again.
+
+        Returns:
+            int: Its id, None if there is no such user.
+        """
+        for user in self.unavailable:
+            if self.users[user] == name:
+                self.unavailable.remove(user)
+                return user
+        return None
+
+    def execute(self, user, time, operation):
+        """
+        Transform and apply the request of `operation` by `user` made at `time`.
+        """
+        self.apply(self.algorithm.receive(user, time, operation))
+
+    def apply(self, operation):
+        if operation.__class__ is Insert:
+            self.document.insert(operation.text, operation.position)
+        elif operation.__class__ is Delete:
+            self.document.delete(operation.position, operation.length)
+        elif operation.__class__ is Split:
+            self.apply(operation.first)
+            self.apply(operation.second)
+
+    def broadcast(self, data, exclude=None):
+        """
+        Send the stanza `data` to every subscribed connection but `exclude`.
+        """
+        for connection in self.members:
+            if connection is not exclude:
+                connection.send(data)
+
+    def synchronize(self):
+        """
+        The contents of the ``sync-*`` stanzas for a new subscriber: every user with their
+        state, the requests still logged and the text.
+        """
+        algorithm = self.algorithm
+        messages = []
+        for user, name in sorted(self.users.items()):
+            status = u'unavailable' if user in self.unavailable else u'active'
+            messages.append(u'<sync-user id="%d" name=%s time="%s" caret="0" '
+                            u'status="%s"/>' % (
+                                user, quoteattr(name),
+                                vector_to_string(algorithm.user_vectors.get(user, {})),
+                                status))
+        for user, requests in sorted(algorithm.logs.items()):
+            for request in requests.requests:
+                messages.append(u'<sync-request user="%d" time="%s">%s</sync-request>' % (
+                    user, vector_to_string(request.vector),
+                    operation_to_xml(request.operation)))
+
+        text = unicode(self.document)
+        for start in range(0, len(text), SEGMENT):
+            messages.append(u'<sync-segment author="0">%s</sync-segment>' %
+                            escape(text[start:start + SEGMENT], ENTITIES))
+
+        return ([u'<sync-begin num-messages="%d"/>' % len(messages)] + messages +
+                [u'<sync-end/>'])
+
+
+class FakeInfinoted(object):
+    """
+    The directory and sessions shared by all connections, with the counters of what was
+    relayed.
+
+    Args:
+        documents (dict): The initial text of each document by name.
+
+    Kwargs:
+        clock (IReactorTime): Used to schedule the virtual users and the reports.
+        batch (bool): Send several messages in one ``<group>`` where possible.
+
+    """
+    def __init__(self, documents, clock=reactor, batch=False):
+        self.clock = clock
+        self.batch = batch
+        self.sessions = {}
+        self.groups = {}
+        self.connections = set()
+        self.last_user = 0
+        self.requests_in = 0
+        self.requests_out = 0
+        # The requests relayed this tick when batching, with the connections to send each
+        # to, by session.
+        self.outgoing = {}
+
+        for node_id, name in enumerate(sorted(documents), 1):
+            session = FakeSession(node_id, name, documents[name])
+            self.sessions[unicode(node_id)] = session
+            self.groups[session.group] = session
+
+    def factory(self):
+        """
+        A factory for the connections of clients to this server.
+        """
+        factory = xmlstream.XmlStreamServerFactory(AnonymousAuthenticator)
+        factory.protocol = StanzaXmlStream
+        factory.addBootstrap(xmlstream.STREAM_AUTHD_EVENT, self.authenticated)
+        return factory
+
+    def authenticated(self, xs):
+        connection = FakeConnection(self, xs)
+        self.connections.add(connection)
+        connection.welcome()
+
+    def next_user(self):
+        self.last_user += 1
+        return self.last_user
+
+    def relay(self, session, user, time, operation, origin=None):
+        """
+        Execute the request of `user` and send it to the subscribers of `session` other
+        than the connection it came from, `origin`.
+        """
+        session.execute(user, time, operation)
+        self.requests_in += 1
+        self.requests_out += len(session.members) - (origin in session.members)
+        request = u'<request user="%d" time="%s">%s</request>' % (
+            user, time, operation_to_xml(operation))
+        if not self.batch:
+            session.broadcast(GROUP % (quoteattr(session.group), request), origin)
+            return
+
+        if not self.outgoing:
+            self.clock.callLater(0, self.flush)
+        members = [connection for connection in session.members if connection is not origin]
+        self.outgoing.setdefault(session, []).append((request, members))
+
+    def flush(self):
+        """
+        Send the requests relayed since the last flush, all those of a session in one
+        ``<group>`` to each of its subscribers.
+        """
+        outgoing, self.outgoing = self.outgoing, {}
+        for session, requests in outgoing.items():
+            group = quoteattr(session.group)
+            for connection in session.members:
+                content = u''.join([request for request, members in requests
+                                    if connection in members])
+                if content:
+                    connection.send(GROUP % (group, content))
+
+    def report(self, interval):
+        """
+        Log what was relayed every `interval` seconds.
+        """
+        counts = [0, 0]
+
+        def report():
+            log.msg('%d connections, %.1f requests/sec in, %.1f requests/sec out' % (
+                len(self.connections), (self.requests_in - counts[0]) / interval,
+                (self.requests_out - counts[1]) / interval))
+            counts[:] = [self.requests_in, self.requests_out]
+
+        call = task.LoopingCall(report)
+        call.clock = self.clock
+        call.start(interval, now=False)
+        return call
+
+
+class FakeConnection(object):
+    """
+    The directory and session stanzas of one client on the authenticated stream `xs`.
+    """
+    def __init__(self, server, xs):
+        self.server = server
+        self.xmlstream = xs
+        self.pending = {}
+        self.handlers = {
+            'explore-node': self.explore_node,
+            'subscribe-session': self.subscribe_session,
+            'subscribe-ack': self.subscribe_ack,
+            'user-join': self.user_join,
+            'request': self.request,
+        }
+        xs.addObserver('/group', self.group)
+        xs.addObserver(xmlstream.STREAM_END_EVENT, self.lost)
+
+    def send(self, data):
+        # Batched requests go first, whatever is sent now may already depend on them.
+        if self.server.outgoing:
+            self.server.flush()
+        self.xmlstream.send(data)
+
+    def welcome(self):
+        self.send(GROUP % (u'"InfDirectory"',
+                           u'<welcome protocol-version="1.0" sequence-id="1"/>'))
+
+    def group(self, element):
+        for node in element.elements():
+            handler = self.handlers.get(node.name)
+            if handler is not None:
+                handler(element['name'], node)
+
+    def explore_node(self, name, node):
+        # All documents are in the root, no other node has children.  Like infinoted the
+        # replies are prefixed with the sequence id of the connection.
+        seq = u'1/' + node.getAttribute('seq', '0')
+        sessions = []
+        if node.getAttribute('id') == u'0':
+            sessions = sorted(self.server.sessions.values(),
+                              key=lambda session: session.node_id)
+        messages = [u'<explore-begin total="%d" seq="%s"/>' % (len(sessions), seq)]
+        for session in sessions:
+            messages.append(u'<add-node id="%d" parent="0" name=%s type="InfText" '
+                            u'seq="%s"/>' % (session.node_id, quoteattr(session.name), seq))
+        messages.append(u'<explore-end seq="%s"/>' % seq)
+        self.send(u''.join([GROUP % (u'"InfDirectory"', message) for message in messages]))
+
+    def subscribe_session(self, name, node):
+        session = self.server.sessions.get(node['id'])
+        if session is None:
+            log.msg('No node %s to subscribe to' % node['id'])
+            return
+
+        self.pending[node['id']] = session
+        seq = quoteattr(u'1/' + node.getAttribute('seq', '0'))
+        self.send(GROUP % (u'"InfDirectory"',
+                           u'<subscribe-session id="%d" group=%s method="central" '
+                           u'seq=%s/>' % (session.node_id, quoteattr(session.group), seq)))
+
+    def subscribe_ack(self, name, node):
+        session = self.pending.pop(node.getAttribute('id'), None)
+        if session is None:
+            return
+
+        session.members[self] = None
+        group = quoteattr(session.group)
+        messages = session.synchronize()
+        if self.server.batch:
+            messages = [u''.join(messages)]
+        self.send(u''.join([GROUP % (group, message) for message in messages]))
+
+    def user_join(self, name, node):
+        session = self.server.groups.get(name)
+        if session is None or session.members.get(self, True) is not None:
+            return
+
+        message = u'user-rejoin'
+        user = session.rejoin(node.getAttribute('name'))
+        if user is None:
+            message = u'user-join'
+            user = self.server.next_user()
+            session.join(user, node.getAttribute('name', u'user%d' % user))
+        session.members[self] = user
+        joined = u'<%s id="%d" name=%s time="%s" caret="0" status="active"' % (
+            message, user, quoteattr(session.users[user]),
+            vector_to_string(session.algorithm.user_vectors[user]))
+        for connection in session.members:
+            # Only the reply to the join itself carries its seq.
+            seq = u''
+            if connection is self:
+                seq = u' seq=%s' % quoteattr(node.getAttribute('seq', '0'))
+            connection.send(GROUP % (quoteattr(name), joined + seq + u'/>'))
+
+    def request(self, name, node):
+        session = self.server.groups.get(name)
+        user = session and session.members.get(self)
+        if user is None:
+            return
+
+        operation = operation_from_xml(node.firstChildElement()) or NOOP
+        try:
+            self.server.relay(session, user, node.getAttribute('time', ''), operation, self)
+        except (LookupError, ValueError):
+            log.err(None, 'Dropped request of user %d in %s' % (user, name))
+
+    def lost(self, reason):
+        self.server.connections.discard(self)
+        for session in self.server.sessions.values():
+            user = session.members.pop(self, None)
+            if user is not None:
+                session.leave(user)
+
+
+class VirtualUsers(object):
+    """
+    `count` users joined to every session of `server`, together making `rate` edits per
+    second at random places.  Mostly single characters are typed, some are deleted.
+
+    Kwargs:
+        seed: Seeds the random edits.
+        interval (float): How often edits are made, the `rate` is spread over them.
+
+    """
+    def __init__(self, server, count, rate, seed=0, interval=0.01):
+        self.server = server
+        self.rate = rate
+        self.interval = interval
+        self.random = random.Random(seed)
+        self.owed = 0.0
+        self.users = []
+        for session in server.sessions.values():
+            for _ in range(count):
+                user = server.next_user()
+                session.join(user, u'virtual%d' % user)
+                self.users.append((session, user))
+        self.call = task.LoopingCall(self.tick)
+        self.call.clock = server.clock
+
+    def start(self):
+        if self.users and self.rate > 0:
+            self.call.start(self.interval, now=False)
+
+    def stop(self):
+        if self.call.running:
+            self.call.stop()
+
+    def tick(self):
+        self.owed += self.rate * self.interval
+        while self.owed >= 1:
+            self.owed -= 1
+            self.edit(*self.random.choice(self.users))
+
+    def edit(self, session, user):
+        """
+        Make one edit as `user`, who knows about everything `session` executed so far.
+        """
+        length = len(session.document)
+        position = self.random.randint(0, length)
+        if length and self.random.random() < 0.3:
+            operation = Delete(min(position, length - 1), 1)
+        else:
+            text = self.random.choice(u'abcdefghijklmnopqrstuvwxyz \n')
+            operation = Insert(position, text)
+
+        algorithm = session.algorithm
+        time = vector_to_string(algorithm.current, algorithm.user_vectors.get(user))
+        self.server.relay(session, user, time, operation)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--port', type=int, default=6523)
+    parser.add_argument('--interface', default='127.0.0.1')
+    parser.add_argument('--documents', type=int, default=1,
+                        help='number of documents in the directory')
+    parser.add_argument('--lines', type=int, default=100,
+                        help='lines of text each document starts with')
+    parser.add_argument('--users', type=int, default=0,
+                        help='virtual users typing into every document')
+    parser.add_argument('--rate', type=float, default=10,
+                        help='edits per second of all virtual users together')
+    parser.add_argument('--report', type=float, default=5,
+                        help='seconds between logging the request rates')
+    parser.add_argument('--batch', action='store_true',
+                        help='send several messages in one group where possible')
+    args = parser.parse_args()
+
+    log.startLogging(sys.stdout)
+    line = u'The quick brown fox jumps over the lazy d\xf6g\n'
+    server = FakeInfinoted(dict((u'document%d.txt' % number, line * args.lines)
+                                for number in range(1, args.documents + 1)),
+                           batch=args.batch)
+    VirtualUsers(server, args.users, args.rate).start()
+    server.report(args.report)
+    reactor.listenTCP(args.port, server.factory(), interface=args.interface)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
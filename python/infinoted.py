@@ -2,82 +2,490 @@
 This handles the communication to an infinoted server
 """
 
+import getpass
+
+from zope.interface import implementer
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred
-from twisted.names.srvconnect import SRVConnector
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.interfaces import IPushProducer
 from twisted.words.xish import domish
 from twisted.words.protocols.jabber import xmlstream, client
 from twisted.words.protocols.jabber.jid import JID
 from twisted.words.protocols.jabber.sasl import SASLInitiatingInitializer
 from twisted.python import log
+from xml.sax.saxutils import escape, quoteattr
+
+from adopted import (Algorithm, Delete, Insert, Move, NOOP, Split, transform,
+                     vector_from_string, vector_to_string)
+from diff import difference
+from directory import Directory, TEXT
+from document import Document
+from stanza import StanzaXmlStream
+
+# Serializers for the messages sent for every edit.  Everything substituted in must already
+# be escaped, see :class:`RequestPipeline`.
+GROUP = u'<group publisher="you" name=%s>%s</group>'
+INSERT_REQUEST = (u'<request user="%s" time="%s">'
+                  u'<insert-caret pos="%d">%s</insert-caret></request>')
+DELETE_REQUEST = u'<request user="%s" time="%s"><delete-caret pos="%d" len="%d"/></request>'
+MOVE_REQUEST = u'<request user="%s" time="%s"><move caret="%d" selection="%d"/></request>'
+
+# Extra entities for :func:`escape` on text: an XML parser reads a bare carriage return as a
+# newline, so it has to go over the wire as a character reference.
+ENTITIES = {u'\r': u'&#13;'}
+
+# The longest wait between attempts to reconnect to infinoted, in seconds.
+RECONNECT_MAX_DELAY = 30
+
+
+class RequestPipeline(object):
+    """
+    Collects the requests for each session and sends them at the end of the reactor tick,
+    one ``<group>`` per session, all in a single write to the stream.
+
+    Between :meth:`pause` and :meth:`resume` nothing is sent, the requests are only queued.
 
+    Args:
+        send (callable): Called with the serialized stanzas, usually ``XmlStream.send``.
+
+    Kwargs:
+        clock (IReactorTime): Used to schedule the flush.
+        metrics (Metrics): Counts the stanzas and requests sent and records the high-water
+                           mark of the requests queued.
+
+    """
+    def __init__(self, send, clock=reactor, metrics=None):
+        self.send = send
+        self.clock = clock
+        self.metrics = metrics
+        self.groups = []
+        self.pending = {}
+        self.queued = 0
+        self.paused = False
+        self.call = None
+
+    def insert(self, group, user, position, text, time=''):
+        """
+        Queue an insert-caret request of `text` at `position` for the session `group`.
+        """
+        self._queue(group, INSERT_REQUEST % (user, time, position, escape(text, ENTITIES)))
+
+    def delete(self, group, user, position, length, time=''):
+        """
+        Queue a delete-caret request of `length` characters at `position` for the session
+        `group`.
+        """
+        self._queue(group, DELETE_REQUEST % (user, time, position, length))
+
+    def move(self, group, user, position, selection, time=''):
+        """
+        Queue a move request of the caret to `position` with `selection` characters
+        selected for the session `group`.
+        """
+        self._queue(group, MOVE_REQUEST % (user, time, position, selection))
+
+    def pause(self):
+        """
+        Stop sending, the stream has more to write than infinoted reads.
+        """
+        self.paused = True
+
+    def resume(self):
+        """
+        Send everything queued while paused and go back to sending at the end of the tick.
+        """
+        self.paused = False
+        self.flush()
+
+    def flush(self):
+        """
+        Send everything queued so far, unless paused.
+        """
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+        if not self.groups or self.paused:
+            return
+
+        stanzas = [GROUP % (quoteattr(group), u''.join(self.pending[group]))
+                   for group in self.groups]
+        if self.metrics is not None:
+            self.metrics.count('infinoted.stanzas_out', len(stanzas))
+            self.metrics.count('infinoted.requests_out', self.queued)
+        self.groups = []
+        self.pending = {}
+        self.queued = 0
+        self.send(u''.join(stanzas))
+
+    def _queue(self, group, request):
+        requests = self.pending.get(group)
+        if requests is None:
+            requests = self.pending[group] = []
+            self.groups.append(group)
+        requests.append(request)
+        self.queued += 1
+        if self.metrics is not None:
+            self.metrics.peak('infinoted.requests', self.queued)
+
+        if self.call is None and not self.paused:
+            self.call = self.clock.callLater(0, self.flush)
+
+
+def operation_from_xml(node):
+    """
+    Build the operation of a request from its XML `node`, like ``<insert-caret pos="0">T
+    </insert-caret>``.
+
+    Returns:
+        The operation, None if it isn't one that is supported.
+    """
+    if node.name in ('insert-caret', 'insert'):
+        return Insert(int(node['pos']), unicode(node))
+    if node.name in ('delete-caret', 'delete'):
+        return Delete(int(node['pos']), int(node['len']))
+    if node.name == 'move':
+        return Move(int(node['caret']), int(node.getAttribute('selection', 0)))
+    if node.name == 'no-op':
+        return NOOP
+    return None
+
+
+class User(object):
+    """
+    A user of a session, as told by ``sync-user``, ``user-join`` and the requests of the
+    user.
+
+    Attributes:
+        id (int): The user id in the session.
+        name (unicode): The name of the user, unique in the session.
+        hue (float): The colour of the user, 0 to 1.
+        caret (int): The character offset of the caret in the document.
+        selection (int): The number of characters selected from the caret, backwards if
+                         negative.
+        status (unicode): ``active``, ``inactive`` or ``unavailable``.
 
+    """
+    __slots__ = ('id', 'name', 'hue', 'caret', 'selection', 'status')
+
+    def __init__(self, node):
+        self.id = int(node['id'])
+        self.update(node)
+
+    def update(self, node):
+        """
+        Take on the state in the attributes of `node`.
+        """
+        self.name = node.getAttribute('name', u'')
+        # Spread the users without a colour around the colour wheel.
+        self.hue = float(node.getAttribute('hue', self.id * 0.618034 % 1))
+        self.caret = int(node.getAttribute('caret', 0))
+        self.selection = int(node.getAttribute('selection', 0))
+        self.status = node.getAttribute('status', u'active')
+
+
+class InfinotedSession(object):
+    """
+    The state of one subscribed text session, the group infinoted names it by, the Vim
+    buffer it is shown in, the user we joined it as and the shadow document and request
+    log of the session.
+
+    Args:
+        name (unicode): The group name of the session, like ``InfSession_3``.
+        buffer_name (unicode): The name of the buffer, the name of the node in the
+                               directory.
+
+    Attributes:
+        synced (bool): Whether the whole document has been synchronized.
+        offline (bool): Whether the connection was lost, local edits are only logged until
+                        the session is resumed.
+        previous (InfinotedSession): While resuming, the session from before the
+                                     connection was lost, which Vim still shows.
+        users (dict): The :class:`User` of each user of the session by id.
+
+    """
+    def __init__(self, name, buffer_name):
+        self.name = name
+        self.buffer_name = buffer_name
+        self.user_id = None
+        self.synced = False
+        self.offline = False
+        self.previous = None
+        self.algorithm = Algorithm()
+        self.document = Document()
+        self.users = {}
+
+    def move_carets(self, operation, author=None):
+        """
+        Move the carets of the users along with the text as `operation` is applied, the
+        caret of the user `author` to where the operation was made.
+
+        Returns:
+            User: The `author`, None if it isn't a user of the session.
+        """
+        for user in self.users.values():
+            if user.id != author:
+                moved = transform(Move(user.caret, user.selection), operation, False)
+                user.caret, user.selection = moved.position, moved.length
+
+        user = self.users.get(author)
+        if user is not None:
+            while operation.__class__ is Split:
+                operation = operation.first
+            if operation.__class__ is Insert:
+                user.caret, user.selection = operation.position + len(operation.text), 0
+            elif operation.__class__ is Delete:
+                user.caret, user.selection = operation.position, 0
+            elif operation.__class__ is Move:
+                user.caret, user.selection = operation.position, operation.length
+        return user
+
+
+@implementer(IPushProducer)
 class InfinotedProtocol(object):
     """
     TODO this needs to be examined, probably should be an actual protocol/factory setup
+
+    The explored part of the directory is cached in :attr:`directory`, only the root is
+    explored up front and the text documents in it subscribed to.  Subdirectories are
+    explored when asked for with :meth:`explore_path`, other documents subscribed to with
+    :meth:`open`.  The buffer of a document is named by its path in the directory, after
+    `prefix`.  Without `subscribe_root` the documents in the root are only subscribed to
+    when opened too.
+
+    Each session is kept in :attr:`sessions` by its group name, which is what incoming
+    stanzas are routed by, and in :attr:`buffers` by its buffer name, which is what edits
+    from Vim are routed by.  Sessions are joined as `user_name`, the login name by default.
+
+    A lost connection is retried with an exponential backoff of up to
+    :data:`RECONNECT_MAX_DELAY` seconds.  Meanwhile the sessions are kept and Vim can keep
+    editing, the edits are logged by the algorithm of each session.  Once reconnected the
+    sessions are subscribed to again and rejoined as the same user, which infinoted
+    answers with a ``user-rejoin``.  The requests infinoted never got are sent again and
+    Vim is only sent the difference between what it shows and the resumed document, see
+    :meth:`resume`.
+
+    The protocol is the producer of what is written to the stream, registered by the
+    service once connected.  While infinoted reads slower than it is sent to the requests
+    wait in the :class:`RequestPipeline` and the edits from Vim in the coalescer of the
+    service, where they are merged and compacted rather than piling up in the transport.
+
+    Nothing happens until :meth:`connect` is called, or until :meth:`connected` is given an
+    already connected stream, like the benchmarks do.
     """
-    def __init__(self, service):
-        jid = JID('127.0.0.1')
+    def __init__(self, service, prefix=u'', subscribe_root=True, user_name=None):
+        self.finished = Deferred()
+        self.prefix = prefix
+        self.subscribe_root = subscribe_root
+        self.user_name = user_name or getpass.getuser().decode('utf-8')
+        self.xmlstream = None
+        self.pipeline = None
+        self.welcomed = False
+        self.waiting = []
+        self.directory = Directory()
+        # The node and Deferred of each exploration by its seq, and the Deferreds of the
+        # explorations by node id.
+        self.explorations = {}
+        self.exploring = {}
+        # The buffer name of each node subscribed to by node id.
+        self.subscriptions = {}
+        self.sessions = {}
+        self.buffers = {}
+        self.seq = 0
+        self.service = service
+
+        # The handler of each message in a <group>, looked up by the name of the message
+        # rather than matching an XPath query per message type against every stanza.
+        self.handlers = {
+            'welcome': self.welcome,
+            'explore-begin': self.explore_begin,
+            'explore-end': self.explore_end,
+            'subscribe-chat': self.subscribe,
+            'subscribe-session': self.subscribe_session,
+            'sync-begin': self.sync_begin,
+            'sync-end': self.sync_end,
+            'user-join': self.user_joined,
+            'user-rejoin': self.user_joined,
+            'user-status-change': self.user_status_change,
+            'add-node': self.add_node,
+            'remove-node': self.remove_node,
+            'sync-segment': self.sync_segment,
+            'sync-user': self.sync_user,
+            'sync-request': self.sync_request,
+            'request': self.request,
+        }
+
+    def connect(self, host='127.0.0.1', port=None, tls=True):
+        """
+        Connect to the infinoted server at `host`.  Without a `port` it is looked up in the
+        ``xmpp-client`` SRV record of `host`, falling back to 6523.  Without `tls` the
+        connection is only encrypted when the server insists, :mod:`fake_infinoted`
+        doesn't.
+
+        The factory reconnects whenever the connection is lost or fails, waiting longer
+        after every failed attempt.
+        """
+        jid = JID(host)
         f = client.XMPPClientFactory(jid, '')
+        f.protocol = StanzaXmlStream
+        f.maxDelay = RECONNECT_MAX_DELAY
+        f.clock = self.service.clock
+        # Binding a resource replaces the jid of the authenticator, log in anonymously with
+        # the jid of the server again on every connection.
+        f.addBootstrap(xmlstream.STREAM_CONNECTED_EVENT,
+                       lambda xs: setattr(xs.authenticator, 'jid', jid))
+        if not tls:
+            f.addBootstrap(xmlstream.STREAM_CONNECTED_EVENT, self.tls_optional)
         f.addBootstrap(xmlstream.STREAM_CONNECTED_EVENT, self.connected)
         f.addBootstrap(xmlstream.STREAM_AUTHD_EVENT, self.authenticated)
-        connector = SRVConnector(
-            reactor, 'xmpp-client', jid.host, f, defaultPort=6523)
-        connector.connect()
-        self.finished = Deferred()
-        self.files = {}
-        self.service = service
+        f.addBootstrap(xmlstream.STREAM_END_EVENT, self.disconnected)
+        if port is None:
+            from twisted.names.srvconnect import SRVConnector
+            connector = SRVConnector(
+                reactor, 'xmpp-client', jid.host, f, defaultPort=6523)
+            connector.connect()
+        else:
+            reactor.connectTCP(host, port, f)
+
+    def tls_optional(self, xs):
+        for initializer in xs.initializers:
+            if isinstance(initializer, xmlstream.TLSInitiatingInitializer):
+                initializer.required = False
 
     def rawDataIn(self, buf):
-        log.msg("RECV: %s" % unicode(buf, 'utf-8').encode('ascii', 'replace'))
+        self.service.tracer.record('infinoted', '<', buf)
+        self.service.metrics.count('infinoted.bytes_in', len(buf))
 
     def rawDataOut(self, buf):
-        log.msg("SEND: %s" % unicode(buf, 'utf-8').encode('ascii', 'replace'))
+        self.service.tracer.record('infinoted', '>', buf)
+        self.service.metrics.count('infinoted.bytes_out', len(buf))
 
     def connected(self, xs):
         log.msg('Connected.')
 
         self.xmlstream = xs
+        self.pipeline = RequestPipeline(xs.send, self.service.clock, self.service.metrics)
+        self.service.infinoted_connected(self)
 
-        # Log all traffic
+        # Trace all traffic
         xs.rawDataInFn = self.rawDataIn
         xs.rawDataOutFn = self.rawDataOut
 
         # Need to inject our on challenge before twisted words sasl version.
         xs.addObserver('/challenge', self.challenge, 100)
-        xs.addObserver('/group/welcome', self.welcome)
-        xs.addObserver('/group/explore-begin', self.explore)
-        xs.addObserver('/group/explore-end', self.explore_end)
-        xs.addObserver('/group/subscribe-chat', self.subscribe)
-        xs.addObserver('/group/subscribe-session', self.subscribe_session)
-        xs.addObserver('/group/sync-begin', self.sync_begin)
-        xs.addObserver('/group/sync-end', self.sync_end)
-        xs.addObserver('/group/user-rejoin', self.user_rejoin)
-        xs.addObserver('/group/add-node', self.add_node)
-        xs.addObserver('/group/sync-segment', self.sync_segment)
-        xs.addObserver('/group/sync-user', self.sync_user)
-        xs.addObserver('/group/request/insert-caret', self.insert)
-        xs.addObserver('/group/request/delete-caret', self.delete)
-
-    def delete(self, element):
-        delete_node = element.firstChildElement().firstChildElement()
-        offset = int(delete_node['pos'])
-        length = int(delete_node['len'])
-        self.service.delete_vim(offset, length,
-                              self.files.keys()[0].encode('ascii', 'ignore'))
-
-    def insert(self, element):
-        """
-        This will send an insert text command to teh associated Vim instance.
-
-        """
-        insert_node = element.firstChildElement().firstChildElement()
-        offset = insert_node['pos']
-        self.service.insert_vim(str(insert_node).encode('ascii', 'ignore'), int(offset),
-                              self.files.keys()[0].encode('ascii', 'ignore'))
-
-
-    def subscribe(self, element):
+        xs.addObserver('/group', self.group)
+
+    def disconnected(self, reason):
+        """
+        The connection was lost.  Keep the sessions, offline, and the explorations still
+        waited for until the factory reconnects.
+        """
+        log.msg('Lost connection to infinoted.')
+        self.service.metrics.count('infinoted.disconnects')
+
+        self.xmlstream = None
+        self.pipeline = None
+        self.welcomed = False
+        self.explorations = {}
+        for node in self.directory.nodes.values():
+            # What changed meanwhile is only known by exploring again.
+            node.explored = False
+        for session in self.sessions.values():
+            if session.previous is not None:
+                # Lost again while resuming, the session Vim shows is still the old one.
+                session = session.previous
+            session.offline = session.algorithm.offline = True
+        self.sessions = {}
+
+    def pauseProducing(self):
+        """
+        The transport has more to write than infinoted reads, hold back the requests and
+        the edits from Vim.
+        """
+        self.service.metrics.count('infinoted.pauses')
+        if self.pipeline is not None:
+            self.pipeline.pause()
+        self.service.pause_gobby(self)
+
+    def resumeProducing(self):
+        """
+        The transport caught up, send everything held back in one go.
+        """
+        self.service.resume_gobby(self)
+        if self.pipeline is not None:
+            self.pipeline.resume()
+
+    def stopProducing(self):
+        """
+        The connection is going away, what the coalescer held is logged by the sessions
+        and sent again once reconnected.
+        """
+        self.service.resume_gobby(self)
+
+    def group(self, element):
+        """
+        Route each message of a ``<group>`` stanza to its handler in :attr:`handlers`, in
+        the order they were sent, with the name of the group it came in.
+        """
+        name = element['name']
+        for node in element.elements():
+            handler = self.handlers.get(node.name)
+            if handler is not None:
+                handler(name, node)
+
+    def request(self, name, node):
+        """
+        Transform the request of another user against everything they didn't know about
+        yet and send the result to the associated Vim instance.
+
+        """
+        session = self.sessions.get(name)
+        if session is None:
+            return
+
+        metrics = self.service.metrics
+        start = metrics.now()
+
+        # Local edits still held back were made before this request arrived.  While
+        # infinoted is behind they stay held, the service transforms the request against
+        # them on its way to Vim rather than queueing ever more requests.
+        self.service.flush_gobby(session.buffer_name, held=False)
+
+        operation = operation_from_xml(node.firstChildElement())
+        if operation is None:
+            # Still needs to count as a request of the user to keep the states right.
+            log.msg('Unsupported request %s' % node.toXml())
+            operation = NOOP
+
+        operation = session.algorithm.receive(int(node['user']),
+                                              node.getAttribute('time', ''), operation)
+        self.apply(operation, session)
+        author = session.move_carets(operation, int(node['user']))
+        if author is not None:
+            self.show_caret(session, author, operation.__class__ is not Move)
+        metrics.count('infinoted.requests_in')
+        self.service.received_gobby(start)
+
+    def apply(self, operation, session):
+        """
+        Apply a transformed `operation` to the shadow document of `session` and its Vim
+        buffer.
+        """
+        if operation.__class__ is Insert:
+            session.document.insert(operation.text, operation.position)
+            if session.previous is None:
+                self.service.insert_vim(operation.text, operation.position,
+                                        session.buffer_name)
+        elif operation.__class__ is Delete:
+            session.document.delete(operation.position, operation.length)
+            if session.previous is None:
+                self.service.delete_vim(operation.position, operation.length,
+                                        session.buffer_name)
+        elif operation.__class__ is Split:
+            self.apply(operation.first, session)
+            self.apply(operation.second, session)
+
+    def subscribe(self, name, node):
         # TODO this needs to be more robust and really ack
         self.xmlstream.send(u'<group publisher="you" name="InfDirectory">'
                             '<subscribe-ack/></group>')
@@ -93,10 +501,25 @@ class InfinotedProtocol(object):
         Returns: TODO
 
         """
-        self.xmlstream.send(u'<group publisher="you" name="' + self.session + '">'
-                            '<request user="' + self.user_id + '" time="">'
-                            '<delete-caret pos="' + str(offset) + '" len="' + str(length)
-                            + '"/></request></group>')
+        session = self.buffers.get(buffer_name)
+        if session is None:
+            return
+        if session.algorithm.user is None:
+            # Not joined yet, hold on to it until we are.
+            self.service.hold_gobby(buffer_name, [(offset, length, u'')])
+            return
+
+        try:
+            session.document.delete(offset, length)
+        except ValueError:
+            log.err(None, 'Dropped delete from %s' % buffer_name)
+            return
+
+        operation = Delete(offset, length)
+        time = session.algorithm.generate(operation)
+        session.move_carets(operation, session.algorithm.user)
+        if not session.offline:
+            self.pipeline.delete(session.name, session.user_id, offset, length, time)
 
     def insert_text(self, text, position, buffer_name):
         """
@@ -116,97 +539,449 @@ class InfinotedProtocol(object):
             </group>
 
         """
-        self.xmlstream.send(u'<group publisher="you" name="' + self.session + '">'
-                            '<request user="' + self.user_id + '" time="">'
-                            '<insert-caret pos="' + str(position) + '">' + text +
-                            '</insert-caret>'
-                            '</request>'
-                            '</group>')
+        session = self.buffers.get(buffer_name)
+        if session is None:
+            return
+        if session.algorithm.user is None:
+            # Not joined yet, hold on to it until we are.
+            self.service.hold_gobby(buffer_name, [(position, 0, text)])
+            return
+
+        try:
+            session.document.insert(text, position)
+        except ValueError:
+            log.err(None, 'Dropped insert into %s' % buffer_name)
+            return
+
+        operation = Insert(position, text)
+        time = session.algorithm.generate(operation)
+        session.move_carets(operation, session.algorithm.user)
+        if not session.offline:
+            self.pipeline.insert(session.name, session.user_id, position, text, time)
+
+    def move_caret(self, offset, selection, buffer_name):
+        """
+        Move our caret in the subscribed buffer to `offset`, with `selection` characters
+        selected.  Edits leave the caret behind them already, a move to there isn't sent.
+        """
+        session = self.buffers.get(buffer_name)
+        if session is None or session.algorithm.user is None:
+            return
+
+        user = session.users.get(session.algorithm.user)
+        if user is not None and (user.caret, user.selection) == (offset, selection):
+            return
+        if not 0 <= offset <= len(session.document):
+            log.msg('Dropped caret move in %s' % buffer_name)
+            return
+
+        operation = Move(offset, selection)
+        time = session.algorithm.generate(operation)
+        session.move_carets(operation, session.algorithm.user)
+        self.service.metrics.count('infinoted.moves')
+        if not session.offline:
+            self.pipeline.move(session.name, session.user_id, offset, selection, time)
+
+    def replace_text(self, offset, length, text, buffer_name):
+        """
+        Replace `length` characters at `offset` with `text`.  This is sent as a delete and
+        an insert request which the :class:`RequestPipeline` puts in the same group.
+
+        Args:
+            offset (int): The caret position in the buffer, 0 based.
+            length (int): The number of characters to remove.
+            text (string): The text to insert in their place.
+            buffer_name (string): The buffer name.
 
-    def explore_end(self, element):
         """
-        Once we get the explore-end then we can send anotheer message.
+        self.delete_text(offset, length, buffer_name)
+        self.insert_text(text, offset, buffer_name)
+
+    def explore(self, node):
+        """
+        Explore the subdirectory `node` unless it already was.
+
+        Returns:
+            Deferred: Fires with `node` once its children are known, or with None if it
+                      was removed meanwhile.
         """
-        self.service.new_buffer(self.files.keys()[0].encode('ascii', 'ignore'))
-        file_id = self.files.values()[0]
+        if node.explored:
+            return succeed(node)
+
+        waiting = self.exploring.get(node.node_id)
+        if waiting is None:
+            waiting = self.exploring[node.node_id] = []
+            self.explore_node(node)
+
+        d = Deferred()
+        waiting.append(d)
+        return d
+
+    def explore_node(self, node):
+        seq = self.next_seq()
+        self.explorations[seq] = node
         self.xmlstream.send(u'<group publisher="you" name="InfDirectory">'
-                            '<subscribe-session seq="2" id="' + str(file_id) + '"/>'
-                            '</group>')
+                            '<explore-node seq="%s" id=%s/></group>' % (
+                                seq, quoteattr(node.node_id)))
+
+    def explore_path(self, path):
+        """
+        Find the node at `path`, exploring the subdirectories on the way, and the node
+        itself if it is a subdirectory, as needed.
+
+        Returns:
+            Deferred: Fires with the node, or None when there is no such node.
+        """
+        names = [name for name in path.split(u'/') if name]
+
+        def walk(node):
+            while node is not None and node.is_directory():
+                if not node.explored:
+                    return self.explore(node).addCallback(walk)
+                if not names:
+                    break
+                node = node.children.get(names.pop(0))
+            if names:
+                return None
+            return node
+
+        return self.when_welcomed().addCallback(lambda _: walk(self.directory.root))
+
+    def when_welcomed(self):
+        """
+        Returns:
+            Deferred: Fires once the server welcomed us, the directory can be explored.
+        """
+        if self.welcomed:
+            return succeed(None)
+        d = Deferred()
+        self.waiting.append(d)
+        return d
+
+    def explore_begin(self, name, node):
+        """
+        The children of an explored subdirectory follow, as ``add-node`` messages.
+        """
 
-    def subscribe_session(self, element):
+    def explore_end(self, name, message):
         """
-        This will send back an ack if we get the expected subscription confirmation
+        All children of a subdirectory were added, wake up whoever waited for them.  The
+        root was explored on connecting, subscribe to every text document in it.
         """
-        node = element.firstChildElement()
-        self.session = node['group']
+        node = self.explorations.pop(self.reply_seq(message), None)
+        if node is None:
+            return
+
+        waiting = self.exploring.pop(node.node_id, [])
+        if node.node_id not in self.directory.nodes:
+            # Removed while being explored.
+            node = None
+        else:
+            node.explored = True
+            if node is self.directory.root and self.subscribe_root:
+                for child in node.children.values():
+                    if child.node_type == TEXT:
+                        self.open(child.path())
+
+        for d in waiting:
+            d.callback(node)
+
+    def open(self, path):
+        """
+        Subscribe to the text document at `path`, if it was found while exploring and isn't
+        already subscribed to, and show it in a new buffer named `path` after the
+        :attr:`prefix`.  Edits Vim makes to it are held by the coalescer of the service
+        until the session is synchronized and joined, see :meth:`user_joined`.
+
+        Returns:
+            bool: Whether the document is subscribed to now.
+        """
+        node = self.directory.find(path)
+        if node is None or node.node_type != TEXT:
+            return False
+        if node.node_id in self.subscriptions:
+            return True
+
+        buffer_name = self.prefix + path
+        self.subscriptions[node.node_id] = buffer_name
+        self.service.new_buffer(buffer_name)
+        self.service.hold_gobby(buffer_name)
+        self.subscribe_node(node.node_id)
+        return True
+
+    def subscribe_node(self, node_id):
+        self.xmlstream.send(u'<group publisher="you" name="InfDirectory">'
+                            '<subscribe-session seq="%s" id=%s/>'
+                            '</group>' % (self.next_seq(), quoteattr(node_id)))
+
+    def next_seq(self):
+        seq = unicode(self.seq)
+        self.seq += 1
+        return seq
+
+    def reply_seq(self, node):
+        """
+        The seq of our request a directory message from infinoted replies to, infinoted may
+        prefix it with the sequence id of the connection, ``1/4``.
+        """
+        return node.getAttribute('seq', u'').rsplit(u'/', 1)[-1]
+
+    def subscribe_session(self, name, node):
+        """
+        This will send back an ack if we get the expected subscription confirmation.  A
+        session subscribed to again after reconnecting is resumed once it is synchronized
+        and joined, until then edits from Vim still go to the offline session.
+        """
+        buffer_name = self.subscriptions.get(node['id'])
+        if buffer_name is None:
+            return
+        session = InfinotedSession(node['group'], buffer_name)
+        self.sessions[session.name] = session
+        previous = self.buffers.get(buffer_name)
+        if previous is not None and previous.offline:
+            session.previous = previous
+        else:
+            self.buffers[session.buffer_name] = session
         self.xmlstream.send(u'<group publisher="you" name="InfDirectory">'
                             '<subscribe-ack id="' + node['id'] + '"/>'
                             '</group>')
 
-    def sync_begin(self, element):
+    def sync_begin(self, name, node):
+        """
+        The session is about to be synchronized, start over with an empty document.  The
+        segments are streamed to Vim as they arrive rather than collected first.
+        """
+        session = self.sessions.get(name)
+        if session is not None:
+            session.synced = False
+            session.document.sync(u'')
+
+    def sync_user(self, name, node):
+        """
+        Record the state a user of the session is at, and where their caret is.
+        """
+        session = self.sessions[name]
+        session.algorithm.set_user_vector(int(node['id']),
+                                          vector_from_string(node.getAttribute('time', '')))
+        self.update_user(session, node)
+
+    def update_user(self, session, node):
+        """
+        Record the state of the user of `session` in `node`, a ``sync-user`` or a
+        ``user-join``, and show or hide their caret.
         """
-        Handle the syncing of the file.
+        user = session.users.get(int(node['id']))
+        if user is None:
+            user = session.users[int(node['id'])] = User(node)
+        else:
+            user.update(node)
+        self.show_caret(session, user)
+
+    def user_status_change(self, name, node):
         """
-        # TODO this should be updating the Vim buffer
-        pass
+        A user of the session became ``active``, ``inactive`` or ``unavailable``.
+        """
+        session = self.sessions.get(name)
+        if session is None:
+            return
+
+        user = session.users.get(int(node.getAttribute('id', -1)))
+        if user is not None:
+            user.status = node.getAttribute('status', u'active')
+            self.show_caret(session, user)
 
-    def sync_user(self, element):
+    def show_caret(self, session, user, edited=False):
         """
-        This should be storing/creating data about a user but forget it for now
+        Have Vim show the caret of `user` where it is in `session`, or not at all if the
+        user is unavailable.  Ours isn't shown.
         """
-        pass
+        if user.name == self.user_name:
+            return
+        if user.status == u'unavailable':
+            self.service.caret_gone(session.buffer_name, user.name)
+        else:
+            self.service.caret_vim(session.buffer_name, user, edited)
+
+    def sync_request(self, name, node):
+        """
+        Log a request still kept by the server, requests to come may be concurrent to it.
+        """
+        session = self.sessions[name]
+        operation = operation_from_xml(node.firstChildElement()) or NOOP
+        session.algorithm.add_synced(int(node['user']), node['time'], operation)
 
-    def sync_segment(self, element):
+    def sync_segment(self, name, node):
         """
-        This is the message to update the buffer with what gobby has.
+        This is the message to update the buffer with what gobby has, the text of each
+        segment follows the previous ones.
         """
-        node = element.firstChildElement()
-        self.service.sync_vim(str(node).encode('ascii', 'ignore'),
-                              self.files.keys()[0].encode('ascii', 'ignore'))
+        session = self.sessions[name]
+        text = unicode(node)
+        session.document.insert(text, len(session.document))
+        if session.previous is None:
+            self.service.sync_vim(text, session.buffer_name)
 
-    def sync_end(self, element):
+    def sync_end(self, name, node):
         """
         Done with syncing send back an ack
         """
-        self.xmlstream.send(u'<group publisher="you" name="' + element['name'] + '">'
+        session = self.sessions.get(name)
+        if session is not None:
+            session.synced = True
+            if session.previous is None:
+                self.service.sync_vim_done(session.buffer_name)
+        self.xmlstream.send(u'<group publisher="you" name="' + name + '">'
                             '<sync-ack/></group>')
-        self.user_join(self.session)
+        self.user_join(name)
 
     def user_join(self, name):
         """
-        This will join to a file or a chat group
+        This will join to a file or a chat group.  A session being resumed is joined with
+        the caret where it was.
         """
-        self.xmlstream.send(u'<group publisher="you" name="' + name + '">'
-                            '<user-join seq="0" name="Bob" status="active" '
-                            'time="" caret="0" hue="0.28028500000000001"/>'
-                            '</group>')
-
-    def user_rejoin(self, element):
+        caret = 0
+        session = self.sessions.get(name)
+        previous = session and session.previous
+        if previous is not None and previous.algorithm.user in previous.users:
+            caret = min(previous.users[previous.algorithm.user].caret,
+                        len(session.document))
+        self.xmlstream.send(u'<group publisher="you" name=%s>'
+                            '<user-join seq="0" name=%s status="active" '
+                            'time="" caret="%d" hue="0.28028500000000001"/>'
+                            '</group>'
+                            % (quoteattr(name), quoteattr(self.user_name), caret))
+
+    def user_joined(self, name, node):
         """
-        Save off the id given from infinoted
+        Record the state of a user joining the session.  The reply to our own join carries
+        the ``seq`` of the request, save off the id given from infinoted.  Its state is how
+        many of our requests infinoted has.  A session being resumed can be resumed now, and
+        the edits Vim made before we joined sent.
         """
-        node = element.firstChildElement()
-        self.user_id = node['id']
-
-    def explore(self, element):
+        session = self.sessions.get(name)
+        if session is None:
+            return
+
+        user = int(node['id'])
+        session.algorithm.set_user_vector(user,
+                                          vector_from_string(node.getAttribute('time', '')))
+        self.update_user(session, node)
+        if node.hasAttribute('seq'):
+            session.user_id = node['id']
+            if session.previous is not None:
+                self.resume(session)
+            session.algorithm.user = user
+            session.algorithm.acknowledge(session.algorithm.current.get(user, 0))
+            if not self.pipeline.paused:
+                self.service.resume_gobby(self)
+
+    def resume(self, session):
         """
-        NOt sure if I really need to do anything here...???
+        Carry on with `session`, synchronized and joined again after reconnecting, where
+        the offline session Vim shows left off.
+
+        The requests of the offline session beyond what infinoted has of our user are sent
+        again, with their original times, and transformed here like infinoted does.  Vim is
+        sent the difference between the offline document and the result, the edits of the
+        others made meanwhile.  When infinoted gave us another user id, no longer has what
+        the requests were made on or they fail to transform, they are dropped and Vim gets
+        the document as infinoted has it.
         """
-        pass
-
-    def add_node(self, element):
+        previous = session.previous
+        buffer_name = session.buffer_name
+        self.service.flush_gobby(buffer_name)
+
+        # The algorithm only gets our user id afterwards, so cleaning up its log doesn't
+        # assume the requests sent again knew about everything already.
+        algorithm = session.algorithm
+        user = int(session.user_id)
+        requests = []
+        if previous.algorithm.user is not None:
+            logged = previous.algorithm.logs.get(previous.algorithm.user)
+            start = algorithm.current.get(previous.algorithm.user, 0)
+            if logged is not None and start < logged.begin:
+                # Sending only the rest would leave a gap, Vim gets what infinoted has.
+                log.msg('Dropped %d edits to %s made while disconnected, they are no '
+                        'longer logged' % (logged.end() - start, buffer_name))
+            elif logged is not None:
+                requests = [logged[index] for index in range(start, logged.end())]
+
+        resent = 0
+        if previous.algorithm.user == user:
+            for request in requests:
+                time = vector_to_string(request.vector, algorithm.user_vectors.get(user))
+                try:
+                    operation = algorithm.receive(user, time, request.operation)
+                except Exception:
+                    # Whatever went wrong, the algorithm is still where infinoted is.
+                    log.err(None, 'Failed to send again the edits to %s made while '
+                                  'disconnected' % buffer_name)
+                    break
+                self.apply(operation, session)
+                session.move_carets(operation, user)
+                if request.operation.__class__ is Insert:
+                    self.pipeline.insert(session.name, session.user_id,
+                                         request.operation.position, request.operation.text,
+                                         time)
+                elif request.operation.__class__ is Delete:
+                    self.pipeline.delete(session.name, session.user_id,
+                                         request.operation.position,
+                                         request.operation.length, time)
+                elif request.operation.__class__ is Move:
+                    self.pipeline.move(session.name, session.user_id,
+                                       request.operation.position,
+                                       request.operation.length, time)
+                resent += 1
+        if resent < len(requests):
+            log.msg('Dropped %d edits to %s made while disconnected' % (
+                len(requests) - resent, buffer_name))
+
+        session.previous = None
+        self.buffers[buffer_name] = session
+        offset, length, text = difference(unicode(previous.document),
+                                          unicode(session.document))
+        if length:
+            self.service.delete_vim(offset, length, buffer_name)
+        if text:
+            self.service.insert_vim(text, offset, buffer_name)
+        if not previous.synced:
+            self.service.sync_vim_done(buffer_name)
+
+        metrics = self.service.metrics
+        metrics.count('infinoted.resumed')
+        metrics.count('infinoted.resent', resent)
+
+    def add_node(self, name, node):
         """
-        This will add a file to the list of available files.
+        Add the document or subdirectory `node` to the :attr:`directory`.
         """
+        self.directory.add(node['id'], node['parent'], node['name'],
+                           node.getAttribute('type'))
 
-        # There may be a better way to hook but i keep getting the root, not the element I
-        # care about
-        node = element.firstChildElement()
-        self.files[node['name']] = node['id']
+    def remove_node(self, name, node):
+        """
+        Remove `node` from the :attr:`directory`.  Sessions already subscribed to are kept.
+        """
+        self.directory.remove(node['id'])
 
-    def welcome(self, element):
-        self.xmlstream.send(u'<group publisher="you" name="InfDirectory"><explore-node '
-                            'seq="0" id="0" /></group>')
+    def welcome(self, name, node):
+        """
+        The server is ready.  On the first connection explore the root, after reconnecting
+        explore again what was still waited for and subscribe to the sessions again.
+        """
+        exploring = list(self.exploring)
+        if not self.subscriptions and not exploring:
+            self.explore(self.directory.root)
+        for node_id in exploring:
+            node = self.directory.get(node_id)
+            if node is not None:
+                self.explore_node(node)
+        for node_id in self.subscriptions:
+            self.subscribe_node(node_id)
+        self.welcomed = True
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(None)
 
     def challenge(self, element):
         # Super hack not sure the exact problem but looking at RFC 2245 anonymous sasl
@@ -0,0 +1,186 @@
+"""
+Counters, latency histograms, queue depths and their high-water marks of the bridge.
+
+The protocols and the :class:`VobbyService` record into one :class:`Metrics`, which can be
+read as JSON from a local HTTP port, see :class:`MetricsResource`, or as text in Vim with
+``:nbkey VobbyStats``.
+
+"""
+import json
+import time
+
+from twisted.web import resource
+
+# Latencies are kept in buckets of powers of 2 microseconds.
+BUCKETS = 32
+
+
+class Histogram(object):
+    """
+    The distribution of a latency, in buckets of powers of 2 microseconds so recording is
+    cheap and the memory used is fixed.
+    """
+    __slots__ = ('count', 'total', 'maximum', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def observe(self, seconds):
+        """
+        Record one latency of `seconds`.
+        """
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[min(bucket, BUCKETS - 1)] += 1
+
+    def percentile(self, fraction):
+        """
+        An upper bound of the `fraction` percentile in seconds, within a factor of 2.
+        """
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min(2 ** bucket / 1000000.0, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        """
+        The count, mean, 50th and 99th percentile and maximum, in milliseconds.
+        """
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+            'p50_ms': self.percentile(0.5) * 1000,
+            'p99_ms': self.percentile(0.99) * 1000,
+            'max_ms': self.maximum * 1000,
+        }
+
+
+class Metrics(object):
+    """
+    Everything recorded about the bridge.  Counters, histograms and peaks are created as
+    they are first used, queue depths are read from callables only when a snapshot is
+    taken.
+
+    Kwargs:
+        enabled (bool): When False nothing is recorded, the methods return right away.
+        clock (callable): Gives the current time in seconds.
+
+    """
+    def __init__(self, enabled=True, clock=time.time):
+        self.enabled = enabled
+        self.clock = clock
+        self.started = clock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.peaks = {}
+
+    def now(self):
+        """
+        The current time, to pass to :meth:`since` later.  None when disabled.
+        """
+        if self.enabled:
+            return self.clock()
+        return None
+
+    def count(self, name, amount=1):
+        """
+        Add `amount` to the counter `name`.
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        """
+        Record a latency of `seconds` in the histogram `name`.
+        """
+        if self.enabled:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def since(self, name, start):
+        """
+        Record the latency from `start`, as given by :meth:`now`, in the histogram `name`.
+        """
+        if self.enabled and start is not None:
+            self.observe(name, self.clock() - start)
+
+    def peak(self, name, value):
+        """
+        Record `value` as the high-water mark `name` if it is higher than the last one.
+        """
+        if self.enabled and value > self.peaks.get(name, 0):
+            self.peaks[name] = value
+
+    def gauge(self, name, function):
+        """
+        Report the value returned by `function` as the queue depth `name`.
+        """
+        self.gauges[name] = function
+
+    def snapshot(self):
+        """
+        Everything recorded so far.
+
+        Returns:
+            dict: With the ``uptime`` in seconds, the ``counters`` with their totals and
+                  rates per second, the ``latencies``, the ``queues`` depths and the
+                  ``peaks`` they and others reached.
+        """
+        uptime = max(self.clock() - self.started, 1e-9)
+        return {
+            'enabled': self.enabled,
+            'uptime': uptime,
+            'counters': dict((name, {'total': count, 'per_sec': count / uptime})
+                             for name, count in self.counters.items()),
+            'latencies': dict((name, histogram.summary())
+                              for name, histogram in self.histograms.items()),
+            'queues': dict((name, function()) for name, function in self.gauges.items()),
+            'peaks': dict(self.peaks),
+        }
+
+    def format(self):
+        """
+        The :meth:`snapshot` as lines of text.
+        """
+        snapshot = self.snapshot()
+        lines = ['uptime %.0fs%s' % (snapshot['uptime'],
+                                     '' if self.enabled else ' (metrics disabled)')]
+        for name, counter in sorted(snapshot['counters'].items()):
+            lines.append('%-28s %12d %10.1f/s' % (name, counter['total'],
+                                                   counter['per_sec']))
+        for name, latency in sorted(snapshot['latencies'].items()):
+            lines.append('%-28s %12d  mean %.2fms p50 %.2fms p99 %.2fms max %.2fms' % (
+                name, latency['count'], latency['mean_ms'], latency['p50_ms'],
+                latency['p99_ms'], latency['max_ms']))
+        for name, depth in sorted(snapshot['queues'].items()):
+            lines.append('%-28s %12d queued' % (name, depth))
+        for name, peak in sorted(snapshot['peaks'].items()):
+            lines.append('%-28s %12d peak' % (name, peak))
+        return lines
+
+
+class MetricsResource(resource.Resource):
+    """
+    Serves the :meth:`Metrics.snapshot` of `metrics` as JSON.
+    """
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps(self.metrics.snapshot(), indent=2, sort_keys=True).encode('utf-8')
@@ -0,0 +1,104 @@
+"""
+The connections to infinoted servers.
+
+:mod:`infinoted` and the ``twisted.words`` XMPP stack behind it are only imported when the
+first connection is opened, so the bridge can start listening for Vim before paying for
+them.
+
+"""
+
+
+def parse_address(address):
+    """
+    Split the `address` of an infinoted server, ``host`` or ``host:port``.
+
+    Returns:
+        tuple: The host and the port, None without one.
+    """
+    host, _, port = address.partition(u':')
+    return host, int(port) if port else None
+
+
+class ConnectionPool(object):
+    """
+    The connections to infinoted servers by ``host:port``.  A connection is opened the
+    first time a document of its server is asked for and shared by all documents of the
+    server after that.
+
+    The documents of the `default` server are named by their path, the documents of any
+    other server by their path after ``host:port/``.  Only the documents in the root of
+    the `default` server are opened when connecting, as vobby always did.
+
+    Args:
+        service (VobbyService): Passed on to each :class:`InfinotedProtocol`.
+
+    Kwargs:
+        default (string): The address of the server documents are on unless told otherwise,
+                          the port is looked up when it has none.
+        tls (bool): Passed on to :meth:`InfinotedProtocol.connect`.
+
+    """
+    def __init__(self, service, default=u'127.0.0.1:6523', tls=True):
+        self.service = service
+        self.default = self.normalize(default)
+        self.tls = tls
+        self.connections = {}
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __iter__(self):
+        return iter(self.connections.values())
+
+    def normalize(self, address):
+        host, port = parse_address(address)
+        return host if port is None else u'%s:%d' % (host, port)
+
+    def get(self, address=None):
+        """
+        The connection to the server at `address`, the default server without one.  It is
+        opened unless it already was.
+        """
+        address = self.normalize(address or self.default)
+        protocol = self.connections.get(address)
+        if protocol is None:
+            from infinoted import InfinotedProtocol
+            if address == self.default:
+                protocol = InfinotedProtocol(self.service)
+            else:
+                protocol = InfinotedProtocol(self.service, address + u'/', False)
+            self.connections[address] = protocol
+            host, port = parse_address(address)
+            protocol.connect(host, port, self.tls)
+        return protocol
+
+    def add(self, protocol, address=None):
+        """
+        Use the already connected `protocol` for the server at `address`.
+        """
+        self.connections[self.normalize(address or self.default)] = protocol
+
+    def find(self, buffer_name):
+        """
+        The connection the document shown in the buffer `buffer_name` came from, None if
+        there isn't one.
+        """
+        for protocol in self.connections.values():
+            if buffer_name in protocol.buffers:
+                return protocol
+        return None
+
+    def resolve(self, location):
+        """
+        Split the `location` of a document or subdirectory, ``path`` on the default server
+        or ``host:port/path`` on another one, opening the connection to its server.  A first
+        name with a colon in it is only taken for ``host:port`` if the port is a number,
+        ``notes:todo.txt`` is a document.
+
+        Returns:
+            tuple: The :class:`InfinotedProtocol` and the path on its server.
+        """
+        first, _, rest = location.partition(u'/')
+        if first.partition(u':')[2].isdigit():
+            return self.get(first), rest
+        return self.get(), location
@@ -0,0 +1,405 @@
+"""
+Replays the traffic of a session through the real protocols, for the benchmarks.
+
+The messages Vim and infinoted send are fed to a :class:`VimBeansProtocol` and an
+:class:`InfinotedProtocol` connected to in memory transports, with the reactor replaced by
+a :class:`task.Clock` advanced after every message.  The traffic is either a trace dumped
+by :meth:`VobbyService.dump_trace` of a whole session or one of the generated
+:data:`SCENARIOS`.
+
+"""
+import gc
+import random
+import timeit
+
+from twisted.internet import task
+from twisted.words.protocols.jabber import xmlstream
+from xml.sax.saxutils import escape, quoteattr
+
+from adopted import Algorithm, Insert, Delete
+from infinoted import ENTITIES, InfinotedProtocol
+from metrics import Histogram
+from stanza import StanzaXmlStream
+from vimbeans import VimBeansProtocol, quote
+from vobby import VobbyService
+from wiretrace import OFF, parse_message
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+STREAM_HEADER = ('<stream:stream xmlns="jabber:client" '
+                 'xmlns:stream="http://etherx.jabber.org/streams" version="1.0">')
+
+
+class CountingTransport(object):
+    """
+    A transport which throws away what is written, only keeping track of how much and of
+    the largest single write.  It never pauses the :attr:`producer` registered with it by
+    itself.  Whether it is :attr:`reading` is only recorded, :class:`Replay` holds back
+    what is fed meanwhile.
+    """
+    disconnecting = False
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+        self.largest = 0
+        self.producer = None
+        self.reading = True
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+        self.largest = max(self.largest, len(data))
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def pauseProducing(self):
+        self.reading = False
+
+    def resumeProducing(self):
+        self.reading = True
+
+
+class Replay(object):
+    """
+    A :class:`VobbyService` with both protocols connected to :class:`CountingTransport`
+    instances, ready to be fed.
+
+    Kwargs:
+        coalesce_window (float): Passed on to the :class:`VobbyService`.
+        vims (int): How many Vims are connected, the traffic of Vim is fed to the first.
+        vim_transport (callable): Makes the transport of each Vim.
+
+    """
+    def __init__(self, coalesce_window=0.05, vims=1, vim_transport=CountingTransport):
+        self.clock = task.Clock()
+        self.service = VobbyService(coalesce_window, trace_level=OFF, clock=self.clock)
+
+        self.vim_transports = []
+        for _ in range(vims):
+            transport = vim_transport()
+            VimBeansProtocol(self.service).makeConnection(transport)
+            self.vim_transports.append(transport)
+        self.vim = self.service.vims[0]
+        self.vim_transport = self.vim_transports[0]
+
+        self.infinoted_transport = CountingTransport()
+        self.unread = []
+        self.infinoted = InfinotedProtocol(self.service, user_name=u'Bob')
+        self.service.pool.add(self.infinoted)
+        self.connect()
+
+    def connect(self):
+        """
+        Connect the :class:`InfinotedProtocol` to a new stream, as if it had just
+        reconnected.
+        """
+        self.xmlstream = StanzaXmlStream(xmlstream.Authenticator())
+        self.xmlstream.makeConnection(self.infinoted_transport)
+        self.infinoted.connected(self.xmlstream)
+        self.xmlstream.dataReceived(STREAM_HEADER)
+
+    def disconnect(self):
+        """
+        Lose the stream to infinoted, the sessions go offline until :meth:`connect`.
+        """
+        self.infinoted.disconnected(None)
+
+    def converged(self):
+        """
+        Whether every Vim shows each document the way the service has it.
+        """
+        for name, session in self.infinoted.buffers.items():
+            text = unicode(session.document)
+            for vim in self.service.vims:
+                buffer = vim.buffers.find(name)
+                if buffer is not None and buffer.document.text() != text:
+                    return False
+        return True
+
+    def feed(self, source, data):
+        """
+        Hand `data` to the protocol of `source`, ``'vim'`` or ``'infinoted'``, as if it had
+        just been read from the socket.  What infinoted sends while its transport isn't
+        reading is held back until :meth:`read`.
+        """
+        if source == 'vim':
+            self.vim.dataReceived(data)
+        else:
+            self.unread.append(data)
+            self.read()
+
+    def read(self):
+        """
+        Hand what infinoted sent to its protocol, as long as the transport is reading.
+        """
+        while self.unread and self.infinoted_transport.reading:
+            self.xmlstream.dataReceived(self.unread.pop(0))
+
+    def run(self, messages, tick=0.01):
+        """
+        Feed all of `messages`, pairs of source and data, advancing the clock by `tick`
+        after each one.
+
+        Returns:
+            dict: The ``messages`` and ``bytes`` fed, the ``seconds`` it took, the
+                  :class:`Histogram` of the ``latency`` of each message including what it
+                  scheduled and the ``allocated`` memory or objects.
+        """
+        latency = Histogram()
+        fed = 0
+
+        gc.collect()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        else:
+            objects = len(gc.get_objects())
+
+        start = timeit.default_timer()
+        for source, data in messages:
+            before = timeit.default_timer()
+            self.feed(source, data)
+            self.clock.advance(tick)
+            latency.observe(timeit.default_timer() - before)
+            fed += len(data)
+        self.service.coalescer.flush()
+        self.clock.advance(tick)
+        seconds = timeit.default_timer() - start
+
+        if tracemalloc is not None:
+            allocated = '%d bytes peak' % tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            allocated = '%d objects' % (len(gc.get_objects()) - objects)
+
+        return {'messages': len(messages), 'bytes': fed, 'seconds': seconds,
+                'latency': latency, 'allocated': allocated}
+
+
+def load_trace(path):
+    """
+    The messages Vim and infinoted sent in the trace at `path`, as dumped by
+    :meth:`VobbyService.dump_trace`.  The trace should cover the whole session, as the
+    harness sends its own stream header anything infinoted sent before the first
+    ``<group>`` is skipped.
+
+    Returns:
+        list: Pairs of source and data.
+    """
+    messages = []
+    started = False
+    with open(path) as trace:
+        for line in trace:
+            source, direction, data = parse_message(line.rstrip('\n'))
+            if direction != '<':
+                continue
+
+            data = data.encode('utf-8')
+            if source == 'vim':
+                messages.append((source, data + '\n'))
+            elif started or '<group' in data:
+                if not started:
+                    data = data[data.index('<group'):]
+                    started = True
+                messages.append((source, data))
+    return messages
+
+
+def group(name, content):
+    """
+    A message from infinoted of `content` for the group `name`.
+    """
+    stanza = u'<group publisher="server" name=%s>%s</group>' % (quoteattr(name), content)
+    return ('infinoted', stanza.encode('utf-8'))
+
+
+def open_session(text, users=1, segment=16 * 1024, batch=False):
+    """
+    The messages to open one session, ``InfSession_1`` of ``shared.txt``, with `text`
+    already in it and `users` other users besides us, user 1, in it.  The session is
+    synchronized with one ``<group>`` per message like infinoted does, or with all of them
+    in a single one with `batch`.
+    """
+    messages = [
+        group('InfDirectory', '<welcome protocol-version="1.0" sequence-id="1"/>'),
+        group('InfDirectory', '<explore-begin total="1" seq="0"/>'),
+        group('InfDirectory', '<add-node id="1" parent="0" name="shared.txt" '
+                              'type="InfText" seq="0"/>'),
+        group('InfDirectory', '<explore-end seq="0"/>'),
+        group('InfDirectory', '<subscribe-session id="1" group="InfSession_1" '
+                              'method="central"/>'),
+    ]
+    sync = [u'<sync-begin num-messages="0"/>']
+    for user in range(2, users + 2):
+        sync.append(u'<sync-user id="%d" name="user%d" time="" caret="0" status="active"/>'
+                    % (user, user))
+    for start in range(0, len(text), segment):
+        sync.append(u'<sync-segment author="0">%s</sync-segment>'
+                    % escape(text[start:start + segment], ENTITIES))
+    sync.append(u'<sync-end/>')
+    if batch:
+        messages.append(group('InfSession_1', u''.join(sync)))
+    else:
+        messages.extend([group('InfSession_1', message) for message in sync])
+    messages.append(group('InfSession_1', '<user-join id="1" seq="0" name="Bob" time="" '
+                                          'caret="0" status="active"/>'))
+    return messages
+
+
+def rejoin_session(text):
+    """
+    The messages to resume ``InfSession_1`` after reconnecting, infinoted still having it
+    with `text` in it and rejoining us as user 1.
+    """
+    return [
+        group('InfDirectory', '<welcome protocol-version="1.0" sequence-id="2"/>'),
+        group('InfDirectory', '<subscribe-session id="1" group="InfSession_1" '
+                              'method="central"/>'),
+        group('InfSession_1', u'<sync-begin num-messages="0"/>'
+                              u'<sync-segment author="0">%s</sync-segment><sync-end/>'
+                              % escape(text, ENTITIES)),
+        group('InfSession_1', '<user-rejoin id="1" seq="0" name="Bob" time="" caret="0" '
+                              'status="active"/>'),
+    ]
+
+
+def typing(keystrokes, paste=0.0, offset=0, seed=0):
+    """
+    Vim typing `keystrokes` characters into buffer 1 from `offset`, with a `paste` of 50
+    lines instead of a character that fraction of the time.
+    """
+    rand = random.Random(seed)
+    messages = []
+    for seqno in range(keystrokes):
+        if rand.random() < paste:
+            text = u'pasted line of text\n' * 50
+        else:
+            text = rand.choice(u'abcdefghijklmnopqrstuvwxyz ')
+        text = text.encode('utf-8')
+        messages.append(('vim', '1:insert=%d %d %s\n' % (seqno, offset, quote(text))))
+        offset += len(text)
+    return messages
+
+
+def cursor(keystrokes, text, jump=0.05, seed=0):
+    """
+    Vim typing `keystrokes` characters into buffer 1, which has `text` in it, reporting the
+    cursor after every one like a ``CursorMovedI`` autocommand does, and going somewhere
+    else to type that `jump` fraction of the time.
+    """
+    rand = random.Random(seed)
+    document = text.encode('utf-8')
+    offset = 0
+    messages = []
+    for seqno in range(keystrokes):
+        if rand.random() < jump:
+            offset = rand.randint(0, len(document))
+            while offset < len(document) and 0x80 <= ord(document[offset]) < 0xc0:
+                offset -= 1
+        else:
+            character = rand.choice('abcdefghijklmnopqrstuvwxyz ')
+            messages.append(('vim', '1:insert=%d %d %s\n'
+                             % (seqno, offset, quote(character))))
+            document = document[:offset] + character + document[offset:]
+            offset += 1
+        messages.append(('vim', '1:newDotAndMark=%d %d %d\n1:keyCommand=%d "VobbyCaret"\n'
+                         % (seqno, offset, offset, seqno)))
+    return messages
+
+
+def substitute(text, old, new, times=1):
+    """
+    Vim running ``:%s/old/new/`` over buffer 1, which has `text` in it, `times` times over.
+    Vim sends a remove and an insert for every line, all of a substitution in one read.
+    """
+    messages = []
+    seqno = 0
+    for _ in range(times):
+        lines = []
+        offset = 0
+        for line in text.splitlines(True):
+            before, after = line.encode('utf-8'), line.replace(old, new).encode('utf-8')
+            if before != after:
+                lines.append('1:remove=%d %d %d\n' % (seqno, offset, len(before)))
+                lines.append('1:insert=%d %d %s\n' % (seqno, offset, quote(after)))
+                seqno += 1
+            offset += len(after)
+        messages.append(('vim', ''.join(lines)))
+        text = text.replace(old, new)
+        old, new = new, old
+    return messages
+
+
+def concurrent(users, requests, text, lag=4, seed=0, batch=1):
+    """
+    `requests` edits from `users` other users typing into ``InfSession_1`` at the same time.
+    Each of them only sees the requests of the others up to `lag` requests late, so they
+    are concurrent to a few others, as they would be with network latency.  The requests
+    are relayed `batch` at a time in one ``<group>``.
+    """
+    rand = random.Random(seed)
+    ids = range(2, users + 2)
+    sites = dict((user, Algorithm(user)) for user in ids)
+    documents = dict((user, text) for user in ids)
+    for site in sites.values():
+        for user in ids:
+            site.set_user_vector(user, {})
+
+    relayed = []
+    seen = dict((user, 0) for user in ids)
+    stanzas = []
+    for _ in range(requests):
+        user = rand.choice(ids)
+        site = sites[user]
+        for other, time, operation in relayed[seen[user]:max(0, len(relayed) - lag)]:
+            if other != user:
+                operation = site.receive(other, time, operation)
+                documents[user] = operation.apply(documents[user])
+        seen[user] = max(seen[user], len(relayed) - lag)
+
+        document = documents[user]
+        position = rand.randint(0, len(document))
+        if document and rand.random() < 0.3:
+            operation = Delete(min(position, len(document) - 1), 1)
+            xml = '<delete-caret pos="%d" len="1"/>' % operation.position
+        else:
+            operation = Insert(position, rand.choice(u'abcdefghijklmnopqrstuvwxyz'))
+            xml = '<insert-caret pos="%d">%s</insert-caret>' % (position, operation.text)
+        documents[user] = operation.apply(document)
+
+        time = site.generate(operation)
+        relayed.append((user, time, operation))
+        stanzas.append('<request user="%d" time="%s">%s</request>' % (user, time, xml))
+    return [group('InfSession_1', ''.join(stanzas[start:start + batch]))
+            for start in range(0, len(stanzas), batch)]
+
+
+LINE = u'The quick brown fox jumps over the lazy d\xf6g\n'
+
+# Only every tenth line has a fox in it.
+SCATTERED = (LINE.replace(u'fox', u'owl') * 9 + LINE) * 100
+
+# Generated sessions by name, each is called with a scale factor.
+SCENARIOS = {
+    'typing': lambda scale: open_session(LINE * 100) + typing(int(20000 * scale)),
+    'paste': lambda scale: open_session(LINE * 100) + typing(int(2000 * scale), paste=0.2),
+    'concurrent': lambda scale: (open_session(LINE * 100, users=8) +
+                                 concurrent(8, int(1000 * scale), LINE * 100)),
+    'sync': lambda scale: open_session(LINE * int(100000 * scale)),
+    'cursor': lambda scale: (open_session(LINE * 100) +
+                             cursor(int(10000 * scale), LINE * 100)),
+    'substitute': lambda scale: (open_session(SCATTERED) +
+                                 substitute(SCATTERED, u'fox', u'cat', int(20 * scale))),
+    'batched': lambda scale: (open_session(LINE * 1000, users=8, segment=1024, batch=True) +
+                              concurrent(8, int(1000 * scale), LINE * 1000, batch=16)),
+}
@@ -2,17 +2,42 @@
 # -*- coding: utf-8 -*-
 
 """
-Temp file for launching twisted from command line.
-Not liking this
+Starts vobby straight on the reactor, without the overhead of twistd.  Vim can connect as
+soon as the port is listening, the connection to infinoted is opened at the same time and
+``twisted.words`` is only imported then.  Run ``./run.py --help`` for the options, or
+``twistd -ny vobby.tac`` for the twistd way.
 """
-from twisted.scripts.twistd import run
-from sys import argv
-import os
+import argparse
+import sys
+
 
 def main():
-    argv[1:] = ['-y', os.path.join(os.path.dirname(__file__), 'vobby.py')]
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=3219,
+                        help='the port Vim connects to with :nbstart')
+    parser.add_argument('--metrics-port', type=int, default=3220,
+                        help='the port serving the metrics as JSON, 0 for none')
+    parser.add_argument('--interface', default='localhost')
+    parser.add_argument('--infinoted', default=u'127.0.0.1:6523',
+                        help='host:port of the infinoted server')
+    parser.add_argument('--no-tls', dest='tls', action='store_false',
+                        help="don't insist on TLS, to use fake_infinoted.py")
+    parser.add_argument('--coalesce-window', type=float, default=0.05,
+                        help='seconds the edits from Vim are held to be merged, 0 for none')
+    args = parser.parse_args()
+
+    from twisted.internet import reactor
+    from twisted.python import log
+    from vobby import make_service
+
+    log.startLogging(sys.stdout)
+    top_service = make_service(args.port, args.metrics_port or None, args.interface,
+                               args.infinoted.decode('utf-8'), args.tls,
+                               args.coalesce_window)
+    reactor.callWhenRunning(top_service.startService)
+    reactor.addSystemEventTrigger('before', 'shutdown', top_service.stopService)
+    reactor.run()
 
-    run()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,107 @@
+"""
+A leaner parser for the ``<group>`` stanzas infinoted sends.
+
+Twisted builds a :class:`domish.Element` for every element of every stanza, and appends
+character data by concatenating strings, which copies a large ``sync-segment`` over and
+over as it arrives in pieces.  The ``<group>`` stanzas are instead parsed into
+:class:`Message` objects which only keep the names, attributes and text the handlers read,
+the text in pieces until it is asked for.  Every other stanza, the stream negotiation, is
+still parsed into :class:`domish.Element` objects for twisted.
+
+"""
+from twisted.words.protocols.jabber import xmlstream
+from twisted.words.xish import domish
+from xml.sax.saxutils import escape, quoteattr
+
+
+class Message(object):
+    """
+    An element of a ``<group>`` stanza, or the stanza itself.  Reads like the part of
+    :class:`domish.Element` the handlers use.
+    """
+    __slots__ = ('name', 'attributes', 'children', 'pieces', 'parent')
+
+    # Group stanzas are only ever in the default namespace of the stream.
+    uri = None
+
+    def __init__(self, name, attributes, parent=None):
+        self.name = name
+        self.attributes = attributes
+        self.children = []
+        self.pieces = []
+        self.parent = parent
+
+    def __getitem__(self, key):
+        return self.attributes[key]
+
+    def __unicode__(self):
+        if len(self.pieces) > 1:
+            self.pieces = [u''.join(self.pieces)]
+        return self.pieces[0] if self.pieces else u''
+
+    def getAttribute(self, key, default=None):
+        return self.attributes.get(key, default)
+
+    def hasAttribute(self, key):
+        return key in self.attributes
+
+    def elements(self):
+        return iter(self.children)
+
+    def firstChildElement(self):
+        return self.children[0] if self.children else None
+
+    def toXml(self):
+        attributes = u''.join([u' %s=%s' % (key, quoteattr(value))
+                               for key, value in sorted(self.attributes.items())])
+        content = escape(unicode(self)) + u''.join([child.toXml()
+                                                   for child in self.children])
+        return u'<%s%s>%s</%s>' % (self.name, attributes, content, self.name)
+
+
+class StanzaStream(domish.ExpatElementStream):
+    """
+    An element stream which hands ``<group>`` stanzas to :attr:`ElementEvent` as
+    :class:`Message` objects and everything else as :class:`domish.Element` objects.
+    """
+    def __init__(self):
+        domish.ExpatElementStream.__init__(self)
+        self.message = None
+
+    def _onStartElement(self, name, attrs):
+        if self.message is not None:
+            message = Message(name.rsplit(' ', 1)[-1], attrs, self.message)
+            self.message.children.append(message)
+            self.message = message
+        elif (self.currElem is None and self.documentStarted and
+              name.rsplit(' ', 1)[-1] == 'group'):
+            self.message = Message('group', attrs)
+            self.localPrefixes = {}
+        else:
+            domish.ExpatElementStream._onStartElement(self, name, attrs)
+
+    def _onEndElement(self, name):
+        message = self.message
+        if message is None:
+            domish.ExpatElementStream._onEndElement(self, name)
+        else:
+            self.message = message.parent
+            if message.parent is None:
+                self.ElementEvent(message)
+
+    def _onCdata(self, data):
+        if self.message is not None:
+            self.message.pieces.append(data)
+        else:
+            domish.ExpatElementStream._onCdata(self, data)
+
+
+class StanzaXmlStream(xmlstream.XmlStream):
+    """
+    An XMPP stream parsed with a :class:`StanzaStream`.
+    """
+    def _initializeStream(self):
+        self.stream = StanzaStream()
+        self.stream.DocumentStartEvent = self.onDocumentStart
+        self.stream.ElementEvent = self.onElement
+        self.stream.DocumentEndEvent = self.onDocumentEnd
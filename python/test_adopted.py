@@ -0,0 +1,187 @@
+"""
+Tests of the adOPTed algorithm, run with::
+
+    trial test_adopted
+"""
+import itertools
+import random
+
+from twisted.trial import unittest
+
+from adopted import NOOP, Algorithm, Delete, Insert, Move, Split, transform
+
+
+def random_operation(rand, text, deletes=0.4):
+    """An insert of one or two characters, or with odds `deletes` a delete of a few."""
+    if text and rand.random() < deletes:
+        position = rand.randint(0, len(text) - 1)
+        return Delete(position, min(rand.randint(1, 3), len(text) - position))
+    return Insert(rand.randint(0, len(text)), rand.choice([u'a', u'b', u'cd']))
+
+
+class Site(object):
+    """
+    The document of `user` with the :class:`Algorithm` to edit it, infinoted relays each
+    request to the other sites in the order it got them.
+    """
+
+    def __init__(self, user, users, text):
+        self.algorithm = Algorithm(user)
+        for other in users:
+            self.algorithm.set_user_vector(other, {})
+        self.text = text
+
+    def make(self, operation):
+        self.text = operation.apply(self.text)
+        return self.algorithm.user, self.algorithm.generate(operation), operation
+
+    def receive(self, request):
+        user, time, operation = request
+        self.text = self.algorithm.receive(user, time, operation).apply(self.text)
+
+
+class TransformTest(unittest.TestCase):
+
+    def assertTransformed(self, operation, against, expected):
+        self.assertEqual(repr(transform(operation, against, True)), repr(expected))
+
+    def test_insert_insert(self):
+        """Of two inserts at the same position the one which wins ends up first."""
+        self.assertEqual(transform(Insert(2, u'a'), Insert(2, u'b'), True).position, 2)
+        self.assertEqual(transform(Insert(2, u'a'), Insert(2, u'b'), False).position, 3)
+        self.assertTransformed(Insert(1, u'a'), Insert(2, u'bc'), Insert(1, u'a'))
+        self.assertTransformed(Insert(3, u'a'), Insert(2, u'bc'), Insert(5, u'a'))
+
+    def test_insert_delete(self):
+        """An insert into deleted text ends up where the text was."""
+        self.assertTransformed(Insert(1, u'x'), Delete(1, 4), Insert(1, u'x'))
+        self.assertTransformed(Insert(3, u'x'), Delete(1, 4), Insert(1, u'x'))
+        self.assertTransformed(Insert(5, u'x'), Delete(1, 4), Insert(1, u'x'))
+        self.assertTransformed(Insert(6, u'x'), Delete(1, 4), Insert(2, u'x'))
+
+    def test_delete_insert(self):
+        """A delete around an insert is split, the inserted text is kept."""
+        self.assertTransformed(Delete(1, 4), Insert(5, u'xy'), Delete(1, 4))
+        self.assertTransformed(Delete(1, 4), Insert(1, u'xy'), Delete(3, 4))
+        operation = transform(Delete(1, 4), Insert(3, u'xy'), True)
+        self.assertIsInstance(operation, Split)
+        self.assertEqual(operation.apply(u'abcxydefg'), u'axyfg')
+
+    def test_delete_delete(self):
+        """Overlapping deletes only delete what is left, nothing if it is all gone."""
+        self.assertTransformed(Delete(1, 4), Delete(3, 4), Delete(1, 2))
+        self.assertTransformed(Delete(3, 4), Delete(1, 4), Delete(1, 2))
+        self.assertTransformed(Delete(6, 2), Delete(1, 4), Delete(2, 2))
+        self.assertIs(transform(Delete(2, 2), Delete(1, 4), True), NOOP)
+        self.assertTransformed(Delete(1, 4), Delete(2, 2), Delete(1, 2))
+
+    def test_move(self):
+        """A caret moves with the text around it, text inserted at it goes in front."""
+        self.assertTransformed(Move(3, 2), Insert(3, u'xy'), Move(5, 2))
+        self.assertTransformed(Move(3, 2), Insert(4, u'xy'), Move(3, 4))
+        self.assertTransformed(Move(3, 2), Delete(1, 3), Move(1, 1))
+        self.assertIs(transform(Insert(1, u'x'), Move(0), True).__class__, Insert)
+
+    def test_tp1(self):
+        """Two concurrent operations transformed against each other give the same text."""
+        rand = random.Random(0)
+        for _ in range(2000):
+            text = u''.join(rand.choice(u'abc') for _ in range(rand.randint(0, 8)))
+            first = random_operation(rand, text)
+            second = random_operation(rand, text)
+            self.assertEqual(transform(second, first, False).apply(first.apply(text)),
+                             transform(first, second, True).apply(second.apply(text)),
+                             (text, first, second))
+
+
+class TranslateTest(unittest.TestCase):
+
+    def converge(self, users, seed, deletes):
+        """
+        Have `users` sites make requests while they only got some of the others', then
+        relay them the rest.
+
+        Returns:
+            set: The texts the sites end up with.
+        """
+        rand = random.Random(seed)
+        sites = [Site(user, range(1, users + 1), u'abcdef') for user in range(1, users + 1)]
+        relayed = []
+        received = [0] * users
+        for _ in range(60):
+            index = rand.randrange(users)
+            site = sites[index]
+            if rand.random() < 0.5:
+                relayed.append(site.make(random_operation(rand, site.text, deletes)))
+            elif received[index] < len(relayed):
+                request = relayed[received[index]]
+                received[index] += 1
+                if request[0] != site.algorithm.user:
+                    site.receive(request)
+        for index, site in enumerate(sites):
+            for request in relayed[received[index]:]:
+                if request[0] != site.algorithm.user:
+                    site.receive(request)
+        return set([site.text for site in sites])
+
+    def test_tp2(self):
+        """
+        An insert and the insert of another user after the text a third one deletes end up
+        in the order they were made in, whichever order they are relayed in.
+        """
+        for users in itertools.permutations([1, 2, 3]):
+            sites = [Site(user, [1, 2, 3], u'abc') for user in [1, 2, 3]]
+            operations = {1: Insert(2, u'x'), 2: Delete(1, 1), 3: Insert(1, u'y')}
+            requests = [sites[user - 1].make(operations[user]) for user in users]
+            for site in sites:
+                for request in requests:
+                    if request[0] != site.algorithm.user:
+                        site.receive(request)
+            self.assertEqual([site.text for site in sites], [u'ayxc'] * 3, users)
+
+    def test_concurrent(self):
+        """Two users inserting and deleting converge, however much they overlap."""
+        for seed in range(50):
+            self.assertEqual(len(self.converge(2, seed, 0.4)), 1, seed)
+
+    def test_concurrent_inserts(self):
+        """Any number of users inserting converge."""
+        for seed in range(50):
+            self.assertEqual(len(self.converge(4, seed, 0)), 1, seed)
+
+    def test_deep_concurrency(self):
+        """A request concurrent to more requests than Python recurses deep is translated."""
+        local = Algorithm(1)
+        local.set_user_vector(1, {})
+        local.set_user_vector(2, {})
+        for position in range(5000):
+            local.generate(Insert(position, u'x'))
+
+        operation = local.receive(2, '', Insert(1, u'y'))
+        self.assertEqual((operation.position, operation.text), (5001, u'y'))
+        operation = local.receive(2, '', Delete(0, 2))
+        self.assertEqual((operation.position, operation.length), (5000, 2))
+
+
+class CleanupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.algorithm = Algorithm(1, cleanup_interval=16)
+        self.algorithm.set_user_vector(1, {})
+
+    def test_alone(self):
+        """The log of a user alone in the session stays bounded."""
+        for position in range(20000):
+            self.algorithm.generate(Insert(position, u'x'))
+        self.assertTrue(len(self.algorithm.logs[1]) <= 16)
+
+    def test_offline(self):
+        """Offline the requests not acknowledged are kept, to be sent again."""
+        for position in range(100):
+            self.algorithm.generate(Insert(position, u'x'))
+        self.algorithm.acknowledge(100)
+        self.algorithm.offline = True
+        for position in range(100, 200):
+            self.algorithm.generate(Insert(position, u'x'))
+        self.assertEqual(self.algorithm.logs[1].begin, 100)
+        self.assertEqual(self.algorithm.logs[1].end(), 200)
@@ -0,0 +1,179 @@
+"""
+Tests of the coalescing of edits, run with::
+
+    trial test_coalescer
+"""
+import random
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from coalescer import EditQueue, OperationCoalescer, Splice
+
+
+def apply(text, edits):
+    for offset, length, inserted in edits:
+        text = text[:offset] + inserted + text[offset + length:]
+    return text
+
+
+def random_edit(rand, text):
+    """A triple inserting, deleting or replacing a few characters of `text`."""
+    offset = rand.randint(0, len(text))
+    length = rand.randint(0, min(3, len(text) - offset)) if rand.random() < 0.5 else 0
+    inserted = rand.choice([u'', u'x', u'yz']) if length else rand.choice([u'x', u'yz'])
+    return offset, length, inserted
+
+
+def splices(queue):
+    return [(splice.offset, splice.length, splice.text) for splice in queue.splices]
+
+
+class SpliceTest(unittest.TestCase):
+
+    def test_merge_insert(self):
+        """Inserts into or right next to the text of a splice are merged."""
+        splice = Splice(3, 2, u'ab')
+        self.assertTrue(splice.merge_insert(5, u'c'))
+        self.assertTrue(splice.merge_insert(3, u'd'))
+        self.assertTrue(splice.merge_insert(5, u'e'))
+        self.assertEqual((splice.offset, splice.length, splice.text), (3, 2, u'daebc'))
+        self.assertFalse(splice.merge_insert(2, u'f'))
+        self.assertFalse(splice.merge_insert(9, u'f'))
+
+    def test_merge_delete(self):
+        """Deletes touching a splice take out its text and grow what it removes."""
+        splice = Splice(3, 0, u'abc')
+        self.assertTrue(splice.merge_delete(4, 1))
+        self.assertEqual((splice.offset, splice.length, splice.text), (3, 0, u'ac'))
+        self.assertTrue(splice.merge_delete(1, 3))
+        self.assertEqual((splice.offset, splice.length, splice.text), (1, 2, u'c'))
+        self.assertTrue(splice.merge_delete(1, 4))
+        self.assertEqual((splice.offset, splice.length, splice.text), (1, 5, u''))
+        self.assertFalse(splice.merge_delete(2, 1))
+        self.assertTrue(splice.merge_delete(0, 1))
+        self.assertFalse(Splice(3, 0, u'abc').merge_delete(7, 1))
+
+
+class EditQueueTest(unittest.TestCase):
+
+    def test_compact(self):
+        """Edits compacted, however many, still turn the text before into the one after."""
+        rand = random.Random(0)
+        for _ in range(50):
+            before = after = u'0123456789' * 5
+            queue = EditQueue(lambda: before, limit=8)
+            for _ in range(rand.randint(1, 60)):
+                offset, length, inserted = random_edit(rand, after)
+                queue.delete(offset, length)
+                queue.insert(inserted, offset)
+                after = apply(after, [(offset, length, inserted)])
+                self.assertTrue(len(queue) <= 8)
+            self.assertEqual(apply(before, splices(queue)), after)
+
+    def test_transform(self):
+        """Concurrent edits and the edits held, transformed, give the same text."""
+        rand = random.Random(1)
+        for _ in range(200):
+            text = u'0123456789' * 2
+            held = remote = text
+            queue = EditQueue(lambda: remote)
+            for _ in range(rand.randint(1, 6)):
+                offset, length, inserted = random_edit(rand, held)
+                queue.delete(offset, length)
+                queue.insert(inserted, offset)
+                held = apply(held, [(offset, length, inserted)])
+            edits = []
+            for _ in range(rand.randint(1, 4)):
+                edits.append(random_edit(rand, remote))
+                remote = apply(remote, edits[-1:])
+
+            transformed = queue.transform(edits)
+            self.assertEqual(apply(held, transformed), apply(remote, splices(queue)))
+
+    def test_caret(self):
+        """A caret moves with the text the edits held insert and delete around it."""
+        queue = EditQueue(lambda: u'0123456789')
+        queue.insert(u'ab', 2)
+        queue.delete(6, 2)
+        self.assertEqual(queue.caret(8, 0), (8, 0))
+        self.assertEqual(queue.caret(5, 0), (6, 0))
+        self.assertEqual(queue.caret(5, 3), (6, 2))
+        self.assertEqual(queue.caret(1, 0), (1, 0))
+
+
+class OperationCoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.text = u'0123456789'
+        self.coalescer = OperationCoalescer(
+            lambda content, offset, name: self.sent.append(('insert', offset, content)),
+            lambda offset, length, name: self.sent.append(('delete', offset, length)),
+            lambda offset, length, content, name: self.sent.append(
+                ('replace', offset, length, content)),
+            0.05, self.clock,
+            move=lambda offset, selection, name: self.sent.append(('move', offset)),
+            text=lambda name: self.text)
+
+    def test_typing(self):
+        """Characters typed within the window are sent as one insert once it ends."""
+        for offset, character in enumerate(u'hello'):
+            self.coalescer.insert(character, offset + 2, 'a')
+            self.clock.advance(0.005)
+        self.assertEqual(self.sent, [])
+        self.clock.advance(0.03)
+        self.assertEqual(self.sent, [('insert', 2, u'hello')])
+
+    def test_not_contiguous(self):
+        """An edit elsewhere sends the pending one first."""
+        self.coalescer.insert(u'a', 2, 'a')
+        self.coalescer.insert(u'b', 8, 'a')
+        self.assertEqual(self.sent, [('insert', 2, u'a')])
+        self.coalescer.flush()
+        self.assertEqual(self.sent[1:], [('insert', 8, u'b')])
+
+    def test_replace(self):
+        """A delete followed by an insert at the same offset is sent as one replace."""
+        self.coalescer.delete(2, 3, 'a')
+        self.coalescer.insert(u'xy', 2, 'a')
+        self.coalescer.flush('a')
+        self.assertEqual(self.sent, [('replace', 2, 3, u'xy')])
+
+    def test_move(self):
+        """A move is sent once the caret rests, or not at all if an edit follows it."""
+        self.coalescer.move(4, 0, 'a')
+        self.coalescer.insert(u'x', 4, 'a')
+        self.clock.advance(1)
+        self.assertEqual(self.sent, [('insert', 4, u'x')])
+        self.coalescer.move(1, 0, 'a')
+        self.clock.advance(0.2)
+        self.assertEqual(len(self.sent), 1)
+        self.clock.advance(0.1)
+        self.assertEqual(self.sent[1:], [('move', 1)])
+
+    def test_pause(self):
+        """A paused buffer is sent nothing until resumed, the others go on as usual."""
+        self.coalescer.insert(u'a', 2, 'a')
+        self.coalescer.pause(['a'])
+        self.coalescer.insert(u'b', 3, 'a')
+        self.coalescer.insert(u'c', 8, 'a')
+        self.coalescer.insert(u'd', 0, 'b')
+        self.clock.advance(1)
+        self.coalescer.flush(held=False)
+        self.assertEqual(self.sent, [('insert', 0, u'd')])
+        self.coalescer.resume(['a'])
+        self.assertEqual(self.sent[1:], [('insert', 2, u'ab'), ('insert', 8, u'c')])
+
+    def test_transform(self):
+        """Remote edits to a paused buffer are transformed against the edits held."""
+        self.coalescer.pause(['a'])
+        self.coalescer.insert(u'ab', 2, 'a')
+        self.text = u'XY0123456789'
+        self.assertEqual(self.coalescer.transform('a', [(0, 0, u'XY')]), [(0, 0, u'XY')])
+        self.text = u'XY012Z3456789'
+        self.assertEqual(self.coalescer.transform('a', [(5, 0, u'Z')]), [(7, 0, u'Z')])
+        self.assertEqual(self.coalescer.transform('b', [(3, 0, u'Z')]), [(3, 0, u'Z')])
+        self.coalescer.resume(['a'])
+        self.assertEqual(self.sent, [('insert', 4, u'ab')])
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the diff of texts, run with::
+
+    trial test_diff
+"""
+import random
+
+from twisted.trial import unittest
+
+from diff import difference, matching_lines, splices
+
+
+def apply(text, edits):
+    for offset, length, inserted in edits:
+        text = text[:offset] + inserted + text[offset + length:]
+    return text
+
+
+def random_text(rand, lines):
+    return u''.join([u''.join([rand.choice(u'abé ') for _ in range(rand.randint(0, 6))]) +
+                     u'\n' for _ in range(lines)])
+
+
+def random_edit(rand, text):
+    """Replace, add or remove a few lines of `text`, or a few characters in one."""
+    lines = text.splitlines(True)
+    start = rand.randint(0, len(lines))
+    end = min(len(lines), start + rand.randint(0, 3))
+    if lines and rand.random() < 0.3:
+        start = min(start, len(lines) - 1)
+        line = lines[start]
+        offset = rand.randint(0, len(line) - 1)
+        lines[start] = line[:offset] + rand.choice([u'', u'x', u'yö']) + line[offset + 1:]
+    else:
+        lines[start:end] = random_text(rand, rand.randint(0, 3)).splitlines(True)
+    return u''.join(lines)
+
+
+class DifferenceTest(unittest.TestCase):
+
+    def test_difference(self):
+        """The replacement only covers what is between the common prefix and suffix."""
+        self.assertEqual(difference(u'abcdef', u'abXYef'), (2, 2, u'XY'))
+        self.assertEqual(difference(u'abc', u'abc'), (3, 0, u''))
+        self.assertEqual(difference(u'', u'abc'), (0, 0, u'abc'))
+        self.assertEqual(difference(u'abc', u''), (0, 3, u''))
+
+    def test_overlap(self):
+        """A prefix and suffix which overlap in the shorter text only count once."""
+        self.assertEqual(difference(u'aaa', u'aa'), (2, 1, u''))
+        self.assertEqual(difference(u'abab', u'ababab'), (4, 0, u'ab'))
+
+    def test_matching_lines(self):
+        """Runs of equal lines are found in order, unless too many lines differ."""
+        old = [u'a', u'b', u'c', u'd', u'e']
+        new = [u'a', u'x', u'c', u'd', u'y', u'e']
+        self.assertEqual(matching_lines(old, new), [(0, 0, 1), (2, 2, 2), (4, 5, 1)])
+        self.assertEqual(matching_lines(old, old), [(0, 0, 5)])
+        self.assertEqual(matching_lines([], new), [])
+        self.assertIsNone(matching_lines(old, new, max_cost=2))
+
+
+class SplicesTest(unittest.TestCase):
+
+    def test_equal(self):
+        """Equal texts need no edits."""
+        self.assertEqual(splices(u'abc\n', u'abc\n'), [])
+
+    def test_regions(self):
+        """Regions far apart are edited apart, close ones as one."""
+        old = u''.join([u'line %d\n' % line for line in range(100)])
+        new = old.replace(u'line 10\n', u'line ten\n').replace(u'line 90\n', u'')
+        # the second one is after the character ten added, from the newline before
+        self.assertEqual(splices(old, new), [(old.index(u'10'), 2, u'ten'),
+                                             (old.index(u'\nline 90') + 1, 8, u'')])
+        edits = splices(old, old.replace(u'line 10', u'l').replace(u'line 12', u'l'))
+        self.assertEqual(len(edits), 1)
+
+    def test_offsets(self):
+        """The offset of each edit is in the text with the edits before it made."""
+        old = u'a\nb\nc\nd\n' * 40
+        new = u'x\n' + old[:100] + u'yy\n' + old[100:]
+        edits = splices(old, new, merge_gap=0)
+        self.assertEqual(edits, [(0, 0, u'x\n'), (101, 0, u'\nyy')])
+        self.assertEqual(apply(old, edits), new)
+
+    def test_round_trip(self):
+        """Applying the splices of two texts to the first one gives the second one."""
+        rand = random.Random(0)
+        for _ in range(300):
+            old = random_text(rand, rand.randint(0, 30))
+            new = old
+            for _ in range(rand.randint(1, 5)):
+                new = random_edit(rand, new)
+            for merge_gap in (0, 8, 128):
+                edits = splices(old, new, merge_gap=merge_gap)
+                self.assertEqual(apply(old, edits), new)
+                offsets = [offset for offset, _, _ in edits]
+                self.assertEqual(offsets, sorted(offsets))
+            self.assertEqual(apply(old, splices(old, new, max_cost=1)), new)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the rope document, run with::
+
+    trial test_document
+"""
+import random
+
+from twisted.trial import unittest
+
+from document import Document, FenwickTree
+
+
+class SmallDocument(Document):
+    """Chunks of a few characters, so every edit is near a boundary between them."""
+    CHUNK_SIZE = 4
+
+
+class FenwickTreeTest(unittest.TestCase):
+
+    def test_find(self):
+        """The running sum reaching a value is found in the first count it reaches."""
+        tree = FenwickTree([3, 0, 2, 5])
+        self.assertEqual(tree.find(0), (0, 0))
+        self.assertEqual(tree.find(3), (0, 3))
+        self.assertEqual(tree.find(4), (2, 1))
+        self.assertEqual(tree.find(10), (3, 5))
+
+    def test_splice(self):
+        """Splicing in the middle and at the end gives the same sums as building anew."""
+        tree = FenwickTree([1, 2, 3, 4, 5])
+        tree.splice(1, 3, [7])
+        tree.splice(4, 4, [6, 8, 9])
+        tree.splice(6, 7, [])
+        counts = [1, 7, 4, 5, 6, 8]
+        self.assertEqual(tree.counts, counts)
+        for index in range(len(counts) + 1):
+            self.assertEqual(tree.prefix(index), sum(counts[:index]))
+
+
+class DocumentTest(unittest.TestCase):
+
+    def assertDocument(self, document, text):
+        self.assertEqual(unicode(document), text)
+        self.assertEqual(len(document), len(text))
+        self.assertEqual(document.lines(), text.count(u'\n') + 1)
+        self.assertEqual(document.text(), text)
+        self.assertEqual(document.byte_offset(len(text)), len(text.encode('utf-8')))
+
+    def test_insert_boundary(self):
+        """An insert at the boundary of two chunks goes between them."""
+        document = SmallDocument(u'abcdefgh')
+        self.assertEqual(document.chunks, [u'abcd', u'efgh'])
+        document.insert(u'xy', 4)
+        self.assertDocument(document, u'abcdxyefgh')
+        document.insert(u'z', 0)
+        document.insert(u'!', len(document))
+        self.assertDocument(document, u'zabcdxyefgh!')
+
+    def test_insert_split(self):
+        """A chunk grown past twice the size is split up."""
+        document = SmallDocument(u'abcd')
+        document.insert(u'0123456789', 2)
+        self.assertDocument(document, u'ab0123456789cd')
+        self.assertTrue(max(len(chunk) for chunk in document.chunks) <= 8)
+
+    def test_delete_across(self):
+        """A delete from the middle of one chunk to the middle of another."""
+        document = SmallDocument(u'abcdefghijkl')
+        document.delete(2, 7)
+        self.assertDocument(document, u'abjkl')
+        self.assertEqual(document.text(1, 3), u'bjk')
+
+    def test_delete_chunk(self):
+        """A delete of exactly one chunk, or all of them, leaves no empty chunks behind."""
+        document = SmallDocument(u'abcdefghijkl')
+        document.delete(4, 4)
+        self.assertDocument(document, u'abcdijkl')
+        self.assertNotIn(u'', document.chunks)
+        document.delete(0, len(document))
+        self.assertDocument(document, u'')
+        document.insert(u'x', 0)
+        self.assertDocument(document, u'x')
+
+    def test_outside(self):
+        """Edits and offsets past the end are refused."""
+        document = SmallDocument(u'abcdef')
+        self.assertRaises(ValueError, document.insert, u'x', 7)
+        self.assertRaises(ValueError, document.delete, 4, 3)
+        self.assertRaises(ValueError, document.delete, -1, 1)
+        self.assertRaises(ValueError, document.text, 5, 2)
+        self.assertRaises(ValueError, document.char_offset, 7)
+        self.assertRaises(ValueError, document.line_offset, 1)
+        self.assertDocument(document, u'abcdef')
+
+    def test_byte_offsets(self):
+        """Characters and UTF-8 bytes translate both ways, in and across chunks."""
+        text = u'aöbc€dé\nfg'
+        document = SmallDocument(text)
+        for offset in range(len(text) + 1):
+            byte = len(text[:offset].encode('utf-8'))
+            self.assertEqual(document.byte_offset(offset), byte)
+            self.assertEqual(document.char_offset(byte), offset)
+        # in the middle of the two bytes of the ö
+        self.assertEqual(document.char_offset(2), 1)
+
+    def test_lines(self):
+        """Lines are found across chunks, a newline at the end starts an empty one."""
+        text = u'ab\ncdefg\n\nhi\n'
+        document = SmallDocument(text)
+        self.assertEqual(document.lines(), 5)
+        self.assertEqual([document.line_offset(line) for line in range(5)],
+                         [0, 3, 9, 10, 13])
+        self.assertEqual(document.line_column(7), (1, 4))
+        self.assertEqual(document.line_column(13), (4, 0))
+
+    def test_random(self):
+        """Random edits keep the document, its offsets and lines the same as a string."""
+        rand = random.Random(0)
+        text = u''
+        document = SmallDocument()
+        for _ in range(2000):
+            if text and rand.random() < 0.45:
+                offset = rand.randint(0, len(text) - 1)
+                length = rand.randint(0, min(12, len(text) - offset))
+                document.delete(offset, length)
+                text = text[:offset] + text[offset + length:]
+            else:
+                offset = rand.randint(0, len(text))
+                content = u''.join([rand.choice(u'ab\né€')
+                                    for _ in range(rand.randint(0, 12))])
+                document.insert(content, offset)
+                text = text[:offset] + content + text[offset:]
+
+            offset = rand.randint(0, len(text))
+            length = rand.randint(0, len(text) - offset)
+            self.assertEqual(document.text(offset, length), text[offset:offset + length])
+            byte = len(text[:offset].encode('utf-8'))
+            self.assertEqual(document.byte_offset(offset), byte)
+            self.assertEqual(document.char_offset(byte), offset)
+            line = text.count(u'\n', 0, offset)
+            self.assertEqual(document.line_column(offset),
+                             (line, offset - (text.rfind(u'\n', 0, offset) + 1)))
+        self.assertDocument(document, text)
@@ -0,0 +1,31 @@
+"""
+Tests of the pool of infinoted connections, run with::
+
+    trial test_pool
+"""
+from twisted.trial import unittest
+
+from pool import ConnectionPool
+
+
+class ResolveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool(None, u'127.0.0.1:6523')
+        self.default, self.other = object(), object()
+        self.pool.add(self.default)
+        self.pool.add(self.other, u'example.com:6524')
+
+    def test_path(self):
+        self.assertEqual(self.pool.resolve(u'dir/a.txt'), (self.default, u'dir/a.txt'))
+
+    def test_address(self):
+        self.assertEqual(self.pool.resolve(u'example.com:6524/dir/a.txt'),
+                         (self.other, u'dir/a.txt'))
+
+    def test_colon_in_name(self):
+        """A colon followed by something other than a port is part of the name."""
+        self.assertEqual(self.pool.resolve(u'notes:todo.txt'),
+                         (self.default, u'notes:todo.txt'))
+        self.assertEqual(self.pool.resolve(u'notes:/todo.txt'),
+                         (self.default, u'notes:/todo.txt'))
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests replaying sessions through both protocols, run with::
+
+    trial test_replay
+"""
+import random
+import re
+
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from adopted import Algorithm
+from replay import LINE, Replay, concurrent, open_session, rejoin_session, typing
+from vimbeans import parse_args, quote
+
+FUNCTION = re.compile(r'(\d+):(\w+)/\d+ ?(.*)$')
+
+
+class Vim(object):
+    """
+    The text of buffer 1 as Vim has it, from the inserts and removes written to it, and
+    edits to it made the way Vim reports them.
+
+    Args:
+        transport (StringTransport): The transport of the Vim connection.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.text = ''
+        self.seqno = 0
+
+    def read(self):
+        """Apply the functions written to the transport since the last read."""
+        for line in self.transport.value().split('\n'):
+            match = FUNCTION.match(line)
+            if match is None or match.group(1) != '1':
+                continue
+            name, args = match.group(2), parse_args(match.group(3))
+            if name == 'insert':
+                self.text = self.text[:args[0]] + args[1] + self.text[args[0]:]
+            elif name == 'remove':
+                self.text = self.text[:args[0]] + self.text[args[0] + args[1]:]
+        self.transport.clear()
+
+    def edit(self, rand):
+        """
+        Insert or remove a few characters at random.
+
+        Returns:
+            str: The event telling about the edit.
+        """
+        text = self.text.decode('utf-8')
+        self.seqno += 1
+        if text and rand.random() < 0.3:
+            offset = rand.randint(0, len(text) - 1)
+            removed = text[offset:offset + rand.randint(1, 3)]
+            self.text = (text[:offset] + text[offset + len(removed):]).encode('utf-8')
+            return '1:remove=%d %d %d\n' % (self.seqno, len(text[:offset].encode('utf-8')),
+                                            len(removed.encode('utf-8')))
+        offset = rand.randint(0, len(text))
+        inserted = rand.choice([u'k', u'\xe9\xe9', u'xy\n'])
+        self.text = (text[:offset] + inserted + text[offset:]).encode('utf-8')
+        return '1:insert=%d %d %s\n' % (self.seqno, len(text[:offset].encode('utf-8')),
+                                        quote(inserted.encode('utf-8')))
+
+
+class ReplayTest(unittest.TestCase):
+
+    def document(self, replay):
+        return unicode(replay.infinoted.buffers[u'shared.txt'].document)
+
+    def test_batched_groups(self):
+        """Sync messages and requests sent in one group are all handled, in order."""
+        text = LINE * 50
+        documents = []
+        for batch in (1, 8):
+            replay = Replay()
+            replay.run(open_session(text, users=4, segment=256, batch=batch > 1))
+            self.assertEqual(self.document(replay), text)
+            replay.run(concurrent(4, 200, text, batch=batch))
+            self.assertTrue(replay.converged())
+            documents.append(self.document(replay))
+        self.assertEqual(documents[0], documents[1])
+
+    def test_edits_before_joining(self):
+        """Edits made during the sync and before we joined are held until then."""
+        text = LINE * 20
+        replay = Replay()
+        messages = open_session(text, segment=256)
+        join = messages.pop()
+        replay.run(messages[:-3])
+        replay.run([('vim', '1:insert=1 0 "x"\n')])
+        replay.run(messages[-3:])
+        replay.run([('vim', '1:insert=2 %d "y"\n' % len(LINE.encode('utf-8')))])
+        session = replay.infinoted.buffers[u'shared.txt']
+        self.assertEqual(unicode(session.document), text)
+        replay.run([join, ('vim', '1:insert=3 0 "z"\n')])
+        self.assertNotIn(None, session.algorithm.logs)
+        self.assertEqual(self.document(replay), u'zx' + LINE[:-1] + u'y' + LINE[-1:] +
+                         LINE * 19)
+        self.assertTrue(replay.converged())
+
+    def test_key_command_failing(self):
+        """A key command which fails is reported in Vim, which stays connected."""
+        replay = Replay(vim_transport=StringTransport)
+        replay.run(open_session(LINE))
+        replay.run([('vim', '0:keyCommand=1 "VobbyOpen notes:todo.txt"\n')])
+
+        def open_document(location):
+            raise ValueError('no such server')
+        self.patch(replay.service, 'open_document', open_document)
+        replay.run([('vim', '0:keyCommand=2 "VobbyOpen example.com:x/a.txt"\n')])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertIn('"VobbyOpen example.com:x/a.txt: no such server\\n"',
+                      replay.vim.transport.value())
+
+    def test_vim_stall(self):
+        """Edits made in Vim while it stalls are transformed against the held ones."""
+        rand = random.Random(0)
+        text = LINE * 20
+        replay = Replay(vim_transport=StringTransport)
+        vim = Vim(replay.vim.transport)
+        replay.run(open_session(text, users=4))
+        vim.read()
+        replay.vim.pauseProducing()
+        for source, data in concurrent(4, 300, text):
+            replay.feed(source, data)
+            replay.clock.advance(0.01)
+            if rand.random() < 0.5:
+                replay.feed('vim', vim.edit(rand))
+                replay.clock.advance(0.01)
+        self.assertEqual(replay.vim.transport.value(), '')
+        replay.vim.resumeProducing()
+        replay.clock.advance(1)
+        vim.read()
+        self.assertEqual(vim.text.decode('utf-8'), self.document(replay))
+        self.assertTrue(replay.converged())
+
+    def test_latency_to_vim(self):
+        """The latency of a request to Vim lasts until it is written to Vim."""
+        text = LINE * 20
+        replay = Replay()
+        replay.service.metrics.clock = replay.clock.seconds
+        replay.run(open_session(text, users=4))
+        replay.vim.pauseProducing()
+        replay.run(concurrent(4, 10, text))
+        replay.clock.advance(2)
+        replay.vim.resumeProducing()
+        latency = replay.service.metrics.histograms['latency.infinoted_to_vim']
+        self.assertTrue(latency.maximum >= 2)
+        self.assertTrue(replay.converged())
+
+    def test_vim_stall_sync(self):
+        """A large sync while Vim stalls is only read as fast as Vim takes it."""
+        text = LINE * 40000
+        replay = Replay()
+        commands = replay.vim.commands
+        replay.vim.pauseProducing()
+        queued = 0
+        for source, data in open_session(text):
+            replay.feed(source, data)
+            replay.clock.advance(0.01)
+            queued = max(queued, commands.size)
+        self.assertTrue(replay.unread)
+        self.assertTrue(queued < commands.high_water + 64 * 1024)
+        replay.vim.resumeProducing()
+        replay.read()
+        replay.clock.advance(1)
+        self.assertEqual(self.document(replay), text)
+        self.assertTrue(replay.converged())
+
+    def test_infinoted_stall(self):
+        """Edits made in Vim while infinoted stalls are held rather than queued."""
+        rand = random.Random(1)
+        text = LINE * 20
+        replay = Replay(vim_transport=StringTransport)
+        vim = Vim(replay.vim.transport)
+        replay.run(open_session(text, users=4))
+        vim.read()
+        replay.infinoted.pauseProducing()
+        for source, data in concurrent(4, 200, text):
+            replay.feed(source, data)
+            replay.clock.advance(0.01)
+            vim.read()
+            replay.feed('vim', vim.edit(rand))
+            replay.clock.advance(0.01)
+            vim.read()
+        self.assertEqual(replay.infinoted.pipeline.queued, 0)
+        replay.infinoted.resumeProducing()
+        replay.clock.advance(1)
+        vim.read()
+        self.assertEqual(vim.text.decode('utf-8'), self.document(replay))
+        self.assertTrue(replay.converged())
+
+    def test_resume(self):
+        """Edits made alone while offline, more than a cleanup keeps, are all resent."""
+        text = LINE * 20
+        replay = Replay()
+        replay.run(open_session(text, users=0))
+        replay.disconnect()
+        replay.run(typing(100, offset=5), tick=0.1)
+        replay.connect()
+        replay.run(rejoin_session(text))
+        self.assertEqual(replay.service.metrics.counters.get('infinoted.resent'), 100)
+        self.assertEqual(len(self.document(replay)), len(text) + 100)
+        self.assertTrue(replay.converged())
+
+    def test_log_bounded(self):
+        """The log of a user alone in the session is cleaned up, while online."""
+        replay = Replay()
+        replay.run(open_session(LINE * 20, users=0))
+        replay.run(typing(1000, offset=5), tick=0.1)
+        algorithm = replay.infinoted.buffers[u'shared.txt'].algorithm
+        self.assertEqual(algorithm.current[1], 1000)
+        self.assertTrue(len(algorithm.logs[1]) <= algorithm.cleanup_interval)
+
+    def test_resume_failing(self):
+        """Edits which fail to be sent again are dropped, Vim gets what infinoted has."""
+        text = LINE * 20
+        replay = Replay()
+        replay.run(open_session(text, users=0))
+        replay.disconnect()
+        replay.run(typing(10, offset=5), tick=0.1)
+        replay.connect()
+
+        def receive(algorithm, user, time, operation):
+            raise RuntimeError('maximum recursion depth exceeded')
+        self.patch(Algorithm, 'receive', receive)
+        replay.run(rejoin_session(text))
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+        session = replay.infinoted.buffers[u'shared.txt']
+        self.assertIsNone(session.previous)
+        self.assertIs(replay.infinoted.sessions[u'InfSession_1'], session)
+        self.assertEqual(self.document(replay), text)
+        self.assertTrue(replay.converged())
+        replay.run([('vim', '1:insert=20 0 "x"\n')])
+        self.assertEqual(self.document(replay), u'x' + text)
+        self.assertEqual(len(session.algorithm.logs[1]), 1)
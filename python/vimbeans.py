@@ -1,66 +1,532 @@
 """
 This handles communicating with Vim through the netbeans interface.
 """
-from twisted.internet.protocol import Protocol, ServerFactory
+import re
+
+from zope.interface import implementer
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import ServerFactory
 from twisted.python import log
 
+from buffers import BufferRegistry
+from carets import CaretAnnotations
+from coalescer import EditQueue
+from diff import splices
+
+
+# Editor to IDE messages, events are ``bufID:name=seqno args`` and replies to functions are
+# ``seqno args``.
+EVENT = re.compile(r'(\d+):(\w+)=(\d+) ?(.*)$')
+REPLY = re.compile(r'(\d+) ?(.*)$')
+
+# A netbeans argument is either a quoted string or a run of non space characters, numbers,
+# booleans (T/F) and positions (lnum/col) all fall into the latter.
+ARGUMENT = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+ESCAPE = re.compile(r'\\(.)')
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '\\': '\\', '"': '"'}
+
+
+def unescape(text):
+    """
+    Unescape the contents of a netbeans quoted string, the surrounding quotes should
+    already be removed.
+    """
+    if '\\' not in text:
+        return text
+    return ESCAPE.sub(lambda match: ESCAPES.get(match.group(1), match.group(1)), text)
+
+
+def quote(text):
+    """
+    Quote `text` as a netbeans string argument.
+    """
+    return '"' + (text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                  .replace('\t', '\\t').replace('\r', '\\r')) + '"'
+
+
+def parse_args(text):
+    """
+    Split the arguments of a netbeans message into a list.  Quoted strings are unescaped,
+    numbers are converted to ints and everything else is left as is.
+
+    Args:
+        text (string): The portion of the message after the ``seqno``.
+
+    Returns:
+        list: The parsed arguments.
+
+    Example:
+        >>> parse_args('12 "hello world" T')
+        [12, 'hello world', 'T']
+
+    """
+    args = []
+    for quoted, bare in ARGUMENT.findall(text):
+        if bare:
+            args.append(int(bare) if bare.isdigit() else bare)
+        else:
+            args.append(unescape(quoted))
+    return args
+
+
+def format_arg(arg):
+    """
+    Format one argument of an IDE to editor message.  Strings are quoted, booleans become
+    ``T``/``F`` and anything else is written as is.
+    """
+    if isinstance(arg, bool):
+        return 'T' if arg else 'F'
+    if isinstance(arg, unicode):
+        return quote(arg.encode('utf-8'))
+    if isinstance(arg, basestring):
+        return quote(arg)
+    return str(arg)
+
+
+class CommandQueue(object):
+    """
+    Collects the commands and functions sent to Vim and writes them all in one
+    ``writeSequence`` at the end of the reactor tick, so a burst of remote edits costs one
+    syscall instead of one per edit.
+
+    Every message is given the next sequence number, functions remember theirs so the
+    reply can be matched up.  Between :meth:`pause` and :meth:`resume` nothing is written,
+    once more than `high_water` bytes are queued meanwhile `backlogged` is told to stop
+    reading what would be sent to Vim until they are.
+
+    Args:
+        transport (ITransport): The transport connected to Vim.
+
+    Kwargs:
+        clock (IReactorTime): Used to schedule the flush.
+        limit (int): Write right away once this many bytes are queued, so a large sync
+                     doesn't pile up in memory until the end of the tick.
+        high_water (int): How many bytes are queued while paused before `backlogged` is
+                          called.
+        tracer (Tracer): Records every message sent.
+        metrics (Metrics): Counts the bytes and writes sent, and records the high-water
+                           mark of the messages queued.
+        backlogged (callable): Called with True once `high_water` is passed while paused,
+                               and with False once the messages queued are written.
+
+    """
+    def __init__(self, transport, clock=reactor, limit=256 * 1024, high_water=1024 * 1024,
+                 tracer=None, metrics=None, backlogged=None):
+        self.transport = transport
+        self.clock = clock
+        self.limit = limit
+        self.high_water = high_water
+        self.tracer = tracer
+        self.metrics = metrics
+        self.backlogged = backlogged
+        self.seqno = 0
+        self.functions = {}
+        self.pending = []
+        self.size = 0
+        self.paused = False
+        self.full = False
+        self.started = None
+        self.call = None
+
+    def command(self, bufid, name, *args):
+        """
+        Queue the command `name` for buffer `bufid`, ``bufID:name!seqno args``.
+
+        Returns:
+            int: The sequence number used.
+        """
+        return self._queue(bufid, name, '!', args)
+
+    def function(self, bufid, name, *args):
+        """
+        Queue the function `name` for buffer `bufid`, ``bufID:name/seqno args``.  Vim will
+        reply with the returned sequence number.
+
+        Returns:
+            int: The sequence number used.
+        """
+        seqno = self._queue(bufid, name, '/', args)
+        self.functions[seqno] = name
+        return seqno
+
+    def reply(self, seqno, args):
+        """
+        Match up a reply from Vim with the function that was sent.
+
+        Returns:
+            string: The name of the function, None if it wasn't one of ours.
+        """
+        name = self.functions.pop(seqno, None)
+        if name is not None and args.startswith('!'):
+            log.msg('Vim failed %s/%d: %s' % (name, seqno, args[1:]))
+        return name
+
+    def mark(self, start):
+        """
+        Record the latency from `start`, as given by :meth:`Metrics.now`, as
+        ``latency.infinoted_to_vim`` once what is queued now, or held while paused, is
+        written.
+        """
+        if self.started is None and (self.pending or self.paused):
+            self.started = start
+
+    def pause(self):
+        """
+        Stop writing, the transport has more to write than Vim reads.
+        """
+        self.paused = True
+
+    def resume(self):
+        """
+        Write everything queued while paused.
+        """
+        self.paused = False
+        self.flush()
 
-class VimBeansProtocol(Protocol):
+    def flush(self):
+        """
+        Write everything queued so far to Vim, unless paused.
+        """
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+        if self.pending and not self.paused:
+            pending, self.pending = self.pending, []
+            size, self.size = self.size, 0
+            started, self.started = self.started, None
+            self.transport.writeSequence(pending)
+            if self.metrics is not None:
+                self.metrics.count('vim.bytes_out', size)
+                self.metrics.count('vim.writes')
+                self.metrics.since('latency.infinoted_to_vim', started)
+            if self.full:
+                self.full = False
+                if self.backlogged is not None:
+                    self.backlogged(False)
+
+    def _queue(self, bufid, name, separator, args):
+        self.seqno += 1
+        message = '%d:%s%s%d' % (bufid, name, separator, self.seqno)
+        if args:
+            message += ' ' + ' '.join([format_arg(arg) for arg in args])
+        if self.tracer is not None:
+            self.tracer.record('vim', '>', message)
+        message += '\n'
+        self.pending.append(message)
+        self.size += len(message)
+        if self.metrics is not None:
+            self.metrics.peak('vim.commands', len(self.pending))
+
+        if self.paused:
+            if self.size >= self.high_water and not self.full:
+                self.full = True
+                if self.backlogged is not None:
+                    self.backlogged(True)
+            return self.seqno
+        if self.size >= self.limit:
+            self.flush()
+        elif self.call is None:
+            self.call = self.clock.callLater(0, self.flush)
+        return self.seqno
+
+
+@implementer(IPushProducer)
+class VimBeansProtocol(LineOnlyReceiver):
     """
     This class implememnts the protocol of sending and recieving messages through Vims
     Netbeans interface.
+
+    Vim sends newline terminated messages which may be split or coalesced arbitrarily
+    across reads, so the framing is left to :class:`LineOnlyReceiver` and each complete
+    message is dispatched through the :attr:`events` table.  Everything sent back goes
+    through the :class:`CommandQueue` in :attr:`commands`, the carets of the other users
+    through the :class:`CaretAnnotations` in :attr:`carets`.
+
+    Buffers are looked up in the :class:`BufferRegistry` of this connection,
+    :attr:`buffers`, as every Vim connected to the service numbers its buffers itself.
+    Vim gives offsets in bytes of UTF-8 while the rest of the bridge uses characters, so
+    the document of each buffer mirrors it to translate between the two as edits go by.
+
+    The edits in one read from the socket are only passed on once all of it was dispatched.
+    More than :attr:`BULK_EDITS` of them to a buffer, as for a paste or a ``:%s``, are
+    replaced by the :func:`diff.splices` of the buffer before and after the read.
+
+    The protocol is the producer of what is written to Vim, registered by the service.
+    While Vim reads slower than it is sent to, the remote edits for each buffer are held
+    in an :class:`EditQueue` in :attr:`held`, which compacts them once there are too many,
+    and sent with the rest of the commands once Vim caught up.  The sync and the other
+    commands can't be compacted, once too many of them are queued the service stops
+    reading from infinoted until they are written.
     """
 
+    delimiter = '\n'
+
+    # Pastes are sent as one insert, so allow for much longer lines than the default.
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    # The most characters sent in one insert while synchronizing.
+    SYNC_CHUNK = 16 * 1024
+
+    # The most edits to a buffer in one read which are passed on as they are.
+    BULK_EDITS = 8
+
     def __init__(self, service):
         """
         Args:
             service (VobbyService):  This will be the object to communicate back and forth
                                      between the Vim protocol and the infinoted protocol.
         """
-        self.bufid = 0
-        self.files = {}
         self.service = service
-        self.service.add_protocol(self)
+        self.buffers = BufferRegistry()
+        self.tracer = service.tracer
+        self.events = {
+            'fileOpened': self.file_opened,
+            'insert': self.event_insert,
+            'remove': self.event_remove,
+            'keyCommand': self.key_command,
+            'newDotAndMark': self.new_dot_and_mark,
+        }
+        self.commands = None
+        self.carets = None
+        self.reading = None
+        self.moved = {}
+        self.paused = False
+        self.held = {}
+
+    def connectionMade(self):
+        self.commands = CommandQueue(
+            self.transport, self.service.clock, tracer=self.tracer,
+            metrics=self.service.metrics,
+            backlogged=lambda full: self.service.vim_backlogged(self, full))
+        self.carets = CaretAnnotations(self.commands, self.buffers, self.service.clock,
+                                       metrics=self.service.metrics)
+        self.service.vim_connected(self)
 
     def dataReceived(self, data):
         """
-        This will parse the netbeans messages from the Vim instance and take appropriate
-        action.
-
+        Dispatch the messages in `data`, holding back the edits until all of them were.
+        """
+        self.reading = {}
+        self.moved = {}
+        try:
+            return LineOnlyReceiver.dataReceived(self, data)
+        finally:
+            reading, self.reading = self.reading, None
+            for buffer, (edits, before) in reading.items():
+                self.send_edits(buffer, edits, before)
+            for buffer, (offset, selection) in self.moved.items():
+                if buffer in self.held:
+                    offset, selection = self.held[buffer].caret(offset, selection)
+                self.service.caret_gobby(offset, selection, buffer.name)
+
+    def lineReceived(self, line):
+        """
+        Dispatch one complete netbeans message.
         """
-        log.msg('Recieved data %s' % (data))
+        self.tracer.record('vim', '<', line)
+        self.service.metrics.count('vim.bytes_in', len(line) + 1)
+        match = EVENT.match(line)
+        if match is None:
+            reply = REPLY.match(line)
+            if reply is not None:
+                self.commands.reply(int(reply.group(1)), reply.group(2))
+
+            # ``AUTH`` and ``DISCONNECT`` don't need handling yet.
+            return
 
-        # TODO probably need a smarter approach, but for now hard code the decision here.
+        bufid, name, seqno, args = match.groups()
+        handler = self.events.get(name)
+        if handler is not None:
+            handler(int(bufid), int(seqno), parse_args(args))
 
-        # Handle non buffer specific commands
-        if data.startswith('0'):
-            data = data[2:]
-            # A new Vim buffer has been opened
-            if data.startswith('fileOpened'):
-                self.watchFile(data.split()[1])
+    def file_opened(self, bufid, seqno, args):
+        """
+        A new Vim buffer has been opened, ``0:fileOpened=0 "pathName" open modified``.
+        """
+        self.watchFile(args[0])
 
+    def event_insert(self, bufid, seqno, args):
+        """
+        Text was inserted into a Vim buffer, ``bufID:insert=seqno off text``.
+        """
+        buffer = self.buffers.get(bufid)
+        if buffer is not None:
+            buffer.seqno = seqno
+            offset, content = args
+            content = content.decode('utf-8', 'replace')
+            try:
+                offset = buffer.document.char_offset(offset)
+            except ValueError:
+                log.err(None, 'Dropped insert into %s' % buffer.name)
+                return
+
+            buffer.document.insert(content, offset)
+            self.edited(buffer, offset, u'', content)
+
+    def event_remove(self, bufid, seqno, args):
+        """
+        Text was removed from a Vim buffer, ``bufID:remove=seqno off length``.
+        """
+        buffer = self.buffers.get(bufid)
+        offset, length = args
+        if buffer is not None and length:
+            buffer.seqno = seqno
+            try:
+                end = buffer.document.char_offset(offset + length)
+                offset = buffer.document.char_offset(offset)
+            except ValueError:
+                log.err(None, 'Dropped remove from %s' % buffer.name)
+                return
+
+            removed = buffer.document.text(offset, end - offset)
+            buffer.document.delete(offset, end - offset)
+            self.edited(buffer, offset, removed, u'')
+
+    def edited(self, buffer, offset, removed, inserted):
+        """
+        The text `removed` at `offset` of `buffer` was replaced by `inserted`, in its
+        document too.  While reading the edit is held back, once there are too many of them
+        only what the buffer was before the read is kept.
+        """
+        if self.reading is None:
+            self.send_edits(buffer, [(offset, removed, inserted)], None)
             return
 
-        if data.startswith('AUTH'):
+        # The edit leaves the caret behind it, a move reported before it is out of date.
+        self.moved.pop(buffer, None)
+        pending = self.reading.setdefault(buffer, [[], None])
+        edits, before = pending
+        if before is None:
+            edits.append((offset, removed, inserted))
+            if len(edits) > self.BULK_EDITS:
+                before = buffer.document.text()
+                for offset, removed, inserted in reversed(edits):
+                    before = before[:offset] + removed + before[offset + len(inserted):]
+                pending[:] = [[], before]
+
+    def send_edits(self, buffer, edits, before):
+        """
+        Pass the `edits` to `buffer` on to the service, or with the text the buffer had
+        `before` them the edits found by diffing it with what the buffer has now.  Edits
+        made while remote ones were held back are transformed against them, the service is
+        already past those.
+        """
+        if before is None:
+            edits = [(offset, len(removed), inserted)
+                     for offset, removed, inserted in edits]
+        else:
+            self.service.metrics.count('vim.bulk_reads')
+            edits = splices(before, buffer.document.text())
+        if buffer in self.held:
+            edits = self.held[buffer].transform(edits)
+
+        for offset, length, text in edits:
+            if length:
+                self.service.delete_gobby(offset, length, buffer.name, self)
+            if text:
+                self.service.insert_gobby(text, offset, buffer.name, self)
+
+    def new_dot_and_mark(self, bufid, seqno, args):
+        """
+        Where the cursor is, ``bufID:newDotAndMark=seqno off off``.  Vim only sends this
+        right before a ``keyCommand``, like the one of ``:nbkey VobbyCaret`` from a
+        ``CursorMoved`` autocommand.  It is passed on after the edits of the same read.
+        """
+        buffer = self.buffers.get(bufid)
+        if buffer is None or len(args) < 2:
+            return
+        try:
+            dot = buffer.document.char_offset(args[0])
+            mark = buffer.document.char_offset(args[1])
+        except ValueError:
             return
 
-        # If we got here then we are looking at a specific buffer
-        for line in data.splitlines():
-            sentid = int(line[0])
-            command = line[2:]
-            if sentid in self.files:
-                # TODO we always seem to get remove and insert in the same run, so probably
-                # need to optimize this some.
+        selection = mark - dot
+        if self.reading is None:
+            if buffer in self.held:
+                dot, selection = self.held[buffer].caret(dot, selection)
+            self.service.caret_gobby(dot, selection, buffer.name)
+        else:
+            self.moved[buffer] = (dot, selection)
 
-                # Vim uses byte offsets into buffers.  May need to handle utf-8 vs ascii...
+    def key_command(self, bufid, seqno, args):
+        """
+        A key set up with ``:nbkey`` was pressed, ``bufID:keyCommand=seqno keyName``.
+        ``:nbkey VobbyStats`` shows the metrics of the service in a buffer,
+        ``:nbkey VobbyBrowse [path]`` what is in a directory of infinoted and
+        ``:nbkey VobbyOpen path`` opens a document of infinoted.  A path starting with
+        ``host:port/`` is on that server rather than the default one.  ``:nbkey
+        VobbyCaret`` does nothing but have Vim report the cursor, see
+        :meth:`new_dot_and_mark`.  What goes wrong is shown in the ``VobbyBrowse`` buffer
+        rather than losing the connection to Vim.
+        """
+        if not args:
+            return
 
-                if command.startswith('remove'):
-                    _, offset, length = command.split(' ', 2)
-                    self.service.delete_gobby(int(offset), int(length), self.files[sentid])
+        key = args[0].decode('utf-8', 'replace')
+        command, _, path = key.partition(u' ')
+        try:
+            if command == u'VobbyStats':
+                self.show(u'VobbyStats', u'\n'.join(self.service.stats()) + u'\n')
+            elif command == u'VobbyBrowse':
+                self.service.browse(path.strip(), self)
+            elif command == u'VobbyOpen' and path.strip():
+                self.service.open_document(path.strip())
+        except Exception as error:
+            log.err(None, 'Failed %s' % args[0])
+            self.show(u'VobbyBrowse', u'%s: %s\n' % (key, error))
+
+    def show(self, buffer_name, content):
+        """
+        Show `content` in the scratch buffer `buffer_name`, replacing what it showed before.
+        Changes to the buffer aren't listened to.
+        """
+        buffer = self.buffers.find(buffer_name)
+        if buffer is None:
+            buffer = self.buffers.add(buffer_name)
+            self.commands.command(buffer.bufid, 'create')
+            self.commands.command(buffer.bufid, 'setTitle', buffer_name)
+            self.commands.command(buffer.bufid, 'setFullName', buffer_name)
+        elif len(buffer.document):
+            self.commands.function(buffer.bufid, 'remove', 0,
+                                   buffer.document.byte_offset(len(buffer.document)))
+
+        buffer.document.sync(content)
+        self.commands.function(buffer.bufid, 'insert', 0, content)
+        self.commands.command(buffer.bufid, 'setModified', False)
+
+    def pauseProducing(self):
+        """
+        The transport has more to write than Vim reads, hold back the edits, commands and
+        carets.
+        """
+        self.service.metrics.count('vim.pauses')
+        self.paused = True
+        self.commands.pause()
+        self.carets.pause()
 
-                if command.startswith('insert'):
-                    _, offset, content = command.split(' ', 2)
-                    self.service.insert_gobby(content[1:-1], int(offset), self.files[sentid])
+    def resumeProducing(self):
+        """
+        Vim caught up, send the edits held back and everything else queued meanwhile.
+        """
+        self.paused = False
+        held, self.held = self.held, {}
+        for buffer, queue in held.items():
+            if self.buffers.find(buffer.name) is buffer:
+                for splice in queue.splices:
+                    self._delete(buffer, splice.offset, splice.length)
+                    self._insert(buffer, splice.text, splice.offset)
+        self.commands.resume()
+        self.carets.resume()
+
+    def stopProducing(self):
+        """
+        The connection is going away, drop what was held for it.
+        """
+        self.held = {}
 
     def watchFile(self, filename):
         """
@@ -70,74 +536,117 @@ class VimBeansProtocol(Protocol):
             filename (str): The filename of the Vim buffer to watch.  This will be the
                             filename local to the Vim instance running
 
-        Hard coded the sequence numbers as 2 and 3.  Not quite sure yet how to utilize or if
-        they need to be.
-
         TODO need to associate the buffer number with infinoted
 
         """
-        self.bufid += 1
-        self.files[self.bufid] = filename
-        self.transport.write(str(self.bufid) + ':putBufferNumber!2 ' + filename + '\n')
-        self.transport.write(str(self.bufid) + ':startDocumentListen!3\n')
+        buffer = self.buffers.add(filename)
+        self.commands.command(buffer.bufid, 'putBufferNumber', filename)
+        self.start_listening(buffer)
 
     def connectionLost(self, reason):
         """
-        TODO This might need to do something probably should close connection to infinoted
-
+        Vim went away, the documents stay subscribed to and are sent to Vim again when it
+        reconnects.
         """
         log.msg('Lost connection')
+        self.carets.stop()
+        self.service.vim_disconnected(self)
 
     def sync(self, content, buffer_name):
         """
-        Synce the `contents` of `buffer_name`
+        Append `content` to `buffer_name` while it is being synchronized.  Large contents
+        are sent as several inserts of at most :attr:`SYNC_CHUNK` characters, so Vim never
+        gets one giant message.
         """
-        # Find the buffer
-        for _file in self.files:
-            if self.files[_file] == buffer_name:
-                self.transport.write(str(_file) + ':insert/50 0 "' + content.replace('\n', '\\n') + '"\n')
-                self.transport.write(str(_file) + ':initDone!0\n')
-                break
+        buffer = self.buffers.find(buffer_name)
+        if buffer is None:
+            return
 
-        # Probably need a finally here...
+        document = buffer.document
+        for start in range(0, len(content), self.SYNC_CHUNK):
+            chunk = content[start:start + self.SYNC_CHUNK]
+            offset = document.byte_offset(len(document))
+            document.insert(chunk, len(document))
+            self.commands.function(buffer.bufid, 'insert', offset, chunk)
+
+    def sync_done(self, buffer_name):
+        """
+        All of `buffer_name` has been synchronized.
+        """
+        buffer = self.buffers.find(buffer_name)
+        if buffer is not None:
+            self.commands.command(buffer.bufid, 'initDone')
 
     def delete(self, offset, length, buffer_name):
         """
-        Deletes part of the buffer
+        Deletes `length` characters at the character `offset` of the buffer.
         """
-        for _file in self.files:
-            if self.files[_file] == buffer_name:
-                self.transport.write(str(_file) + ':remove/10 ' + str(offset) + ' ' +
-                                     str(length) + '\n')
+        buffer = self.buffers.find(buffer_name)
+        if buffer is None:
+            return
+        if self.paused:
+            self._hold(buffer).delete(offset, length)
+        else:
+            self._delete(buffer, offset, length)
 
     def insert(self, content, offset, buffer_name):
         """
         This will insert text into the given buffer.
 
         Args:
-            content (string): Data to insert.  Often this is one character at a time.
-            offset (int): Byte offset into the buffer.
+            content (unicode): Data to insert.  Often this is one character at a time.
+            offset (int): Character offset into the buffer.
             buffer_name (string): The buffer name.
 
         """
-        for _file in self.files:
-            if self.files[_file] == buffer_name:
-                self.transport.write(str(_file) + ':insert/20 ' + str(offset) + ' "' +
-                                     content.replace('\n', '\\n') + '"\n')
+        buffer = self.buffers.find(buffer_name)
+        if buffer is None:
+            return
+        if self.paused:
+            self._hold(buffer).insert(content, offset)
+        else:
+            self._insert(buffer, content, offset)
+
+    def _delete(self, buffer, offset, length):
+        if length:
+            start = buffer.document.byte_offset(offset)
+            end = buffer.document.byte_offset(offset + length)
+            buffer.document.delete(offset, length)
+            self.commands.function(buffer.bufid, 'remove', start, end - start)
+
+    def _insert(self, buffer, content, offset):
+        if content:
+            start = buffer.document.byte_offset(offset)
+            buffer.document.insert(content, offset)
+            self.commands.function(buffer.bufid, 'insert', start, content)
+
+    def _hold(self, buffer):
+        held = self.held.get(buffer)
+        if held is None:
+            held = self.held[buffer] = EditQueue(buffer.document.text,
+                                                 metrics=self.service.metrics, name='vim')
+        return held
 
     def new_buffer(self, filename):
         """
         Create a new buffer with name in Vim.
         """
-        self.bufid += 1
-        self.files[self.bufid] = filename
-        self.transport.write(str(self.bufid) + ':create!0\n')
-        self.transport.write(str(self.bufid) + ':setTitle!0 "' + filename + '"\n')
-        self.transport.write(str(self.bufid) + ':setFullName!0 "' + filename + '"\n')
-        self.transport.write(str(self.bufid) + ':setCaretListener!0\n')
-        self.transport.write(str(self.bufid) + ':setModified!0 F\n')
-        self.transport.write(str(self.bufid) + ':setContentType!0\n')
-        self.transport.write(str(self.bufid) + ':startDocumentListen!0\n')
+        buffer = self.buffers.add(filename)
+        self.commands.command(buffer.bufid, 'create')
+        self.commands.command(buffer.bufid, 'setTitle', filename)
+        self.commands.command(buffer.bufid, 'setFullName', filename)
+        self.commands.command(buffer.bufid, 'setCaretListener')
+        self.commands.command(buffer.bufid, 'setModified', False)
+        self.commands.command(buffer.bufid, 'setContentType')
+        self.start_listening(buffer)
+
+    def start_listening(self, buffer):
+        """
+        Have Vim report the changes to `buffer`.
+        """
+        if not buffer.listening:
+            buffer.listening = True
+            self.commands.command(buffer.bufid, 'startDocumentListen')
 
 
 class VimBeansFactory(ServerFactory):
@@ -149,12 +658,12 @@ class VimBeansFactory(ServerFactory):
 
     protocol = VimBeansProtocol
 
-    # TODO This isn't ideal really want one service per protocol instance
     def __init__(self, service):
         self.service = service
 
     def buildProtocol(self, service):
         """
-        This will build the protocol for the Vim protocol.
+        This will build the protocol for the Vim protocol.  Every Vim that connects gets
+        its own protocol, all of them sharing the one service and its infinoted sessions.
         """
         return VimBeansProtocol(self.service)
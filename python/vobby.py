@@ -1,18 +1,24 @@
 """
-This is a twisted TODO IS IT A PLUGIN OR AN APPLICATION OR WHAT? which implements the main
-Vim to infinoted communication.
+The service which implements the main Vim to infinoted communication.
 
 It will launch a server for Vim to Netbeans communication, and will connect that server to
-an infinoted server for the infintoed communication.
+an infinoted server for the infintoed communication.  :func:`make_service` puts it all
+together, ``run.py`` runs it straight on the reactor and ``vobby.tac`` under twistd.
 
 """
-
-# HACK FOR NOW THIS IS A TAC FILE
+import os
+import signal
+import tempfile
 
 from twisted.internet import reactor
+from twisted.python import log
 from twisted.application import internet, service
+from twisted.web.server import Site
 from vimbeans import VimBeansFactory
-from infinoted import InfinotedProtocol
+from pool import ConnectionPool
+from coalescer import OperationCoalescer
+from wiretrace import Tracer, RING
+from metrics import Metrics, MetricsResource
 
 
 class VobbyService(service.Service):
@@ -23,75 +29,424 @@ class VobbyService(service.Service):
     the :meth:`add_protocol` method.  Then these protocols can then call back into this
     service with generic editing operations that each instance will know how to handle.
 
+    Edits from Vim are merged by an :class:`OperationCoalescer` for `coalesce_window`
+    seconds before being sent on to infinoted, moves of the caret until it rests or the
+    next edits are sent.
+
+    Any number of Vims can be connected at once, they are kept in :attr:`vims`.  They share
+    the infinoted sessions, remote edits are sent to all of them and the edits of one are
+    sent to the others straight away, so their buffers never differ by more than what is
+    still on the way.
+
+    The traffic of both protocols is recorded by the :class:`Tracer` :attr:`tracer` at
+    `trace_level`, ``kill -USR1`` the process to dump it with :meth:`dump_trace`.
+
+    Neither side is written to faster than it reads.  The service registers each protocol as
+    the push producer of the transport it writes to.  While a Vim is behind the remote edits
+    for it are held by its protocol, while infinoted is behind the edits from Vim are held
+    by the coalescer, see :meth:`pause_gobby`.  Either way they are compacted once there are
+    too many, rather than piling up in the transport.
+
+    Throughput, latencies, queue depths and their high-water marks are recorded in the
+    :class:`Metrics` :attr:`metrics`, unless `metrics_enabled` is False.  The latency of
+    local edits is from the first edit held back by the coalescer until it is sent to
+    infinoted.
+
+    Everything scheduled, by the service and the protocols, goes through `clock`.
+
+    The connections to infinoted servers are kept in the :class:`ConnectionPool`
+    :attr:`pool`, documents are on the server at `infinoted` unless their path starts with
+    the ``host:port`` of another one.  Without `infinoted_tls` the connections are only
+    encrypted when the server requires it, to load test against :mod:`fake_infinoted`.
+
+    The connection to infinoted is opened as soon as the service starts, the documents
+    subscribed to before Vim connects are kept in their sessions and sent to Vim when it
+    does.  The time from starting to the first document being complete in Vim is recorded
+    as ``startup.first_sync``.
+
     """
-    def __init__(self):
-        self.vimbeans = None
-        self.infinoted = None
+    def __init__(self, coalesce_window=0.05, trace_level=RING, metrics_enabled=True,
+                 clock=reactor, infinoted=u'127.0.0.1:6523', infinoted_tls=True):
+        self.clock = clock
+        self.pool = ConnectionPool(self, infinoted, infinoted_tls)
+        self.tracer = Tracer(trace_level)
+        self.metrics = Metrics(metrics_enabled)
+        self.vims = []
+        self.coalescer = OperationCoalescer(self.send_insert, self.send_delete,
+                                            self.send_replace, coalesce_window, clock,
+                                            move=self.send_move, text=self.gobby_text,
+                                            metrics=self.metrics)
+        self.edited = {}
+        self.started = None
+        self.backlogged = set()
+
+        self.metrics.gauge('coalescer.buffers', lambda: len(self.coalescer.pending))
+        self.metrics.gauge('coalescer.held', lambda: sum(
+            [len(held) for held in self.coalescer.held.values()]))
+        self.metrics.gauge('vim.clients', lambda: len(self.vims))
+        self.metrics.gauge('vim.commands', self.queued_commands)
+        self.metrics.gauge('vim.held', lambda: sum(
+            [len(held) for vim in self.vims for held in vim.held.values()]))
+        self.metrics.gauge('infinoted.requests', self.queued_requests)
 
     def add_protocol(self, protocol):
         """
-        This will add the given `protocol` instance to this object.  If a protocol instance
-        that matches the `protocol` type already exists it will be replaced.
+        This will add the given `protocol` instance to this object, Vim protocols to the
+        others in :attr:`vims` and infinoted protocols to :attr:`pool`.
 
         """
         if protocol.__class__.__name__ == 'VimBeansProtocol':
-            self.vimbeans = protocol
+            if protocol not in self.vims:
+                self.vims.append(protocol)
         elif protocol.__class__.__name__ == 'InfinotedProtocol':
-            self.infinoted = protocol
+            self.pool.add(protocol)
         else:
             raise  # Some type error
 
     def startService(self):
         service.Service.startService(self)
-        # TODO this may need to be somewhere else.  Anyway kick off the ifinoted client.
-        # and now it's super hacky
-        reactor.callLater(5, self.start_infinoted)
+        self.started = self.metrics.now()
+        self.start_infinoted()
+
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1,
+                          lambda signum, frame: reactor.callFromThread(self.dump_trace))
+
+    def dump_trace(self, path=None):
+        """
+        Write the traffic recorded by :attr:`tracer` to `path`, ``vobby.trace`` in the
+        temporary directory by default.
+        """
+        path = path or os.path.join(tempfile.gettempdir(), 'vobby.trace')
+        with open(path, 'w') as output:
+            count = self.tracer.dump(output)
+        log.msg('Dumped %d traced messages to %s' % (count, path))
+
+    def stats(self):
+        """
+        The :attr:`metrics` as lines of text, also written to the log.
+        """
+        lines = self.metrics.format()
+        log.msg('\n'.join(lines))
+        return lines
+
+    def queued_commands(self):
+        return sum([len(vim.commands.pending) for vim in self.vims if vim.commands])
+
+    def queued_requests(self):
+        pipelines = [getattr(protocol, 'pipeline', None) for protocol in self.pool]
+        return sum([pipeline.queued for pipeline in pipelines if pipeline is not None])
 
     def start_infinoted(self):
-        self.infinoted = InfinotedProtocol(self)
+        self.pool.get()
+
+    def vim_connected(self, vim):
+        """
+        The Vim of the protocol `vim` just connected, create the buffers of the documents
+        already subscribed to in it and send it what was synchronized of them so far, with
+        the carets of the other users.  The protocol is registered as the producer of its
+        transport, to hold back what it sends while Vim is behind.
+        """
+        self.add_protocol(vim)
+        vim.transport.registerProducer(vim, True)
+        for protocol in self.pool:
+            for buffer_name in protocol.subscriptions.values():
+                vim.new_buffer(buffer_name)
+                session = protocol.buffers.get(buffer_name)
+                if session is None:
+                    continue
+                # the others already have the edits held back by the coalescer
+                self.flush_gobby(buffer_name)
+                if len(session.document):
+                    vim.sync(unicode(session.document), buffer_name)
+                if session.synced:
+                    vim.sync_done(buffer_name)
+                    self._synced()
+                for user in session.users.values():
+                    if user.status != u'unavailable' and user.name != protocol.user_name:
+                        vim.carets.move(buffer_name, user)
+
+    def vim_disconnected(self, vim):
+        """
+        The Vim of the protocol `vim` went away, keep the sessions for the others and for
+        when it connects again.
+        """
+        if vim in self.vims:
+            self.vims.remove(vim)
+        self.vim_backlogged(vim, False)
+
+    def vim_backlogged(self, vim, full):
+        """
+        The commands queued for the Vim of the protocol `vim` while it is behind passed
+        their high-water mark when `full`, stop reading from infinoted until every Vim
+        caught up, as what is read would only be queued for it too.
+        """
+        if full:
+            if not self.backlogged:
+                self.metrics.count('infinoted.read_pauses')
+                for protocol in self.pool:
+                    if protocol.xmlstream is not None:
+                        protocol.xmlstream.transport.pauseProducing()
+            self.backlogged.add(vim)
+        elif vim in self.backlogged:
+            self.backlogged.remove(vim)
+            if not self.backlogged:
+                for protocol in self.pool:
+                    if protocol.xmlstream is not None:
+                        protocol.xmlstream.transport.resumeProducing()
+
+    def infinoted_connected(self, protocol):
+        """
+        The infinoted `protocol` has a new stream, register it as the producer of the
+        transport so it is paused while infinoted is behind.  Nothing is read from it while
+        a Vim is backlogged.
+        """
+        protocol.xmlstream.transport.registerProducer(protocol, True)
+        if self.backlogged:
+            protocol.xmlstream.transport.pauseProducing()
+
+    def pause_gobby(self, protocol):
+        """
+        The infinoted behind `protocol` reads slower than it is sent to, hold the edits to
+        its documents in the coalescer, compacting them rather than sending more.
+        """
+        self.coalescer.pause(protocol.buffers.keys())
+
+    def resume_gobby(self, protocol):
+        """
+        The infinoted behind `protocol` caught up, send it the edits held back.  The edits
+        to a session not joined yet stay held until it is.
+        """
+        self.coalescer.resume([name for name, session in protocol.buffers.items()
+                               if session.algorithm.user is not None])
+
+    def hold_gobby(self, buffer_name, edits=()):
+        """
+        Hold the edits to `buffer_name` in the coalescer, along with the `edits` already
+        taken from it, until :meth:`resume_gobby`.  Its session can't be sent edits before
+        it is synchronized and joined.
+
+        Args:
+            edits (list): Triples of the offset, the number of characters to remove there
+                          and the text to insert in their place.
+        """
+        self.coalescer.pause([buffer_name])
+        for offset, length, text in edits:
+            self.coalescer.delete(offset, length, buffer_name)
+            self.coalescer.insert(text, offset, buffer_name)
+
+    def gobby_text(self, buffer_name):
+        """
+        The text of `buffer_name` as sent to infinoted so far, what the edits held by the
+        coalescer apply to.
+        """
+        protocol = self.pool.find(buffer_name)
+        session = protocol and protocol.buffers.get(buffer_name)
+        if session is None:
+            return u''
+        return unicode(session.document)
 
     def sync_vim(self, contents, buffer_name):
         """
-        This will sync the `contents` with the vim buffer associated with `buffer_name`
+        This will append the synchronized `contents` to the vim buffers associated with
+        `buffer_name`
+        """
+        for vim in self.vims:
+            vim.sync(contents, buffer_name)
+
+    def sync_vim_done(self, buffer_name):
+        """
+        The vim buffers associated with `buffer_name` have all of its contents.
+        """
+        for vim in self.vims:
+            vim.sync_done(buffer_name)
+        if self.vims:
+            self._synced()
+
+    def caret_vim(self, buffer_name, user, edited=False):
         """
-        self.vimbeans.sync(contents, buffer_name)
+        Show the caret of the other :class:`infinoted.User` `user` in the vim buffers
+        associated with `buffer_name`, with the line it is on as edited by them if
+        `edited`.
+        """
+        for vim in self.vims:
+            vim.carets.move(buffer_name, user, edited)
+
+    def caret_gone(self, buffer_name, name):
+        """
+        The user `name` left, stop showing their caret in `buffer_name`.
+        """
+        for vim in self.vims:
+            vim.carets.remove(buffer_name, name)
+
+    def _synced(self):
+        if self.started is not None:
+            self.metrics.since('startup.first_sync', self.started)
+            log.msg('First document synchronized %.3f seconds after starting.'
+                    % (self.metrics.now() - self.started))
+            self.started = None
+
+    def insert_gobby(self, content, offset, buffer_name, origin=None):
+        """
+        Vim inserted `content` at `offset` of `buffer_name`, the Vim of the protocol
+        `origin` if it was one of :attr:`vims`, which the others get straight away.
+        """
+        self._edit(buffer_name)
+        self.coalescer.insert(content, offset, buffer_name)
+        for vim in self.vims:
+            if vim is not origin:
+                vim.insert(content, offset, buffer_name)
+
+    def delete_gobby(self, offset, length, buffer_name, origin=None):
+        """
+        Vim deleted `length` characters at `offset` of `buffer_name`, like
+        :meth:`insert_gobby`.
+        """
+        self._edit(buffer_name)
+        self.coalescer.delete(offset, length, buffer_name)
+        for vim in self.vims:
+            if vim is not origin:
+                vim.delete(offset, length, buffer_name)
+
+    def caret_gobby(self, offset, selection, buffer_name):
+        """
+        The caret of Vim moved to `offset` of `buffer_name`, with `selection` characters
+        selected from there.
+        """
+        self.metrics.count('vim.caret_moves')
+        self.coalescer.move(offset, selection, buffer_name)
+
+    def send_insert(self, content, offset, buffer_name):
+        protocol = self._send(buffer_name)
+        if protocol is not None:
+            protocol.insert_text(content, offset, buffer_name)
 
-    def insert_gobby(self, content, offset, buffer_name):
-        self.infinoted.insert_text(content, offset, buffer_name)
+    def send_delete(self, offset, length, buffer_name):
+        protocol = self._send(buffer_name)
+        if protocol is not None:
+            protocol.delete_text(offset, length, buffer_name)
 
-    def delete_gobby(self, offset, length, buffer_name):
-        self.infinoted.delete_text(offset, length, buffer_name)
+    def send_replace(self, offset, length, content, buffer_name):
+        protocol = self._send(buffer_name)
+        if protocol is not None:
+            protocol.replace_text(offset, length, content, buffer_name)
+
+    def send_move(self, offset, selection, buffer_name):
+        protocol = self.pool.find(buffer_name)
+        if protocol is not None:
+            protocol.move_caret(offset, selection, buffer_name)
+
+    def _edit(self, buffer_name):
+        self.metrics.count('vim.edits')
+        if buffer_name not in self.edited:
+            self.edited[buffer_name] = self.metrics.now()
+
+    def _send(self, buffer_name):
+        self.metrics.count('infinoted.edits')
+        self.metrics.since('latency.vim_to_infinoted', self.edited.pop(buffer_name, None))
+        return self.pool.find(buffer_name)
+
+    def flush_gobby(self, buffer_name, held=True):
+        """
+        Send the edits to `buffer_name` still held back by the coalescer.  Without `held`
+        the edits held while infinoted is behind stay held.
+        """
+        self.coalescer.flush(buffer_name, held)
+
+    def received_gobby(self, start):
+        """
+        A request from infinoted, received at `start`, was passed on to the Vims, its
+        latency is recorded once it is written to them.
+        """
+        for vim in self.vims:
+            vim.commands.mark(start)
 
     def insert_vim(self, content, offset, buffer_name):
-        self.vimbeans.insert(content, offset, buffer_name)
+        self._edit_vim(buffer_name, [(offset, 0, content)])
 
     def delete_vim(self, offset, length, buffer_name):
-        self.vimbeans.delete(offset, length, buffer_name)
+        self._edit_vim(buffer_name, [(offset, length, u'')])
+
+    def _edit_vim(self, buffer_name, edits):
+        # The edits held back for infinoted are in Vim already, the remote ones have to
+        # come after them.
+        for offset, length, text in self.coalescer.transform(buffer_name, edits):
+            for vim in self.vims:
+                if length:
+                    vim.delete(offset, length, buffer_name)
+                if text:
+                    vim.insert(text, offset, buffer_name)
 
     def new_buffer(self, buffer_name):
         """
-        Create a new buffer with name in Vim.
+        Create a new buffer with name in every connected Vim.
         """
-        self.vimbeans.new_buffer(buffer_name)
+        for vim in self.vims:
+            vim.new_buffer(buffer_name)
+
+    def browse(self, location, vim):
+        """
+        Show what is in the infinoted subdirectory at `location`, ``path`` or
+        ``host:port/path``, in the ``VobbyBrowse`` buffer of the Vim of the protocol `vim`,
+        exploring it first unless it already was.
+        """
+        protocol, path = self.pool.resolve(location)
+        protocol.explore_path(path).addCallback(self._show_listing, protocol, location, vim)
+
+    def _show_listing(self, node, protocol, location, vim):
+        if node is None:
+            lines = [u'%s: not found' % location]
+        elif node.is_directory():
+            lines = ([protocol.prefix + node.path() + u'/'] +
+                     protocol.directory.listing(node))
+        else:
+            lines = [protocol.prefix + node.path()]
+        if vim in self.vims:
+            vim.show(u'VobbyBrowse', u'\n'.join(lines) + u'\n')
+
+    def open_document(self, location):
+        """
+        Open the infinoted document at `location`, ``path`` or ``host:port/path``, in a new
+        buffer, exploring the directories on the way unless they already were.
+        """
+        protocol, path = self.pool.resolve(location)
+        protocol.explore_path(path).addCallback(
+            lambda node: node is not None and protocol.open(node.path()))
 
 
-# configuration parameters
-port = 3219
-iface = 'localhost'
+def make_service(port=3219, metrics_port=3220, iface='localhost',
+                 infinoted=u'127.0.0.1:6523', infinoted_tls=True, coalesce_window=0.05):
+    """
+    Put together the :class:`VobbyService` with the servers for Vim and for the metrics.
 
-# this will hold the services that combine to form the poetry server
-top_service = service.MultiService()
+    Kwargs:
+        port (int): The port Vim connects to with ``:nbstart``.
+        metrics_port (int): The port serving the metrics as JSON, None for none.
+        iface (string): The interface both listen on.
+        infinoted (unicode): Passed on to the :class:`VobbyService`.
+        infinoted_tls (bool): Passed on to the :class:`VobbyService`.
+        coalesce_window (float): Passed on to the :class:`VobbyService`.
+
+    Returns:
+        service.MultiService: All of them, the server for Vim starting first so Vim can
+                              connect while infinoted is being connected to.
+    """
+    top_service = service.MultiService()
+    vobby_service = VobbyService(coalesce_window, infinoted=infinoted,
+                                 infinoted_tls=infinoted_tls)
 
-vobby_service = VobbyService()
-vobby_service.setServiceParent(top_service)
+    # the tcp service connects the factory to a listening socket. it will
+    # create the listening socket when it is started
+    factory = VimBeansFactory(vobby_service)
+    tcp_service = internet.TCPServer(port, factory, interface=iface)
+    tcp_service.setServiceParent(top_service)
 
-# the tcp service connects the factory to a listening socket. it will
-# create the listening socket when it is started
-factory = VimBeansFactory(vobby_service)
-tcp_service = internet.TCPServer(port, factory, interface=iface)
-tcp_service.setServiceParent(top_service)
+    vobby_service.setServiceParent(top_service)
 
-application = service.Application("Vobby")
+    # the metrics as JSON, curl http://localhost:3220/
+    if metrics_port is not None:
+        metrics_site = Site(MetricsResource(vobby_service.metrics))
+        metrics_service = internet.TCPServer(metrics_port, metrics_site, interface=iface)
+        metrics_service.setServiceParent(top_service)
 
-# this hooks the collection we made to the application
-top_service.setServiceParent(application)
+    return top_service
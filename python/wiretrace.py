@@ -0,0 +1,88 @@
+"""
+Tracing of the raw traffic to Vim and infinoted.
+
+Logging every read and write costs more than the rest of the bridge put together, so the
+traffic is only kept, unformatted, in a ring buffer of the last messages.  It is formatted
+when the trace is dumped, for instance after something went wrong.
+
+"""
+import collections
+import time
+
+from twisted.python import log
+
+# Trace levels, each includes the ones before it.
+OFF = 0
+RING = 1
+LOG = 2
+
+
+class Tracer(object):
+    """
+    Keeps the last `size` messages seen by the protocols.
+
+    Kwargs:
+        level (int): :data:`OFF` keeps nothing, :data:`RING` keeps the messages in the ring
+                     buffer and :data:`LOG` also writes each one to the twisted log as it
+                     is seen, which is slow.
+        size (int): How many messages the ring buffer holds.
+        sample (int): Only keep one of every `sample` messages.
+
+    """
+    def __init__(self, level=RING, size=4096, sample=1):
+        self.level = level
+        self.sample = sample
+        self.count = 0
+        self.messages = collections.deque(maxlen=size)
+
+    def record(self, source, direction, data):
+        """
+        Record `data` which `source` sent or received, `direction` is ``'<'`` for received
+        and ``'>'`` for sent.
+        """
+        if self.level < RING:
+            return
+
+        self.count += 1
+        if self.sample > 1 and self.count % self.sample:
+            return
+
+        message = (time.time(), source, direction, data)
+        self.messages.append(message)
+        if self.level >= LOG:
+            log.msg(format_message(message))
+
+    def dump(self, output):
+        """
+        Write the messages in the ring buffer, oldest first, to the file like `output`.
+
+        Returns:
+            int: The number of messages written.
+        """
+        messages = list(self.messages)
+        for message in messages:
+            output.write(format_message(message) + '\n')
+        return len(messages)
+
+
+def format_message(message):
+    """
+    Format a message recorded by a :class:`Tracer` as one line.
+    """
+    timestamp, source, direction, data = message
+    if not isinstance(data, unicode):
+        data = data.decode('utf-8', 'replace')
+    return '%s.%03d %s %s %s' % (time.strftime('%H:%M:%S', time.localtime(timestamp)),
+                                 int(timestamp * 1000) % 1000, source, direction,
+                                 data.encode('unicode_escape'))
+
+
+def parse_message(line):
+    """
+    Parse a line written by :meth:`Tracer.dump` back into its parts.
+
+    Returns:
+        tuple: ``(source, direction, data)``, `data` being unicode.
+    """
+    timestamp, source, direction, data = line.split(' ', 3)
+    return source, direction, data.decode('unicode_escape')